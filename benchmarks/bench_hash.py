@@ -0,0 +1,71 @@
+"""
+Micro-benchmark comparing ``ss.calculate_hash_for_file`` against the
+original implementation, which read and unpacked one 64 bit word at a time.
+
+Usage:
+
+    python benchmarks/bench_hash.py [number of repetitions]
+"""
+from __future__ import print_function
+import os
+import struct
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import ss  # noqa
+
+
+def reference_hash_for_file(name):
+    longlongformat = 'q'  # long long
+    bytesize = struct.calcsize(longlongformat)
+    filesize = os.path.getsize(name)
+    hash = filesize
+    with open(name, 'rb') as f:
+        for x in range(65536 // bytesize):
+            (l_value,) = struct.unpack(longlongformat, f.read(bytesize))
+            hash = (hash + l_value) & 0xFFFFFFFFFFFFFFFF
+        f.seek(max(0, filesize - 65536), 0)
+        for x in range(65536 // bytesize):
+            (l_value,) = struct.unpack(longlongformat, f.read(bytesize))
+            hash = (hash + l_value) & 0xFFFFFFFFFFFFFFFF
+    return '%016x' % hash
+
+
+def main(argv):
+    number = int(argv[1]) if len(argv) > 1 else 200
+    fd, filename = tempfile.mkstemp(suffix='.avi')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(os.urandom(4 * 1024 * 1024))
+        assert ss.calculate_hash_for_file(filename) == \
+            reference_hash_for_file(filename)
+
+        # each candidate runs with its own value of the cached numpy module,
+        # so "ss (struct)" doesn't leak into the timing of "ss"
+        numpy = ss._import_numpy()
+        candidates = [('reference', reference_hash_for_file, numpy),
+                      ('ss', ss.calculate_hash_for_file, numpy)]
+        if numpy is not None:
+            candidates.append(('ss (struct)', ss.calculate_hash_for_file, None))
+
+        timings = []
+        for name, func, candidate_numpy in candidates:
+            ss._numpy[:] = [candidate_numpy]
+            try:
+                elapsed = timeit.timeit(lambda: func(filename), number=number)
+            finally:
+                ss._numpy[:] = [numpy]
+            timings.append((name, elapsed / number))
+
+        reference_time = timings[0][1]
+        for name, per_call in timings:
+            print('{0:<15} {1:10.1f} us/file {2:8.1f}x'.format(
+                name, per_call * 1e6, reference_time / per_call))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
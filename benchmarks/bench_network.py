@@ -0,0 +1,350 @@
+"""
+End to end benchmark of ``ss.main`` against local stand-ins for the
+OpenSubtitles XML-RPC API and its download server, with configurable
+latency, jitter and error rate.
+
+A synthetic tree of movies is created in a temporary directory and ss is run
+on it once for each value of ``parallel_jobs``, using the real code paths for
+hashing, searching and downloading (only the configuration is replaced).
+For each run it reports files per second and the p50/p99 latencies of each
+stage, as seen by ss.
+
+Usage:
+
+    python benchmarks/bench_network.py [options]
+
+Run with ``--help`` for the options.
+"""
+from __future__ import print_function, division
+from contextlib import closing
+from gzip import GzipFile
+from io import BytesIO
+import optparse
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import ss  # noqa
+
+if sys.version_info[0] == 3:  # pragma: no cover
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from io import StringIO
+    from socketserver import ThreadingMixIn
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+else:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from SimpleXMLRPCServer import SimpleXMLRPCServer, \
+        SimpleXMLRPCRequestHandler
+    from StringIO import StringIO
+
+
+class NetworkConditions(object):
+    """
+    Latency (plus up to ``jitter`` seconds) and rate of errors of a server.
+    """
+
+    def __init__(self, latency, jitter, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """
+        Sleeps as the server would, returning True if the request should
+        fail.
+        """
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.requests += 1
+            self.errors += failed
+        return failed
+
+
+class StandInOpenSubtitles(object):
+    """
+    XML-RPC methods of OpenSubtitles used by ss. ``found_rate`` of the movies
+    have subtitles in every language, downloaded from ``subtitles_url``.
+    """
+
+    def __init__(self, conditions, subtitles_url, found_rate):
+        self.conditions = conditions
+        self.subtitles_url = subtitles_url
+        self.found_rate = found_rate
+
+    def LogIn(self, username, password, language, useragent):
+        self.conditions.delay()
+        return {'token': 'TOKEN', 'status': '200 OK'}
+
+    def LogOut(self, token):
+        return {'status': '200 OK'}
+
+    def SearchSubtitles(self, token, queries):
+        if self.conditions.delay():
+            return {'status': '503 Service Unavailable'}
+        data = []
+        for i, query in enumerate(queries):
+            title = query.get('query')
+            # stable per movie, so every run finds the same subtitles
+            if title and zlib.crc32(title.encode('utf-8')) % 100 < \
+                    self.found_rate * 100:
+                data.append(dict(
+                    QueryNumber=str(i), SubLanguageID=query['sublanguageid'],
+                    SeriesSeason=str(query.get('season', 0)),
+                    SeriesEpisode=str(query.get('episode', 0)),
+                    SubFormat='srt', SubDownloadLink='{0}/{1}.gz'.format(
+                        self.subtitles_url, i)))
+        return {'status': '200 OK', 'data': data or False}
+
+
+class XMLRPCRequestHandler(SimpleXMLRPCRequestHandler):
+    # otherwise Nagle's algorithm delays keep-alive responses, dominating
+    # the latencies measured
+    disable_nagle_algorithm = True
+
+
+class ThreadingXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_servers(options):
+    """
+    Starts the download and XML-RPC servers on threads.
+
+    :return: (servers, OpenSubtitles uri, download NetworkConditions,
+        search NetworkConditions)
+    """
+    download_conditions = NetworkConditions(
+        options.download_latency / 1000, options.jitter / 1000,
+        options.error_rate)
+    buf = BytesIO()
+    with closing(GzipFile(fileobj=buf, mode='wb')) as f:
+        f.write(b'1\n00:00:01,000 --> 00:00:02,000\nsubtitle\n\n' * 500)
+    subtitle = buf.getvalue()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if download_conditions.delay():
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(subtitle)))
+            self.end_headers()
+            self.wfile.write(subtitle)
+
+        def log_message(self, *args):
+            pass
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    subtitles_url = 'http://127.0.0.1:%d' % http_server.server_address[1]
+
+    search_conditions = NetworkConditions(
+        options.latency / 1000, options.jitter / 1000, options.error_rate)
+    rpc_server = ThreadingXMLRPCServer(('127.0.0.1', 0),
+                                       requestHandler=XMLRPCRequestHandler,
+                                       logRequests=False, allow_none=True)
+    rpc_server.register_instance(StandInOpenSubtitles(
+        search_conditions, subtitles_url, options.found_rate))
+    uri = 'http://127.0.0.1:%d/RPC2' % rpc_server.server_address[1]
+
+    servers = [http_server, rpc_server]
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return servers, uri, download_conditions, search_conditions
+
+
+def create_movies(dirname, count):
+    series = ['Some.Show', 'Another.Show', 'Third.Show']
+    for i in range(count):
+        if i % 2:
+            name = 'Movie.Number.{0}.{1}.avi'.format(i, 1950 + i % 70)
+        else:
+            name = '{0}.S{1:02d}E{2:02d}.avi'.format(
+                series[i % len(series)], i // 100 + 1, i % 100)
+        with open(os.path.join(dirname, name), 'wb') as f:
+            f.write(os.urandom(128 * 1024))
+
+
+class StageTimer(object):
+    """
+    Replaces module level functions of ss by wrappers recording how long
+    each call takes, per stage.
+    """
+
+    def __init__(self):
+        self.timings = {}  # stage -> list of seconds
+        self._originals = []
+        self._lock = threading.Lock()
+
+    def wrap(self, stage, name):
+        func = getattr(ss, name)
+        timings = self.timings.setdefault(stage, [])
+
+        def timed(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    timings.append(time.time() - started)
+
+        self._originals.append((name, func))
+        setattr(ss, name, timed)
+
+    def restore(self):
+        for name, func in reversed(self._originals):
+            setattr(ss, name, func)
+        self._originals = []
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(p / 100 * (len(values) - 1)))]
+
+
+STAGES = [
+    # stage, function wrapped (called through the module by the thread engine)
+    ('hash', 'calculate_hash_for_file'),
+    ('search', 'query_open_subtitles_batch'),
+    ('download', 'download_movie_subtitle'),
+]
+
+
+def run(movies_dir, config):
+    """
+    Runs ss once with the given configuration.
+
+    :return: (seconds, StageTimer, output of ss)
+    """
+    for name in os.listdir(movies_dir):
+        if name.endswith('.srt'):
+            os.remove(os.path.join(movies_dir, name))
+    shutil.rmtree(config.cache_dir, ignore_errors=True)
+
+    timer = StageTimer()
+    for stage, name in STAGES:
+        timer.wrap(stage, name)
+    original_load_configuration = ss.load_configuration
+    ss.load_configuration = lambda filename: config
+    stream = StringIO()
+    try:
+        started = time.time()
+        ss.main(['ss', movies_dir], stream=stream)
+        elapsed = time.time() - started
+    finally:
+        ss.load_configuration = original_load_configuration
+        timer.restore()
+    return elapsed, timer, stream.getvalue()
+
+
+def main(argv):
+    parser = optparse.OptionParser(
+        usage='Usage: python benchmarks/bench_network.py [options]')
+    parser.add_option('--movies', type='int', default=200,
+                      help='number of movies in the synthetic tree [200]')
+    parser.add_option('--languages', default='eng',
+                      help='comma separated languages to search [eng]')
+    parser.add_option('--jobs', default='1,2,4,8,16',
+                      help='comma separated values of parallel_jobs '
+                           '[1,2,4,8,16]')
+    parser.add_option('--engine', default='thread', choices=ss.ENGINES,
+                      help='engine to benchmark [thread]')
+    parser.add_option('--latency', type='float', default=50,
+                      help='milliseconds each search takes [50]')
+    parser.add_option('--download-latency', type='float', default=10,
+                      help='milliseconds each download takes [10]')
+    parser.add_option('--jitter', type='float', default=20,
+                      help='up to this many milliseconds are added to each '
+                           'request [20]')
+    parser.add_option('--error-rate', type='float', default=0.01,
+                      help='fraction of requests failing with 503 [0.01]')
+    parser.add_option('--found-rate', type='float', default=0.8,
+                      help='fraction of movies with subtitles [0.8]')
+    options, args = parser.parse_args(argv[1:])
+
+    servers, uri, download_conditions, search_conditions = \
+        start_servers(options)
+    ss.OPENSUBTITLES_URI = uri
+    tempdir = tempfile.mkdtemp(prefix='ss-bench-')
+    try:
+        movies_dir = os.path.join(tempdir, 'movies')
+        os.mkdir(movies_dir)
+        create_movies(movies_dir, options.movies)
+        languages = options.languages.split(',')
+        files = options.movies * len(languages)
+
+        print('{0} movies, {1} languages, {2} engine; search {3:.0f}ms, '
+              'download {4:.0f}ms, jitter {5:.0f}ms, {6:.0%} errors'.format(
+                  options.movies, len(languages), options.engine,
+                  options.latency, options.download_latency, options.jitter,
+                  options.error_rate))
+        print()
+        columns = ['jobs', 'seconds', 'files/s', 'speedup', 'ok', 'errors']
+        columns += ['{0} p50/p99 ms'.format(stage) for stage, _ in STAGES]
+        print('  '.join('{0:>8}'.format(x) if i < len(columns) - len(STAGES)
+                        else '{0:>22}'.format(x)
+                        for i, x in enumerate(columns)))
+
+        baseline = None
+        for jobs in [int(x) for x in options.jobs.split(',')]:
+            config = ss.Configuration(
+                languages=languages, parallel_jobs=jobs,
+                engine=options.engine,
+                cache_dir=os.path.join(tempdir, 'cache'))
+            elapsed, timer, output = run(movies_dir, config)
+            rate = files / elapsed
+            baseline = baseline or rate
+            row = ['{0:>8}'.format(jobs), '{0:>8.2f}'.format(elapsed),
+                   '{0:>8.1f}'.format(rate),
+                   '{0:>7.1f}x'.format(rate / baseline),
+                   '{0:>8}'.format(len(re.findall(r'\[OK\]', output))),
+                   '{0:>8}'.format(len(re.findall(r'\[ERROR\]', output)))]
+            for stage, _ in STAGES:
+                timings = timer.timings[stage]
+                if timings:
+                    cell = '{0:.1f} / {1:.1f}'.format(
+                        percentile(timings, 50) * 1000,
+                        percentile(timings, 99) * 1000)
+                else:
+                    cell = '-'  # not called through ss (async engine)
+                row.append('{0:>22}'.format(cell))
+            print('  '.join(row))
+
+        print()
+        print('Server requests: {0} searches ({1} failed), {2} downloads '
+              '({3} failed)'.format(
+                  search_conditions.requests, search_conditions.errors,
+                  download_conditions.requests, download_conditions.errors))
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
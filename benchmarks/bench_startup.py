@@ -0,0 +1,69 @@
+"""
+Startup time of ss: how long ``import ss``, ``ss --help`` and a run with
+nothing to do take over starting the interpreter, in fresh processes as the
+``ss`` entry point is used.
+
+Usage:
+
+    python benchmarks/bench_startup.py [repetitions] [maximum overhead in ms]
+
+When the maximum is given, exits with status 1 if importing ss takes longer
+than that, to catch a heavy import creeping back to module level.
+"""
+from __future__ import print_function, division
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+def best_time(code, repetitions):
+    """
+    Returns the best wall time, in seconds, of running the given code in a
+    new interpreter.
+    """
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repetitions):
+            started = time.time()
+            subprocess.check_call([sys.executable, '-c', code], cwd=ROOT,
+                                  stdout=devnull, stderr=devnull)
+            elapsed = time.time() - started
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(argv):
+    repetitions = int(argv[1]) if len(argv) > 1 else 20
+    maximum = float(argv[2]) / 1000 if len(argv) > 2 else None
+    empty_dir = tempfile.mkdtemp(prefix='ss-startup-')
+    try:
+        baseline = best_time('pass', repetitions)
+        cases = [
+            ('import ss', 'import ss'),
+            ('ss --help', 'import ss; ss.main(["ss", "--help"])'),
+            ('ss <empty dir>', 'import ss; ss.main(["ss", %r])' % empty_dir),
+        ]
+        print('{0:<16} {1:>8.1f} ms'.format('python', baseline * 1000))
+        overheads = {}
+        for name, code in cases:
+            elapsed = best_time(code, repetitions)
+            overheads[name] = elapsed - baseline
+            print('{0:<16} {1:>8.1f} ms {2:>+8.1f} ms'.format(
+                name, elapsed * 1000, overheads[name] * 1000))
+    finally:
+        shutil.rmtree(empty_dir)
+
+    if maximum is not None and overheads['import ss'] > maximum:
+        print('import ss takes {0:.1f} ms over python, more than {1:.1f} '
+              'ms'.format(overheads['import ss'] * 1000, maximum * 1000))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
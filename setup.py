@@ -10,7 +10,7 @@ setup(
     version="1.6.0",
     packages=[],
     scripts=['ss.py'],
-    py_modules=['ss'],
+    py_modules=['ss', 'ss_async'],
     install_requires=['guessit>=2', 'colorama'],
     entry_points={'console_scripts': ['ss = ss:main']},
     extras_require={
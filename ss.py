@@ -1,37 +1,46 @@
 from __future__ import print_function, division
-from contextlib import closing
-import gzip
+from contextlib import closing, contextmanager
+import bisect
+import errno
 import optparse
 import os
-import shutil
+import random
+import socket
 import struct
-import tempfile
 import sys
 import subprocess
 import itertools
+import threading
+import time
+import json
+import uuid
+import collections
+import zlib
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from colorama import init, Fore, Style
-import guessit
-
-
-init(autoreset=True)
+# guessit, colorama, sqlite3, urllib and concurrent.futures are imported
+# only by the functions using them: ss is often called just to find out
+# there is nothing to do, and importing them takes most of its startup time
 
 
 __version__ = '1.5.2'
 
 if sys.version_info[0] == 3: # pragma: no cover
-    from urllib.request import urlopen
-    from xmlrpc.client import ServerProxy
+    from urllib.parse import urljoin, urlsplit
+    from xmlrpc.client import ServerProxy, Transport
     from configparser import RawConfigParser
+    import http.client as http_client
+    import queue
 else:  # pragma: no cover
-    from urllib import urlopen
-    from xmlrpclib import Server as ServerProxy
+    from urlparse import urljoin, urlsplit
+    from xmlrpclib import Server as ServerProxy, Transport
     from ConfigParser import RawConfigParser
+    import httplib as http_client
+    import Queue as queue
 
 
-def obtain_guessit_query(movie_filename, language):
-    guess = guessit.guessit(os.path.basename(movie_filename))
+def obtain_guessit_query(movie_filename, language, guess=None):
+    if guess is None:
+        guess = guess_movie(movie_filename)
 
     def extract_query(guess, parts):
         result = ['"%s"' % guess.get(k) for k in parts if guess.get(k)]
@@ -55,14 +64,217 @@ def obtain_guessit_query(movie_filename, language):
     return result
 
 
-def obtain_movie_hash_query(movie_filename, language):
+# properties of guessit's guess used by obtain_guessit_query
+GUESS_KEYS = ('type', 'title', 'episode_title', 'release_group', 'year',
+              'season', 'episode')
+
+
+def guess_movie(movie_filename):
+    """
+    Parses the name of the movie with guessit.
+
+    :rtype: dict
+    :return: the properties in GUESS_KEYS guessed, as JSON types.
+    """
+    import guessit
+    with profiled('guessit', movie_filename):
+        guess = guessit.guessit(os.path.basename(movie_filename))
+    result = {}
+    for key in GUESS_KEYS:
+        value = guess.get(key)
+        if value is not None:
+            if not isinstance(value, (int, list)):
+                value = u'%s' % value
+            result[key] = value
+    return result
+
+
+def guess_movie_names(basenames):
+    """
+    Runs `guess_movie` for many movies in one go, to amortize the cost of
+    sending them to another process.
+
+    :rtype: list(dict|None)
+    :return: the guess for each name, or None for the names guessit failed
+        to parse, which are parsed again (reporting the error) when
+        searched.
+    """
+    results = []
+    for basename in basenames:
+        try:
+            results.append(guess_movie(basename))
+        except Exception:
+            results.append(None)
+    return results
+
+
+def guessit_version():
+    """
+    Returns the version of guessit installed, without importing it if
+    possible.
+    """
+    try:
+        from importlib.metadata import version
+        return version('guessit')
+    except ImportError:  # pragma: no cover
+        import guessit
+        return guessit.__version__
+
+
+def create_process_pool(processes):
+    """
+    Returns a ProcessPoolExecutor starting fresh interpreters, as forking
+    the threads of a run is not safe.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    try:
+        context = multiprocessing.get_context('spawn')
+    except AttributeError:  # pragma: no cover
+        return ProcessPoolExecutor(processes)
+    return ProcessPoolExecutor(processes, mp_context=context)
+
+
+def obtain_movie_hash_query(movie_filename, language, hash_cache=None):
+    if hash_cache is not None:
+        moviehash = hash_cache.get_hash(movie_filename)
+    else:
+        moviehash = calculate_hash_for_file(movie_filename)
     return {
-        'moviehash': calculate_hash_for_file(movie_filename),
+        'moviehash': moviehash,
         'moviebytesize': str(os.path.getsize(movie_filename)),
         'sublanguageid': language,
     }
 
 
+# number of movie names sent at a time to each guessit process
+GUESSIT_CHUNK_SIZE = 64
+
+
+class MovieAnalyzer(object):
+    """
+    Computes the per-file information needed to search for subtitles (the
+    guessit guess and the movie hash and size) once per movie, reusing it
+    for the queries of every language.
+
+    ``calls`` counts how many guessit parses and hash calculations were
+    actually made, and ``saved`` how many were served from memory instead.
+    """
+
+    def __init__(self, hash_cache=None, guessit_cache=None):
+        """
+        :param HashCache hash_cache: if given, used to obtain movie hashes.
+        :param GuessitCache guessit_cache: if given, used to obtain guessit
+            guesses.
+        """
+        self.hash_cache = hash_cache
+        self.guessit_cache = guessit_cache
+        self.calls = {'guessit': 0, 'hash': 0}
+        self.saved = {'guessit': 0, 'hash': 0}
+        self._memo = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _memoize(self, kind, movie_filename, compute):
+        key = (kind, movie_filename)
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        # the per-key lock ensures concurrent callers compute it only once
+        with key_lock:
+            if key in self._memo:
+                with self._lock:
+                    self.saved[kind] += 1
+                return self._memo[key]
+            value = compute()
+            with self._lock:
+                self.calls[kind] += 1
+                self._memo[key] = value
+            return value
+
+    def guessit_query(self, movie_filename, language):
+        guess = self._memoize('guessit', movie_filename,
+                              lambda: self._guess(movie_filename))
+        return obtain_guessit_query(movie_filename, language, guess=guess)
+
+    def _guess(self, movie_filename):
+        basename = os.path.basename(movie_filename)
+        if self.guessit_cache is not None:
+            guess = self.guessit_cache.lookup([basename]).get(basename)
+            if guess is not None:
+                return guess
+        guess = guess_movie(movie_filename)
+        if self.guessit_cache is not None:
+            self.guessit_cache.store({basename: guess})
+        return guess
+
+    def analyze(self, movie_filenames, processes=1,
+                chunk_size=GUESSIT_CHUNK_SIZE):
+        """
+        Parses the names of the given movies with guessit ahead of their
+        searches, which then find the guesses ready.
+
+        Names not in the guessit cache are parsed in chunks of ``chunk_size``
+        by ``processes`` processes, so the parsing, which is CPU bound, does
+        not compete for the GIL with the threads doing network I/O.
+
+        :return: iterator of lists of movie filenames, yielded as their
+            guesses become available.
+        """
+        pending = []
+        with self._lock:
+            for movie_filename in movie_filenames:
+                if ('guessit', movie_filename) not in self._memo and \
+                        movie_filename not in pending:
+                    pending.append(movie_filename)
+        if not pending:
+            return
+
+        if self.guessit_cache is not None:
+            cached = self.guessit_cache.lookup(
+                [os.path.basename(x) for x in pending])
+            ready = [x for x in pending if os.path.basename(x) in cached]
+            self._remember(ready, [cached[os.path.basename(x)]
+                                   for x in ready], cached=True)
+            if ready:
+                yield ready
+            pending = [x for x in pending if os.path.basename(x) not in cached]
+
+        chunks = [pending[i:i + chunk_size]
+                  for i in range(0, len(pending), chunk_size)]
+        basenames = [[os.path.basename(x) for x in chunk] for chunk in chunks]
+        if processes > 1 and len(chunks) > 1:
+            executor = create_process_pool(min(processes, len(chunks)))
+            try:
+                for chunk, guesses in zip(chunks, executor.map(
+                        guess_movie_names, basenames)):
+                    yield self._remember(chunk, guesses)
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            for chunk, names in zip(chunks, basenames):
+                yield self._remember(chunk, guess_movie_names(names))
+
+    def _remember(self, movie_filenames, guesses, cached=False):
+        parsed = {}
+        with self._lock:
+            for movie_filename, guess in zip(movie_filenames, guesses):
+                if guess is not None:
+                    self._memo[('guessit', movie_filename)] = guess
+                    if not cached:
+                        self.calls['guessit'] += 1
+                        parsed[os.path.basename(movie_filename)] = guess
+        if parsed and self.guessit_cache is not None:
+            self.guessit_cache.store(parsed)
+        return movie_filenames
+
+    def movie_hash_query(self, movie_filename, language):
+        query = self._memoize(
+            'hash', movie_filename,
+            lambda: obtain_movie_hash_query(movie_filename, None,
+                                            self.hash_cache))
+        return dict(query, sublanguageid=language)
+
+
 def filter_bad_results(search_results, guessit_query):
     """
     filter out search results with bad season and episode number (if
@@ -77,35 +289,500 @@ def filter_bad_results(search_results, guessit_query):
     return search_results
 
 
-def query_open_subtitles(movie_filename, language):
-    uri = 'http://api.opensubtitles.org/xml-rpc'
-    server = ServerProxy(uri, verbose=0, allow_none=True, use_datetime=True)
-    login_info = server.LogIn('', '', 'en', 'ss v' + __version__)
-    token = login_info['token']
+OPENSUBTITLES_URI = 'http://api.opensubtitles.org/xml-rpc'
 
-    try:
-        guessit_query = obtain_guessit_query(movie_filename, language)
-        search_queries = [
-            guessit_query,
-            obtain_movie_hash_query(movie_filename, language),
-        ]
 
-        response = server.SearchSubtitles(token, search_queries)
+# default seconds to wait for a connection to be established, and for each
+# read from it
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+
+class TimeoutHTTPConnection(http_client.HTTPConnection):
+    """
+    HTTPConnection with separate timeouts for connecting and for reading: a
+    server which accepts the connection but never answers can't hang a
+    worker forever.
+    """
+
+    def __init__(self, host, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        http_client.HTTPConnection.__init__(self, host,
+                                            timeout=connect_timeout)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        http_client.HTTPConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+
+
+class TimeoutHTTPSConnection(http_client.HTTPSConnection):
+    """
+    HTTPSConnection counterpart of TimeoutHTTPConnection.
+    """
+
+    def __init__(self, host, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        http_client.HTTPSConnection.__init__(self, host,
+                                             timeout=connect_timeout)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        http_client.HTTPSConnection.connect(self)
+        self.sock.settimeout(self.read_timeout)
+
+
+def create_http_connection(scheme, host, connect_timeout=CONNECT_TIMEOUT,
+                           read_timeout=READ_TIMEOUT):
+    connection_class = TimeoutHTTPSConnection if scheme == 'https' \
+        else TimeoutHTTPConnection
+    return connection_class(host, connect_timeout, read_timeout)
+
+
+class TimeoutTransport(Transport):
+    """
+    XML-RPC transport using connect and read timeouts (see
+    TimeoutHTTPConnection), for http and https uris.
+    """
+
+    def __init__(self, scheme='http', connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        Transport.__init__(self, True)  # use_datetime
+        self.scheme = scheme
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def make_connection(self, host):
+        # keep the connection alive between calls, as Transport does
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        self._connection = host, create_http_connection(
+            self.scheme, chost, self.connect_timeout, self.read_timeout)
+        return self._connection[1]
+
+
+class OpenSubtitlesSession(object):
+    """
+    A logged in connection to the OpenSubtitles XML-RPC API.
+
+    Logs in lazily on the first call and keeps the token (and the underlying
+    HTTP connection) for all subsequent calls; the token is renewed when the
+    server reports it as invalid or when it has been idle for longer than the
+    server keeps sessions alive.
+    """
+
+    # OpenSubtitles drops sessions after 15 minutes without activity
+    max_idle_time = 14 * 60
+
+    def __init__(self, uri=None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        uri = uri or OPENSUBTITLES_URI
+        transport = TimeoutTransport(urlsplit(uri).scheme, connect_timeout,
+                                     read_timeout)
+        self.server = ServerProxy(uri, transport=transport, verbose=0,
+                                  allow_none=True, use_datetime=True)
+        self.token = None
+        self.last_used = None
+        self.login_count = 0
+
+    def login(self):
+        login_info = self.server.LogIn('', '', 'en', 'ss v' + __version__)
+        self.token = login_info['token']
+        self.last_used = time.time()
+        self.login_count += 1
+
+    def logout(self):
+        if self.token is not None:
+            token, self.token = self.token, None
+            self.server.LogOut(token)
+
+    def call(self, method_name, *args):
+        """
+        Calls the given XML-RPC method passing the session token as first
+        argument, logging in (again) if needed.
+        """
+        if self.token is None or \
+                time.time() - self.last_used > self.max_idle_time:
+            self.login()
+        response = getattr(self.server, method_name)(self.token, *args)
+        if is_expired_session_response(response):
+            self.login()
+            response = getattr(self.server, method_name)(self.token, *args)
+        self.last_used = time.time()
+        check_server_busy_response(response)
+        return response
+
+    def search_subtitles(self, search_queries):
+        return self.call('SearchSubtitles', search_queries)
+
+
+def is_expired_session_response(response):
+    """
+    Returns True if the response from OpenSubtitles means our token is no
+    longer valid ("401 Unauthorized" or "406 No session").
+    """
+    return response_status(response).startswith(('401', '406'))
+
+
+def response_status(response):
+    return str(response.get('status', '')) if hasattr(response, 'get') else ''
+
+
+class ServerBusyError(IOError):
+    """
+    Raised when OpenSubtitles is throttling us or is temporarily unavailable.
+    """
+
+
+# HTTP (and OpenSubtitles) status codes meaning the server is overloaded
+BUSY_STATUSES = (429, 503)
+
+
+def check_server_busy_response(response):
+    """
+    Raises ServerBusyError if the response from OpenSubtitles has a status
+    meaning it is throttling us ("429 Too many requests").
+    """
+    status = response_status(response)
+    if status.startswith(tuple(str(x) for x in BUSY_STATUSES)):
+        raise ServerBusyError('server is busy: {0}'.format(status))
+
+
+def is_throttling_error(exception):
+    """
+    Returns True if the exception means the server is throttling us or is
+    overloaded, as opposed to an error specific to a request.
+    """
+    if isinstance(exception, (ServerBusyError, socket.timeout)):
+        return True
+    return getattr(exception, 'errcode', None) in BUSY_STATUSES
+
+
+# errors of the connection itself, as opposed to errors of a request
+TRANSIENT_ERRNOS = (errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED,
+                    errno.EPIPE, errno.ETIMEDOUT)
+
+
+def is_transient_error(exception):
+    """
+    Returns True if the request failed because of the network or of a
+    temporary problem in the server, so it might succeed if tried again.
+    """
+    if is_throttling_error(exception):
+        return True
+    if isinstance(exception, (http_client.HTTPException, EOFError)):
+        return True
+    if getattr(exception, 'errno', None) in TRANSIENT_ERRNOS:
+        return True
+    return (getattr(exception, 'errcode', None) or 0) >= 500
+
+
+class SessionPool(object):
+    """
+    Thread-safe pool of OpenSubtitlesSession objects shared by all workers of
+    a run.
+
+    Sessions are created on demand up to ``size`` and handed out one worker
+    at a time, so a run logs in at most once per concurrent worker instead of
+    once per query. Call ``close`` at shutdown to log out all sessions.
+    """
+
+    def __init__(self, size, uri=None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        self._uri = uri
+        self._timeouts = (connect_timeout, read_timeout)
+        self._semaphore = threading.BoundedSemaphore(max(size, 1))
+        self._lock = threading.Lock()
+        self._idle = []
+        self._sessions = []
+
+    @contextmanager
+    def session(self):
+        self._semaphore.acquire()
         try:
-            search_results = response['data']
-        except KeyError:  # noqa
-            raise KeyError('"data" key not found in response: %r' % response)
+            with self._lock:
+                if self._idle:
+                    session = self._idle.pop()
+                else:
+                    session = OpenSubtitlesSession(self._uri, *self._timeouts)
+                    self._sessions.append(session)
+            try:
+                yield session
+            finally:
+                with self._lock:
+                    self._idle.append(session)
+        finally:
+            self._semaphore.release()
+
+    @property
+    def login_count(self):
+        return sum(x.login_count for x in self._sessions)
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions, self._idle = self._sessions, [], []
+        for session in sessions:
+            try:
+                session.logout()
+            except Exception:  # noqa
+                pass  # best effort: the server expires the token anyway
+
+
+# number of queries sent by default in a single SearchSubtitles call: each
+# (movie, language) pair takes two queries (guessit and hash)
+SEARCH_BATCH_SIZE = 20
+
+# OpenSubtitles never returns more results than this in a single call
+SEARCH_RESULTS_LIMIT = 500
+
+# kinds of queries sent for each pair: guessit text query and movie hash
+SEARCH_KINDS = ('text', 'hash')
+
+
+def query_open_subtitles(movie_filename, language, session_pool=None):
+    job = (movie_filename, language)
+    result = query_open_subtitles_batch([job], session_pool)[job]
+    if isinstance(result, Exception):
+        raise result
+    return result
 
-        if search_results:
-            search_results = filter_bad_results(search_results, guessit_query)
 
-        return search_results
-    finally:
-        server.LogOut(token)
+def query_open_subtitles_batch(movie_languages, session_pool=None,
+                               analyzer=None, search_cache=None, hedger=None,
+                               two_phase=False, kinds=SEARCH_KINDS,
+                               controller=None):
+    """
+    Searches subtitles for many (movie_filename, language) pairs using a
+    single SearchSubtitles call.
+
+    With `two_phase`, only the hash queries are sent first, and the text
+    queries (which need the name of the movie parsed by guessit) only for
+    the pairs the hashes didn't find, in a second call.
+
+    :param MovieAnalyzer analyzer: used to obtain the queries for each movie,
+        possibly shared with other batches.
+    :param SearchCache search_cache: if given, pairs with cached results are
+        not sent to the server, and new results are stored in it.
+    :param SearchHedger hedger: if given, used to send the search.
+    :param tuple kinds: of the queries sent, see `build_search_queries`.
+    :param ConcurrencyController controller: if given, each SearchSubtitles
+        call runs in one of its slots.
+    :return: dict mapping each (movie_filename, language) pair to its list of
+        search results, already filtered by `filter_bad_results`, or to the
+        exception raised building its queries (see `build_search_queries`).
+    """
+    if session_pool is None:
+        with closing(SessionPool(1)) as session_pool:
+            return query_open_subtitles_batch(movie_languages, session_pool,
+                                              analyzer, search_cache, hedger,
+                                              two_phase, kinds, controller)
+    if analyzer is None:
+        analyzer = MovieAnalyzer()
+    if two_phase:
+        results = query_open_subtitles_batch(
+            movie_languages, session_pool, analyzer, search_cache, hedger,
+            kinds=('hash',), controller=controller)
+        misses = search_misses(movie_languages, results)
+        if misses:
+            results.update(query_open_subtitles_batch(
+                misses, session_pool, analyzer, search_cache, hedger,
+                kinds=('text',), controller=controller))
+        return results
+
+    search_queries, query_jobs, errors = build_search_queries(
+        movie_languages, analyzer, kinds)
+    results = {}
+    if search_cache is not None:
+        results, search_queries, query_jobs = search_cache.lookup(
+            search_queries, query_jobs)
+    results.update(errors)
+    if not search_queries:
+        return results
+
+    with profiled('search', '%d queries' % len(search_queries)), \
+            controlled(controller):
+        if hedger is not None:
+            response = hedger.search(session_pool, search_queries)
+        else:
+            with session_pool.session() as session:
+                response = session.search_subtitles(search_queries)
+    search_results, missing = parse_search_response(response, search_queries,
+                                                    query_jobs)
+    if search_cache is not None:
+        search_cache.store(search_queries, query_jobs, dict(
+            (job, x) for job, x in search_results.items() if job not in missing))
+    results.update(search_results)
+    for batch in split_in_halves(missing):
+        results.update(query_open_subtitles_batch(batch, session_pool,
+                                                  analyzer, search_cache,
+                                                  hedger, kinds=kinds,
+                                                  controller=controller))
+    return results
+
+
+def build_search_queries(movie_languages, analyzer, kinds=SEARCH_KINDS):
+    """
+    Builds the guessit ('text') and hash ('hash') queries for each
+    (movie_filename, language) pair, of the given kinds.
+
+    A pair whose queries can't be built (for example, the movie is too small
+    to be hashed, or guessit fails to parse its name) is left out, so only
+    that pair fails instead of its whole batch.
+
+    :rtype: tuple(list(dict), list(tuple(str, str)), dict)
+    :return: the queries for SearchSubtitles, the pair of each query, and
+        the exception raised for each pair left out.
+    """
+    search_queries = []
+    query_jobs = []
+    errors = {}
+    for job in movie_languages:
+        movie_filename, language = job
+        queries = []
+        try:
+            if 'text' in kinds:
+                queries.append(analyzer.guessit_query(movie_filename,
+                                                      language))
+            if 'hash' in kinds:
+                queries.append(analyzer.movie_hash_query(movie_filename,
+                                                         language))
+        except Exception as e:
+            errors[job] = e
+        else:
+            search_queries.extend(queries)
+            query_jobs.extend([job] * len(queries))
+    return search_queries, query_jobs, errors
+
 
+def search_misses(movie_languages, results):
+    """
+    Returns the pairs of a search by hash to search again by name: the ones
+    not found, and the ones whose hash couldn't be calculated.
+    """
+    return [job for job in movie_languages
+            if not results.get(job) or isinstance(results[job], Exception)]
+
+
+def parse_search_response(response, search_queries, query_jobs):
+    """
+    Splits the response of a batched SearchSubtitles call into the results
+    of each (movie_filename, language) pair, filtered by
+    `filter_bad_results`.
 
-def find_subtitle(movie_filename, language):
-    search_results = query_open_subtitles(movie_filename, language)
+    :rtype: tuple(dict, list)
+    :return: the results of each pair, and the pairs that should be searched
+        again because the server truncated the results of the batch.
+    """
+    try:
+        search_results = response['data']
+    except KeyError:  # noqa
+        raise KeyError('"data" key not found in response: %r' % response)
+
+    results = split_search_results(search_results or [], search_queries,
+                                   query_jobs)
+    guessit_queries = dict((job, query)
+                           for query, job in zip(search_queries, query_jobs)
+                           if 'moviehash' not in query)
+    for job, job_results in results.items():
+        # hash matches are exact, so without a text query there is nothing
+        # to filter by
+        if job_results and job in guessit_queries:
+            results[job] = filter_bad_results(job_results, guessit_queries[job])
+
+    # the server silently truncates the results of large batches: the pairs
+    # left without results should be searched again, in smaller batches
+    missing = []
+    if search_results and len(search_results) >= SEARCH_RESULTS_LIMIT and \
+            len(results) > 1:
+        missing = [job for job in results if not results[job]]
+    return results, sorted(missing)
+
+
+def split_in_halves(items):
+    """
+    Returns the non-empty halves of the given list.
+    """
+    half = max(len(items) // 2, 1)
+    return [x for x in (items[:half], items[half:]) if x]
+
+
+def plan_search_batches(movie_languages, batch_size=SEARCH_BATCH_SIZE,
+                        queries_per_pair=len(SEARCH_KINDS)):
+    """
+    Packs (movie_filename, language) pairs into the fewest SearchSubtitles
+    calls possible, each one sending at most `batch_size` queries.
+
+    :rtype: list(list(tuple(str, str)))
+    """
+    jobs_per_batch = max(batch_size // queries_per_pair, 1)
+    movie_languages = sorted(movie_languages)
+    return [movie_languages[i:i + jobs_per_batch]
+            for i in range(0, len(movie_languages), jobs_per_batch)]
+
+
+def split_search_results(search_results, search_queries, query_jobs):
+    """
+    Splits the results of a batched SearchSubtitles call back into the
+    (movie_filename, language) pair each one belongs to, keeping the order
+    returned by the server.
+
+    Results are matched by "QueryNumber" when the server reports it,
+    otherwise by "MovieHash" and "SubLanguageID" of the hash queries; text
+    query results are then matched by the "IDMovieImdb" learned from the
+    hash matches, or by "SubLanguageID" if only one pair in the batch
+    searched for that language.
+
+    :param list search_results: "data" list returned by SearchSubtitles.
+    :param list search_queries: queries sent to SearchSubtitles.
+    :param list query_jobs: the (movie_filename, language) pair of each query.
+    :rtype: dict
+    """
+    jobs = []
+    for job in query_jobs:
+        if job not in jobs:
+            jobs.append(job)
+
+    jobs_by_hash = {}
+    for query, job in zip(search_queries, query_jobs):
+        if 'moviehash' in query:
+            jobs_by_hash[(query['moviehash'], query['sublanguageid'])] = job
+
+    def exact_match(result):
+        query_number = result.get('QueryNumber')
+        if query_number is not None and \
+                0 <= int(query_number) < len(query_jobs):
+            return query_jobs[int(query_number)]
+        key = (result.get('MovieHash'), result.get('SubLanguageID'))
+        return jobs_by_hash.get(key)
+
+    matched = [exact_match(x) for x in search_results]
+
+    jobs_by_imdb = {}
+    for result, job in zip(search_results, matched):
+        if job is not None and result.get('IDMovieImdb'):
+            jobs_by_imdb[(result['IDMovieImdb'], job[1])] = job
+
+    split = dict((job, []) for job in jobs)
+    for result, job in zip(search_results, matched):
+        language = result.get('SubLanguageID')
+        if job is None:
+            job = jobs_by_imdb.get((result.get('IDMovieImdb'), language))
+        if job is None:
+            candidates = [x for x in jobs if language is None or
+                          x[1] == language]
+            if len(candidates) == 1:
+                job = candidates[0]
+        if job is not None:
+            split[job].append(result)
+    return split
+
+
+def select_subtitle(search_results):
+    """
+    Returns the (download url, extension) of the best search result, or
+    (None, None) if there are no results.
+    """
     if search_results:
         search_result = search_results[0]
         return search_result['SubDownloadLink'], '.' + search_result['SubFormat']
@@ -113,6 +790,12 @@ def find_subtitle(movie_filename, language):
         return None, None
 
 
+def find_subtitle(movie_filename, language, session_pool=None):
+    search_results = query_open_subtitles(movie_filename, language,
+                                          session_pool)
+    return select_subtitle(search_results)
+
+
 def obtain_subtitle_filename(movie_filename, language, subtitle_ext, multi):
     # possibilities where we don't override
     if multi:
@@ -122,55 +805,612 @@ def obtain_subtitle_filename(movie_filename, language, subtitle_ext, multi):
     return os.path.splitext(movie_filename)[0] + new_ext
 
 
-def download_subtitle(subtitle_url, subtitle_filename):
-    # first download it and save to a temp dir
-    with closing(urlopen(subtitle_url)) as urlfile:
-        gzip_subtitle_contents = urlfile.read()
+def find_subtitle_filename(movie_filename, language, multi):
+    """
+    Returns the subtitle of the language downloaded before for the movie (see
+    `obtain_subtitle_filename`), or None if there is none.
+    """
+    for subtitle_ext in SUBTITLE_EXTENSIONS:
+        subtitle_filename = obtain_subtitle_filename(movie_filename, language,
+                                                     subtitle_ext, multi)
+        if os.path.isfile(subtitle_filename):
+            return subtitle_filename
+    return None
+
+
+class HTTPConnectionPool(object):
+    """
+    Bounded pool of persistent (keep-alive) HTTP connections shared by the
+    download workers, keyed by scheme and host.
+
+    At most ``max_per_host`` connections to the same host are in use at any
+    time; idle connections are reused for the next request to the same host
+    unless they have been idle for more than ``idle_timeout`` seconds.
+    ``requests`` and ``reused`` count the requests made and how many of them
+    reused an existing connection.
+    """
+
+    redirect_statuses = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_per_host=4, idle_timeout=30,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.requests = 0
+        self.reused = 0
+        self._idle = {}  # (scheme, host) -> list of (connection, last used)
+        self._semaphores = {}  # (scheme, host) -> semaphore
+        self._lock = threading.Lock()
+
+    @property
+    def reuse_rate(self):
+        return self.reused / self.requests if self.requests else 0.0
+
+    def urlopen(self, url, max_redirects=5):
+        """
+        Sends a GET request for the given url, following redirects.
+
+        :return: file-like object with the response body; ``close()`` it to
+            give the connection back to the pool.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        headers = {'User-Agent': 'ss v' + __version__}
+
+        with self._lock:
+            semaphore = self._semaphores.setdefault(
+                key, threading.BoundedSemaphore(self.max_per_host))
+        semaphore.acquire()
+        try:
+            while True:
+                connection, reused = self._checkout(key)
+                try:
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                except (http_client.HTTPException, socket.error):
+                    connection.close()
+                    if reused:
+                        continue  # the server closed the idle connection
+                    raise
+                break
+        except:  # noqa
+            semaphore.release()
+            raise
+
+        with self._lock:
+            self.requests += 1
+            self.reused += reused
+        pooled_response = _PooledResponse(self, key, connection, response)
+
+        if response.status in self.redirect_statuses and max_redirects > 0:
+            location = response.getheader('Location')
+            pooled_response.read()
+            pooled_response.close()
+            return self.urlopen(urljoin(url, location), max_redirects - 1)
+        elif response.status != 200:
+            pooled_response.read()
+            pooled_response.close()
+            error_class = ServerBusyError \
+                if response.status in BUSY_STATUSES else IOError
+            error = error_class('HTTP error {0} ({1}) for {2}'.format(
+                response.status, response.reason, url))
+            error.errcode = response.status
+            raise error
+        return pooled_response
+
+    def _checkout(self, key):
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                connection, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return connection, True
+                connection.close()
+        scheme, host = key
+        return create_http_connection(scheme, host, self.connect_timeout,
+                                      self.read_timeout), False
+
+    def _checkin(self, key, connection, response):
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault(key, []).append((connection, time.time()))
+        else:
+            connection.close()
+        self._semaphores[key].release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection, _ in connections:
+                connection.close()
+
 
-    tempdir = tempfile.mkdtemp()
+class _PooledResponse(object):
+    """
+    Response returned by `HTTPConnectionPool.urlopen`.
+    """
+
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def read(self, *args):
+        return self._response.read(*args)
+
+    def close(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            self._pool._checkin(self._key, connection, self._response)
+
+
+# size of the chunks read from the network when downloading subtitles
+DOWNLOAD_CHUNK_SIZE = 16 * 1024
+
+
+def urlopen(url, timeout=READ_TIMEOUT):
+    if sys.version_info[0] == 3:  # pragma: no cover
+        from urllib.request import urlopen
+    else:  # pragma: no cover
+        from urllib2 import urlopen
+    return urlopen(url, timeout=timeout)
+
+
+def download_subtitle(subtitle_url, subtitle_filename, http_pool=None,
+                      timeout=READ_TIMEOUT):
+    """
+    Downloads the gzipped subtitle from the given url, decompressing it while
+    it is read from the network into a temporary file next to
+    `subtitle_filename`, which is then atomically renamed over it.
+
+    :param HTTPConnectionPool http_pool: if given, the subtitle is downloaded
+        using one of its persistent connections.
+    :param float timeout: seconds to wait for the server when `http_pool` is
+        not given (the pool has its own timeouts).
+    """
+    if http_pool is None:
+        opener = lambda url: urlopen(url, timeout=timeout)
+    else:
+        opener = http_pool.urlopen
+    with profiled('download', subtitle_filename):
+        with closing(opener(subtitle_url)) as urlfile:
+            save_gzipped_subtitle(urlfile, subtitle_filename)
+
+
+def save_gzipped_subtitle(source, subtitle_filename):
+    """
+    Decompresses the gzipped subtitle read from the `source` file-like object
+    into a temporary file next to `subtitle_filename`, atomically renaming it
+    over `subtitle_filename` once complete.
+    """
+    temp_filename = '{0}.{1}.part'.format(subtitle_filename,
+                                          uuid.uuid4().hex[:8])
+    fd = os.open(temp_filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
     try:
-        basename = subtitle_url.split('/')[-1]
-        tempfilename = os.path.join(tempdir, basename)
-        with open(tempfilename, 'wb') as f:
-            f.write(gzip_subtitle_contents)
+        with os.fdopen(fd, 'wb') as f:
+            decompress_gzip_stream(source, f)
+        replace_file(temp_filename, subtitle_filename)
+    except:  # noqa
+        os.remove(temp_filename)
+        raise
 
-        with closing(gzip.GzipFile(tempfilename, 'rb')) as f:
-            subtitle_contents = f.read()
 
-        # copy it over the new filename
-        with open(subtitle_filename, 'wb') as f:
-            f.write(subtitle_contents)
-    finally:
-        shutil.rmtree(tempdir)
+def decompress_gzip_stream(source, target):
+    """
+    Decompresses gzip data read from the `source` file-like object in chunks,
+    writing the decompressed data to `target`.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+    while chunk:
+        target.write(decompressor.decompress(chunk))
+        # gzip files might have multiple members, or be padded with zeros
+        chunk = decompressor.unused_data.lstrip(b'\x00')
+        if chunk:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+    target.write(decompressor.flush())
+    if not getattr(decompressor, 'eof', True):
+        raise IOError('gzip data is truncated')
+
+
+def replace_file(src, dst):
+    """
+    Renames `src` to `dst`, overwriting it atomically when the platform
+    supports it.
+    """
+    getattr(os, 'replace', os.rename)(src, dst)
+
+
+MOVIE_EXTENSIONS = set(['.avi', '.mp4', '.mpg', '.mkv'])
 
 
-def find_movie_files(input_names, recursive=False):
-    extensions = set(['.avi', '.mp4', '.mpg', '.mkv'])
+def find_movie_files(input_names, recursive=False, max_workers=4,
+                     listings=None):
+    """
+    Yields the movie files among the given input names, listing the contents
+    of directories (and of their sub-directories, if `recursive`).
+
+    Sub-directories are listed concurrently by up to `max_workers` threads
+    and movies are yielded as soon as their directory is listed, so callers
+    can start working before the walk finishes. Directories are visited only
+    once by real path, so symlink loops are not followed forever.
+
+    :param dict listings: if given, filled with the names of the entries of
+        each directory listed, so they can be reused by `SubtitleIndex`.
+    """
     returned = set()
+    visited = set()
+
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        future_to_dirname = {}
+
+        def visit(dirname):
+            real_dirname = os.path.realpath(dirname)
+            if real_dirname not in visited:
+                visited.add(real_dirname)
+                future = executor.submit(list_movie_directory, dirname,
+                                         recursive)
+                future_to_dirname[future] = dirname
+                pending.add(future)
+
+        for input_name in input_names:
+            if os.path.isfile(input_name):
+                if input_name not in returned:
+                    yield input_name
+                    returned.add(input_name)
+            else:
+                visit(input_name)
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                movies, sub_dirs, names = future.result()
+                if listings is not None:
+                    listings[future_to_dirname[future]] = names
+                for movie_filename in movies:
+                    if movie_filename not in returned:
+                        yield movie_filename
+                        returned.add(movie_filename)
+                for sub_dir in sub_dirs:
+                    visit(sub_dir)
+
+
+def list_movie_directory(dirname, recursive):
+    """
+    Lists a single directory, using the file type cached by `os.scandir`
+    where available instead of a `stat` call per entry.
 
-    for input_name in input_names:
+    :rtype: tuple(list(str), list(str), list(str))
+    :return: the movies in the directory, its sub-directories (only if
+        `recursive`) and the names of all its entries.
+    """
+    movies = []
+    sub_dirs = []
+    names = []
+    with profiled('walk', dirname):
+        for name, is_dir in iter_directory(dirname):
+            names.append(name)
+            result = os.path.join(dirname, name)
+            if name[-4:] in MOVIE_EXTENSIONS:
+                movies.append(result)
+            elif recursive and is_dir():
+                sub_dirs.append(result)
+    return movies, sub_dirs, names
+
+
+def iter_directory(dirname):
+    """
+    Yields (name, is_dir) for each entry in the directory, where `is_dir` is
+    a callable returning if the entry is a directory (following symlinks).
+    """
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(dirname):
+            yield entry.name, entry.is_dir
+    else:  # pragma: no cover
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            yield name, lambda path=path: os.path.isdir(path)
+
+
+# seconds without changes before a new movie is searched in --watch mode
+WATCH_DELAY = 5
+
+# seconds without changes after which a movie never closed by its writer is
+# forgotten in --watch mode
+WATCH_EXPIRE = 60 * 60
+
+# seconds between listings of the directories when inotify is not available
+WATCH_POLL_INTERVAL = 2
+
+
+class Debouncer(object):
+    """
+    Collects the paths changed in the directories watched, returning each
+    one only once it is complete (closed after writing, or moved in) and no
+    change was seen for `delay` seconds, so movies still being copied or
+    downloaded are not picked up half written.
+
+    Paths which are not complete are forgotten once they are removed, or
+    after `expire` seconds without changes (their writer died), so they
+    don't pile up while watching for a long time.
+    """
+
+    def __init__(self, delay, expire=WATCH_EXPIRE):
+        self.delay = delay
+        self.expire = expire
+        self._changed = {}  # path -> (time of the last change, complete)
+
+    def touch(self, path, complete, now=None):
+        self._changed[path] = (time.time() if now is None else now, complete)
+
+    def ready(self, now=None):
+        now = time.time() if now is None else now
+        result = []
+        for path, (changed, complete) in list(self._changed.items()):
+            if now - changed < self.delay:
+                continue
+            if complete:
+                result.append(path)
+            elif now - changed < self.expire and os.path.exists(path):
+                continue
+            del self._changed[path]
+        return sorted(result)
+
+    def timeout(self, now=None):
+        """
+        Returns the seconds until the next path may be ready, or None if no
+        path is complete.
+        """
+        now = time.time() if now is None else now
+        changes = [changed for changed, complete in self._changed.values()
+                   if complete]
+        if not changes:
+            return None
+        return max(0, min(changes) + self.delay - now)
+
+
+class InotifyWatcher(object):
+    """
+    Reports the files created, written or moved into directories (and into
+    their sub-directories, if `recursive`) using Linux's inotify through
+    ctypes. Directories are watched only once by real path, so symlink loops
+    are not followed forever.
+    """
+
+    method = 'inotify'
+
+    IN_MODIFY = 0x2
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    _event = struct.Struct('iIII')  # wd, mask, cookie, length of the name
+
+    def __init__(self, dirnames, recursive=False):
+        import ctypes
+        import ctypes.util
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self._recursive = recursive
+        self._dirnames = {}  # watch descriptor -> directory
+        self._watched = {}  # real path of the directory -> watch descriptor
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise self._error('inotify_init')
+        try:
+            for dirname in dirnames:
+                self._add(dirname)
+        except Exception:
+            self.close()
+            raise
+
+    def _error(self, name):
+        code = self._ctypes.get_errno()
+        return OSError(code, '{0}: {1}'.format(name, os.strerror(code)))
+
+    def _add(self, dirname):
+        real_dirname = os.path.realpath(dirname)
+        if real_dirname in self._watched:
+            return
+        mask = (self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO |
+                self.IN_CREATE)
+        encoded = dirname
+        if not isinstance(encoded, bytes):
+            encoded = encoded.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self._fd, encoded, mask)
+        if wd < 0:
+            raise self._error(dirname)
+        self._dirnames[wd] = dirname
+        self._watched[real_dirname] = wd
+        if self._recursive:
+            for name, is_dir in iter_directory(dirname):
+                try:
+                    if not is_dir():
+                        continue
+                except OSError:
+                    continue  # a symlink loop or already gone
+                self._add(os.path.join(dirname, name))
+
+    def _add_new_directory(self, dirname):
+        """
+        Watches a directory created or moved into one watched, returning its
+        files as changes, since they may have been written before it was
+        watched.
+        """
+        try:
+            self._add(dirname)
+        except OSError:
+            return []  # already gone
+        return [(os.path.join(root, name), True)
+                for root, _, names in os.walk(dirname) for name in names]
+
+    def read(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (forever if None) for changes.
+
+        :rtype: list(tuple(str, bool))
+        :return: the paths changed and if they were complete.
+        """
+        import select
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self._fd, 64 * 1024)
+        changes = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_IGNORED:
+                self._dirnames.pop(wd, None)
+                for real_dirname in [x for x, y in self._watched.items()
+                                     if y == wd]:
+                    del self._watched[real_dirname]
+                continue
+            # events for unknown descriptors include the queue overflowing:
+            # the files whose events were dropped are not searched
+            dirname = self._dirnames.get(wd)
+            if dirname is None or not name:
+                continue
+            if not isinstance(dirname, bytes):
+                name = name.decode(sys.getfilesystemencoding())
+            path = os.path.join(dirname, name)
+            created = mask & (self.IN_CREATE | self.IN_MOVED_TO)
+            if not mask & self.IN_ISDIR:
+                complete = mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+                changes.append((path, bool(complete)))
+            elif self._recursive and created:
+                changes.extend(self._add_new_directory(path))
+        return changes
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+class PollingWatcher(object):
+    """
+    Fallback of InotifyWatcher where inotify is not available: lists the
+    directories every `interval` seconds, reporting the files that appeared
+    or changed size or modification time since the previous listing.
+    Directories are listed only once by real path, as in InotifyWatcher.
+    """
+
+    def __init__(self, dirnames, recursive=False,
+                 interval=WATCH_POLL_INTERVAL):
+        self.method = 'polling every {0}s'.format(interval)
+        self._dirnames = list(dirnames)
+        self._recursive = recursive
+        self._interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        """
+        :return: dict of path -> (size, modification time) of the files.
+        """
+        result = {}
+        visited = set()
+        pending = list(self._dirnames)
+        while pending:
+            dirname = pending.pop()
+            real_dirname = os.path.realpath(dirname)
+            if real_dirname in visited:
+                continue
+            visited.add(real_dirname)
+            try:
+                entries = list(iter_directory(dirname))
+            except OSError:
+                continue
+            for name, is_dir in entries:
+                path = os.path.join(dirname, name)
+                try:
+                    if is_dir():
+                        if self._recursive:
+                            pending.append(path)
+                        continue
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                result[path] = (st.st_size, st.st_mtime)
+        return result
+
+    def read(self, timeout=None):
+        """
+        Same as `InotifyWatcher.read`, waiting at most `interval` seconds.
+        """
+        if timeout is None or timeout > self._interval:
+            timeout = self._interval
+        time.sleep(timeout)
+        snapshot = self._scan()
+        changes = sorted((path, True) for path, stat in snapshot.items()
+                         if self._snapshot.get(path) != stat)
+        self._snapshot = snapshot
+        return changes
+
+    def close(self):
+        pass
+
+
+def create_watcher(dirnames, recursive=False):
+    """
+    Returns an InotifyWatcher for the given directories, or a
+    PollingWatcher where inotify is not available (or out of watches).
+    """
+    try:
+        return InotifyWatcher(dirnames, recursive)
+    except (OSError, AttributeError, TypeError):
+        return PollingWatcher(dirnames, recursive)
+
+
+def watch_movies(watcher, delay, ignored=None):
+    """
+    Yields lists of the movie files created in the directories watched,
+    once they settle for `delay` seconds (see `Debouncer`), forever.
+
+    :param set ignored: paths written by ss itself, like the mkv files it
+        creates, skipped (and removed from the set) once they settle.
+    """
+    debouncer = Debouncer(delay)
+    while True:
+        for path, complete in watcher.read(debouncer.timeout()):
+            name = os.path.basename(path)
+            if name[-4:] in MOVIE_EXTENSIONS and not name.startswith('.'):
+                debouncer.touch(path, complete)
+        movies = []
+        for path in debouncer.ready():
+            if ignored is not None and path in ignored:
+                ignored.discard(path)
+            elif os.path.isfile(path):
+                movies.append(path)
+        if movies:
+            yield movies
 
-        if os.path.isfile(input_name) and input_name not in returned:
-            yield input_name
-            returned.add(input_name)
-        else:
-            names = os.listdir(input_name)
-            for name in names:
-                result = os.path.join(input_name, name)
-                if name[-4:] in extensions:
-                    if result not in returned:
-                        yield result
-                        returned.add(result)
 
-                elif os.path.isdir(result) and recursive:
-                    for x in find_movie_files([result], recursive):
-                        yield x
+# list of subtitle formats obtained from opensubtitles' advanced search page.
+SUBTITLE_EXTENSIONS = ['.sub', '.srt', '.ssa', '.smi', '.mpl']
+
+# tags found around the language in subtitle names, like "movie.eng.forced.srt"
+SUBTITLE_TAGS = frozenset(['forced', 'hi', 'sdh', 'cc', 'default', 'full'])
 
 
 def has_subtitle(filename, language, multi):
-    # list of subtitle formats obtained from opensubtitles' advanced search page.
-    formats = ['.sub', '.srt', '.ssa', '.smi', '.mpl']
-    for ext in formats:
+    for ext in SUBTITLE_EXTENSIONS:
         subtitle_filename = obtain_subtitle_filename(filename, language, ext,
                                                      multi)
         if os.path.isfile(subtitle_filename):
@@ -179,19 +1419,97 @@ def has_subtitle(filename, language, multi):
     return False
 
 
-def search_and_download(movie_filename, language, multi):
-    subtitle_url, subtitle_ext = find_subtitle(movie_filename, language=language)
+class SubtitleIndex(object):
+    """
+    Index of the subtitles that already exist next to movies, built from a
+    single listing of each directory, so `has_subtitle` checks become
+    dictionary lookups instead of a stat per candidate name.
+
+    Names are matched ignoring case, and subtitles with extra tags (see
+    SUBTITLE_TAGS) around the language (for example "movie.eng.forced.srt"
+    or "movie.HI.eng.srt") also count as subtitles for that language; any
+    other part makes it the subtitle of another movie, so
+    "Alien.Resurrection.eng.srt" doesn't count for "Alien.avi".
+    """
+
+    def __init__(self, listings=None):
+        """
+        :param dict listings: directory -> names of its entries, as filled by
+            `find_movie_files`; directories not found there are listed when
+            first needed.
+        """
+        self._listings = dict((self._key(k), v)
+                              for k, v in (listings or {}).items())
+        self._directories = {}
+
+    @staticmethod
+    def _key(dirname):
+        return os.path.normcase(os.path.abspath(dirname))
+
+    def _directory_index(self, dirname):
+        """
+        Returns a dict mapping each possible movie name (lower case, without
+        extension) to the tags of the subtitles that follow it.
+        """
+        key = self._key(dirname)
+        index = self._directories.get(key)
+        if index is None:
+            names = self._listings.get(key)
+            if names is None:
+                try:
+                    names = os.listdir(dirname or os.curdir)
+                except OSError:
+                    names = []
+            index = {}
+            for name in names:
+                base, ext = os.path.splitext(name.lower())
+                if ext not in SUBTITLE_EXTENSIONS:
+                    continue
+                # the movie name itself might have dots, so index the
+                # subtitle under every possible movie name
+                parts = base.split('.')
+                for i in range(1, len(parts) + 1):
+                    index.setdefault('.'.join(parts[:i]), []).append(
+                        frozenset(parts[i:]))
+            self._directories[key] = index
+        return index
+
+    def has_subtitle(self, movie_filename, language, multi):
+        dirname, basename = os.path.split(movie_filename)
+        movie_name = os.path.splitext(basename)[0].lower()
+        language = language.lower()
+        for tags in self._directory_index(dirname).get(movie_name, ()):
+            if not tags:
+                if not multi:
+                    return True
+            elif language in tags and tags - SUBTITLE_TAGS <= {language}:
+                return True
+        return False
+
+
+def search_and_download(movie_filename, language, multi, session_pool=None):
+    subtitle_url, subtitle_ext = find_subtitle(movie_filename, language=language,
+                                               session_pool=session_pool)
     if subtitle_url:
-        subtitle_filename = obtain_subtitle_filename(movie_filename,
-                                                     language,
-                                                     subtitle_ext,
-                                                     multi=multi)
-        download_subtitle(subtitle_url, subtitle_filename)
-        return subtitle_filename
+        return download_movie_subtitle(movie_filename, language, subtitle_url,
+                                       subtitle_ext, multi=multi)
     else:
         return None
 
 
+def download_movie_subtitle(movie_filename, language, subtitle_url,
+                            subtitle_ext, multi, http_pool=None):
+    """
+    Downloads the subtitle next to the movie, returning its filename.
+    """
+    subtitle_filename = obtain_subtitle_filename(movie_filename,
+                                                 language,
+                                                 subtitle_ext,
+                                                 multi=multi)
+    download_subtitle(subtitle_url, subtitle_filename, http_pool)
+    return subtitle_filename
+
+
 def load_configuration(filename):
     p = RawConfigParser()
     p.add_section('ss')
@@ -206,7 +1524,32 @@ def load_configuration(filename):
     read_if_defined('recursive', 'getboolean')
     read_if_defined('skip', 'getboolean')
     read_if_defined('mkv', 'getboolean')
+    read_if_defined('mkv_in_place', 'getboolean')
     read_if_defined('parallel_jobs', 'getint')
+    read_if_defined('search_batch_size', 'getint')
+    read_if_defined('two_phase_search', 'getboolean')
+    read_if_defined('cache_dir', 'get')
+    read_if_defined('http_max_connections', 'getint')
+    read_if_defined('http_idle_timeout', 'getfloat')
+    read_if_defined('engine', 'get')
+    read_if_defined('async_max_requests', 'getint')
+    read_if_defined('search_jobs', 'getint')
+    read_if_defined('download_jobs', 'getint')
+    read_if_defined('mkv_jobs', 'getint')
+    read_if_defined('mkv_jobs_per_device', 'getint')
+    read_if_defined('search_cache_ttl', 'getfloat')
+    read_if_defined('search_cache_negative_ttl', 'getfloat')
+    read_if_defined('adaptive_concurrency', 'getboolean')
+    read_if_defined('retry_attempts', 'getint')
+    read_if_defined('circuit_breaker_failures', 'getint')
+    read_if_defined('circuit_breaker_timeout', 'getfloat')
+    read_if_defined('connect_timeout', 'getfloat')
+    read_if_defined('read_timeout', 'getfloat')
+    read_if_defined('deadline', 'getfloat')
+    read_if_defined('hedge_percentile', 'getfloat')
+    read_if_defined('hedge_max_rate', 'getfloat')
+    read_if_defined('guessit_processes', 'getint')
+    read_if_defined('watch_delay', 'getfloat')
 
     if p.has_option('ss', 'languages'):
         value = p.get('ss', 'languages')
@@ -215,6 +1558,10 @@ def load_configuration(filename):
     return config
 
 
+# number of bytes hashed at the start and at the end of each movie
+HASH_BLOCK_SIZE = 65536
+
+
 def calculate_hash_for_file(name):
     '''
     Calculates the hash for the given filename.
@@ -227,49 +1574,491 @@ def calculate_hash_for_file(name):
     @return: str
         The calculated hash code, as an hex string.
     '''
-    longlongformat = 'q'  # long long
-    bytesize = struct.calcsize(longlongformat)
-
-    f = open(name, "rb")
-
     filesize = os.path.getsize(name)
-    hash = filesize
 
-    minimum_size = 65536 * 2
+    minimum_size = HASH_BLOCK_SIZE * 2
     assert filesize >= minimum_size, \
         'Movie {name} must have at least {min} bytes'.format(min=minimum_size,
                                                              name=name)
 
-    for x in range(65536//bytesize):
-        buffer = f.read(bytesize)
-        (l_value,)= struct.unpack(longlongformat, buffer)
-        hash += l_value
-        hash = hash & 0xFFFFFFFFFFFFFFFF #to remain as 64bit number
-
-
-    f.seek(max(0,filesize-65536),0)
-    for x in range(65536//bytesize):
-        buffer = f.read(bytesize)
-        (l_value,)= struct.unpack(longlongformat, buffer)
-        hash += l_value
-        hash = hash & 0xFFFFFFFFFFFFFFFF
+    with profiled('hash', name):
+        with open(name, 'rb') as f:
+            head = f.read(HASH_BLOCK_SIZE)
+            f.seek(filesize - HASH_BLOCK_SIZE, 0)
+            tail = f.read(HASH_BLOCK_SIZE)
 
-    f.close()
+        hash = filesize + sum_64bit_words(head) + sum_64bit_words(tail)
+    hash = hash & 0xFFFFFFFFFFFFFFFF  # to remain as 64bit number
     returnedhash = "%016x" % hash
     return returnedhash
 
 
+def sum_64bit_words(block):
+    '''
+    Sums all little-endian 64 bit words of the given block in one go, using
+    NumPy when it is available, wrapping around at 64 bits.
+
+    @param block: bytes
+        Data to sum; its length must be a multiple of 8.
+
+    @return: int
+    '''
+    numpy = _import_numpy()
+    if numpy is not None:
+        return _sum_64bit_words_numpy(numpy, block)
+    else:
+        return _sum_64bit_words_struct(block)
+
+
+def _sum_64bit_words_numpy(numpy, block):
+    words = numpy.frombuffer(block, dtype='<u8')
+    return int(words.sum(dtype=numpy.uint64))
+
+
+def _sum_64bit_words_struct(block):
+    words = struct.unpack('<%dQ' % (len(block) // 8), block)
+    return sum(words) & 0xFFFFFFFFFFFFFFFF
+
+
+_numpy = []
+
+
+def _import_numpy():
+    '''
+    Returns the numpy module, or None if it is not installed; imported only
+    once, on first use.
+    '''
+    if not _numpy:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy.append(numpy)
+    return _numpy[0]
+
+
+def default_cache_dir():
+    """
+    Returns the directory where ss keeps its caches: ``$XDG_CACHE_HOME/ss``,
+    defaulting to ``~/.cache/ss``.
+    """
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'ss')
+
+
+class SQLiteCache(object):
+    """
+    Base class for caches stored in a SQLite database shared by all threads;
+    the database is only created when first used.
+
+    Subclasses define ``schema``, the statement creating their table.
+    """
+
+    schema = None
+
+    def __init__(self, filename):
+        """
+        :param str filename: path to the SQLite database.
+        """
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            import sqlite3
+            dirname = os.path.dirname(self.filename)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self._connection = sqlite3.connect(self.filename,
+                                               check_same_thread=False)
+            self._connection.execute(self.schema)
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class HashCache(SQLiteCache):
+    """
+    Persistent cache of movie hashes.
+
+    Entries are keyed by the device and inode of each movie and are only
+    valid while its size and modification time stay the same, so movies are
+    hashed again automatically when they change.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS hashes ('
+              'device INTEGER, inode INTEGER, size INTEGER, '
+              'mtime_ns INTEGER, path TEXT, hash TEXT, '
+              'PRIMARY KEY (device, inode))')
+
+    def __init__(self, filename, rehash=False):
+        """
+        :param str filename: path to the SQLite database.
+        :param bool rehash: if True, always calculate hashes again (updating
+            the cache) instead of using cached values.
+        """
+        SQLiteCache.__init__(self, filename)
+        self.rehash = rehash
+
+    def get_hash(self, movie_filename):
+        """
+        Returns the hash of the given movie, calculating it only if the movie
+        is not in the cache or has changed since it was cached.
+        """
+        stat = os.stat(movie_filename)
+        mtime_ns = getattr(stat, 'st_mtime_ns', None)
+        if mtime_ns is None:  # pragma: no cover
+            mtime_ns = int(stat.st_mtime * 1e9)
+        key = (stat.st_dev, stat.st_ino)
+
+        if not self.rehash:
+            with self._lock:
+                row = self._connect().execute(
+                    'SELECT size, mtime_ns, hash FROM hashes '
+                    'WHERE device = ? AND inode = ?', key).fetchone()
+            if row is not None and tuple(row[:2]) == (stat.st_size, mtime_ns):
+                self.hits += 1
+                return row[2]
+
+        self.misses += 1
+        moviehash = calculate_hash_for_file(movie_filename)
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)',
+                key + (stat.st_size, mtime_ns,
+                       os.path.abspath(movie_filename), moviehash))
+            connection.commit()
+        return moviehash
+
+
+class GuessitCache(SQLiteCache):
+    """
+    Persistent cache of guessit guesses (see `guess_movie`), keyed by the
+    basename of each movie and the version of guessit, so names are parsed
+    again after guessit is upgraded.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS guesses ('
+              'basename TEXT, version TEXT, guess TEXT, '
+              'PRIMARY KEY (basename, version))')
+
+    def __init__(self, filename, version=None):
+        """
+        :param str filename: path to the SQLite database.
+        :param str version: of guessit; by default, the one installed.
+        """
+        SQLiteCache.__init__(self, filename)
+        self._version = version
+
+    @property
+    def version(self):
+        if self._version is None:
+            self._version = guessit_version()
+        return self._version
+
+    def lookup(self, basenames):
+        """
+        :rtype: dict(str, dict)
+        :return: the cached guesses of the given names.
+        """
+        result = {}
+        with self._lock:
+            connection = self._connect()
+            for basename in basenames:
+                row = connection.execute(
+                    'SELECT guess FROM guesses '
+                    'WHERE basename = ? AND version = ?',
+                    (basename, self.version)).fetchone()
+                if row is not None:
+                    result[basename] = json.loads(row[0])
+        self.hits += len(result)
+        self.misses += len(basenames) - len(result)
+        return result
+
+    def store(self, guesses):
+        """
+        :param dict(str, dict) guesses: guess of each basename.
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.executemany(
+                'INSERT OR REPLACE INTO guesses VALUES (?, ?, ?)',
+                [(basename, self.version, json.dumps(guess, sort_keys=True))
+                 for basename, guess in guesses.items()])
+            connection.commit()
+
+
+class SearchCache(SQLiteCache):
+    """
+    Persistent cache of the search results of each (movie, language) pair,
+    keyed by the movie hash and size, the language and the guessit query.
+
+    Results are reused for ``ttl`` seconds. Searches that found nothing are
+    cached for ``negative_ttl`` seconds, doubling each time the search comes
+    back empty again (up to ``ttl``), so movies without subtitles are
+    searched less and less often.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS searches ('
+              'key TEXT PRIMARY KEY, results TEXT, misses INTEGER, '
+              'expires REAL)')
+
+    def __init__(self, filename, ttl=24 * 60 * 60, negative_ttl=60 * 60,
+                 refresh=False):
+        """
+        :param str filename: path to the SQLite database.
+        :param float ttl: seconds to reuse search results.
+        :param float negative_ttl: seconds to reuse a first empty search.
+        :param bool refresh: if True, always search again (updating the
+            cache) instead of using cached results.
+        """
+        SQLiteCache.__init__(self, filename)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh = refresh
+
+    @staticmethod
+    def _keys(search_queries, query_jobs):
+        """
+        Returns the cache key of each (movie_filename, language) pair.
+        """
+        parts = {}
+        for query, job in zip(search_queries, query_jobs):
+            query = dict(query)
+            language = query.pop('sublanguageid')
+            parts.setdefault(job, [language]).append(query)
+        return dict((job, json.dumps(x, sort_keys=True))
+                    for job, x in parts.items())
+
+    def lookup(self, search_queries, query_jobs):
+        """
+        Looks up the cached results for each pair of the given queries.
+
+        :rtype: tuple(dict, list, list)
+        :return: the cached results of each pair found, and the queries (and
+            their pairs) which should still be sent to the server.
+        """
+        if self.refresh:
+            return {}, search_queries, query_jobs
+        cached = {}
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            for job, key in self._keys(search_queries, query_jobs).items():
+                row = connection.execute(
+                    'SELECT results, expires FROM searches WHERE key = ?',
+                    (key,)).fetchone()
+                if row is not None and row[1] > now:
+                    cached[job] = json.loads(row[0])
+        self.hits += len(cached)
+        self.misses += len(set(query_jobs)) - len(cached)
+        remaining = [(query, job) for query, job in zip(search_queries,
+                                                        query_jobs)
+                     if job not in cached]
+        return (cached, [query for query, job in remaining],
+                [job for query, job in remaining])
+
+    def store(self, search_queries, query_jobs, results):
+        """
+        Stores the search results of each pair of the given queries.
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            for job, key in self._keys(search_queries, query_jobs).items():
+                if job not in results:
+                    continue
+                if results[job]:
+                    misses = 0
+                    ttl = self.ttl
+                else:
+                    row = connection.execute(
+                        'SELECT misses FROM searches WHERE key = ?',
+                        (key,)).fetchone()
+                    misses = (row[0] if row is not None else 0) + 1
+                    ttl = min(self.negative_ttl * 2 ** (misses - 1), self.ttl)
+                connection.execute(
+                    'INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)',
+                    (key, json.dumps(results[job] or [], default=str),
+                     misses, now + ttl))
+            connection.commit()
+
+
+class RunJournal(SQLiteCache):
+    """
+    Journal of the (movie, language) pairs of the runs and how far each one
+    got, so interrupted runs can be continued with ``--resume``.
+
+    The state of each pair is one of 'planned' (not done yet), 'searched'
+    (no subtitles found), 'downloaded' (its mkv file still to be created),
+    'done' (downloaded, no mkv file wanted), 'embedded' (into its mkv file)
+    or 'failed'. A new run forgets the pairs finished by earlier runs but
+    keeps the ones they didn't finish, so running ``ss`` on other movies
+    doesn't lose what ``--resume`` would continue.
+
+    Each change is committed right away, so concurrent runs never wait long
+    for each other. If the database can't be written even so, the journal
+    stops recording, keeping the error in ``error``, instead of failing the
+    run.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS jobs ('
+              'movie TEXT, language TEXT, state TEXT, '
+              'PRIMARY KEY (movie, language))')
+
+    finished = ('searched', 'done', 'embedded')
+
+    def __init__(self, filename):
+        SQLiteCache.__init__(self, filename)
+        self.error = None
+
+    def start(self, pairs):
+        """
+        Starts a new run of the given pairs.
+        """
+        def start(connection):
+            connection.execute(
+                'DELETE FROM jobs WHERE state IN (?, ?, ?)', self.finished)
+            connection.executemany(
+                'INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)',
+                [(os.path.abspath(movie_filename), language, 'planned')
+                 for movie_filename, language in pairs])
+        self._write(start)
+
+    def record(self, pairs, state):
+        self._write(lambda connection: connection.executemany(
+            'UPDATE jobs SET state = ? WHERE movie = ? AND language = ?',
+            [(state, os.path.abspath(movie_filename), language)
+             for movie_filename, language in pairs]))
+
+    def record_movie(self, movie_filename, previous, state):
+        """
+        Changes the state of the pairs of the movie in the `previous` state.
+        """
+        self._write(lambda connection: connection.execute(
+            'UPDATE jobs SET state = ? WHERE movie = ? AND state = ?',
+            (state, os.path.abspath(movie_filename), previous)))
+
+    def incomplete(self):
+        """
+        Returns the sorted pairs not searched or downloaded yet: the planned
+        and failed ones.
+        """
+        return self._pairs('planned', 'failed')
+
+    def downloaded(self):
+        """
+        Returns the sorted pairs downloaded but not embedded into their mkv
+        file yet.
+        """
+        return self._pairs('downloaded')
+
+    def _pairs(self, *states):
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT movie, language FROM jobs WHERE state IN '
+                '({0})'.format(', '.join('?' * len(states))),
+                states).fetchall()
+        return sorted((movie, language) for movie, language in rows)
+
+    def _write(self, func):
+        """
+        Calls ``func(connection)`` and commits its changes, unless the
+        journal failed before.
+        """
+        import sqlite3
+        with self._lock:
+            if self.error is not None:
+                return
+            try:
+                connection = self._connect()
+                try:
+                    func(connection)
+                    connection.commit()
+                except sqlite3.Error:
+                    connection.rollback()
+                    raise
+            except sqlite3.Error as e:  # typically "database is locked"
+                self.error = e
+
+
+# engines that can run searches and downloads, see "engine" in Configuration
+ENGINES = ('thread', 'async')
+
+
 class Configuration(object):
 
-    attrs = 'languages recursive skip mkv parallel_jobs'.split()
+    attrs = ('languages recursive skip mkv mkv_in_place parallel_jobs '
+             'search_batch_size two_phase_search cache_dir '
+             'http_max_connections http_idle_timeout engine '
+             'async_max_requests search_jobs '
+             'download_jobs mkv_jobs mkv_jobs_per_device search_cache_ttl '
+             'search_cache_negative_ttl adaptive_concurrency retry_attempts '
+             'circuit_breaker_failures circuit_breaker_timeout '
+             'connect_timeout read_timeout deadline hedge_percentile '
+             'hedge_max_rate guessit_processes watch_delay').split()
 
     def __init__(self, languages=('eng',), recursive=False, skip=False,
-                 mkv=False, parallel_jobs=8):
+                 mkv=False, mkv_in_place=False, parallel_jobs=8,
+                 search_batch_size=SEARCH_BATCH_SIZE, two_phase_search=False,
+                 cache_dir=None,
+                 http_max_connections=4, http_idle_timeout=30,
+                 engine='thread', async_max_requests=100, search_jobs=0,
+                 download_jobs=0, mkv_jobs=0, mkv_jobs_per_device=1,
+                 search_cache_ttl=24,
+                 search_cache_negative_ttl=1, adaptive_concurrency=True,
+                 retry_attempts=4, circuit_breaker_failures=5,
+                 circuit_breaker_timeout=30, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, deadline=0, hedge_percentile=0,
+                 hedge_max_rate=0.05, guessit_processes=0,
+                 watch_delay=WATCH_DELAY):
         self.languages = list(languages)
         self.recursive = recursive
         self.skip = skip
         self.mkv = mkv
+        self.mkv_in_place = mkv_in_place
         self.parallel_jobs = parallel_jobs
+        self.search_batch_size = search_batch_size
+        self.two_phase_search = two_phase_search
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.http_max_connections = http_max_connections
+        self.http_idle_timeout = http_idle_timeout
+        self.engine = engine
+        self.async_max_requests = async_max_requests
+        # 0 means the same as parallel_jobs
+        self.search_jobs = search_jobs
+        self.download_jobs = download_jobs
+        self.mkv_jobs = mkv_jobs
+        # mkv files created at the same time on each disk
+        self.mkv_jobs_per_device = mkv_jobs_per_device
+        # in hours
+        self.search_cache_ttl = search_cache_ttl
+        self.search_cache_negative_ttl = search_cache_negative_ttl
+        self.adaptive_concurrency = adaptive_concurrency
+        self.retry_attempts = retry_attempts
+        self.circuit_breaker_failures = circuit_breaker_failures
+        # in seconds
+        self.circuit_breaker_timeout = circuit_breaker_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # in minutes, 0 means no deadline
+        self.deadline = deadline
+        # 0 disables hedging
+        self.hedge_percentile = hedge_percentile
+        self.hedge_max_rate = hedge_max_rate
+        # 0 means one per CPU
+        self.guessit_processes = guessit_processes
+        # in seconds
+        self.watch_delay = watch_delay
 
     def __eq__(self, other):
         for attr in self.attrs:
@@ -291,12 +2080,166 @@ class Configuration(object):
             'recursive = %s' % self.recursive,
             'skip = %s' % self.skip,
             'mkv = %s' % self.mkv,
+            'mkv_in_place = %s' % self.mkv_in_place,
             'parallel_jobs = %d' % self.parallel_jobs,
+            'search_batch_size = %d' % self.search_batch_size,
+            'two_phase_search = %s' % self.two_phase_search,
+            'cache_dir = %s' % self.cache_dir,
+            'http_max_connections = %d' % self.http_max_connections,
+            'http_idle_timeout = %s' % self.http_idle_timeout,
+            'engine = %s' % self.engine,
+            'async_max_requests = %d' % self.async_max_requests,
+            'search_jobs = %d' % self.search_jobs,
+            'download_jobs = %d' % self.download_jobs,
+            'mkv_jobs = %d' % self.mkv_jobs,
+            'mkv_jobs_per_device = %d' % self.mkv_jobs_per_device,
+            'search_cache_ttl = %s' % self.search_cache_ttl,
+            'search_cache_negative_ttl = %s' % self.search_cache_negative_ttl,
+            'adaptive_concurrency = %s' % self.adaptive_concurrency,
+            'retry_attempts = %d' % self.retry_attempts,
+            'circuit_breaker_failures = %d' % self.circuit_breaker_failures,
+            'circuit_breaker_timeout = %s' % self.circuit_breaker_timeout,
+            'connect_timeout = %s' % self.connect_timeout,
+            'read_timeout = %s' % self.read_timeout,
+            'deadline = %s' % self.deadline,
+            'hedge_percentile = %s' % self.hedge_percentile,
+            'hedge_max_rate = %s' % self.hedge_max_rate,
+            'guessit_processes = %d' % self.guessit_processes,
+            'watch_delay = %s' % self.watch_delay,
         ]
         return '\n'.join(values)
 
 
-def main(argv=sys.argv, stream=sys.stdout):
+class Profiler(object):
+    """
+    Records how long each job of each stage of a run takes (``--profile``).
+
+    Spans are recorded per thread; spans of coroutines, which share a
+    thread, are given the lowest free "virtual" lane instead, so both
+    engines show how busy each stage was over time in the trace written by
+    `write_trace`.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = []  # list of (stage, lane, start, duration, detail)
+        self._busy_lanes = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, detail=None, virtual=False):
+        if virtual:
+            with self._lock:
+                lane = next(x for x in itertools.count()
+                            if 'async-%d' % x not in self._busy_lanes)
+                lane = 'async-%d' % lane
+                self._busy_lanes.add(lane)
+        else:
+            lane = threading.current_thread().name
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                self._busy_lanes.discard(lane)
+                self.spans.append((stage, lane, start, duration, detail))
+
+    def summary(self):
+        """
+        :rtype: list(tuple(str, int, float, float, float, float))
+        :return: for each stage, in order of first appearance: its name,
+            the number of jobs, the total seconds and the p50, p99 and
+            maximum seconds of a job.
+        """
+        durations = collections.OrderedDict()
+        for stage, lane, start, duration, detail in sorted(
+                self.spans, key=lambda x: x[2]):
+            durations.setdefault(stage, []).append(duration)
+        rows = []
+        for stage, values in durations.items():
+            values.sort()
+            rows.append((stage, len(values), sum(values),
+                         values[int(round(0.5 * (len(values) - 1)))],
+                         values[int(round(0.99 * (len(values) - 1)))],
+                         values[-1]))
+        return rows
+
+    def print_summary(self, stream):
+        elapsed = time.time() - self.started
+        print('{0:<10} {1:>7} {2:>9} {3:>6} {4:>9} {5:>9} {6:>9}'.format(
+            'Stage', 'Jobs', 'Total s', 'Busy', 'p50 ms', 'p99 ms', 'Max ms'),
+            file=stream)
+        for stage, count, total, p50, p99, maximum in self.summary():
+            # average number of jobs of the stage running at the same time
+            busy = total / elapsed if elapsed else 0.0
+            print('{0:<10} {1:>7} {2:>9.2f} {3:>6.1f} {4:>9.1f} {5:>9.1f} '
+                  '{6:>9.1f}'.format(stage, count, total, busy, p50 * 1000,
+                                     p99 * 1000, maximum * 1000),
+                  file=stream)
+        print('Wall time: {0:.2f}s'.format(elapsed), file=stream)
+
+    def write_trace(self, filename):
+        """
+        Writes the spans in Chrome's trace event format, which can be opened
+        in chrome://tracing or https://ui.perfetto.dev.
+        """
+        pid = os.getpid()
+        lanes = {}
+        events = []
+        for stage, lane, start, duration, detail in self.spans:
+            tid = lanes.setdefault(lane, len(lanes) + 1)
+            event = {'name': stage, 'cat': stage, 'ph': 'X', 'pid': pid,
+                     'tid': tid, 'ts': (start - self.started) * 1e6,
+                     'dur': duration * 1e6}
+            if detail is not None:
+                event['args'] = {'detail': detail}
+            events.append(event)
+        for lane, tid in lanes.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': lane}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+_colorama_initialized = []
+
+
+def init_colorama():
+    """
+    Makes sys.stdout reset the colors after each print (and translate them
+    on Windows), once.
+    """
+    if not _colorama_initialized:
+        import colorama
+        colorama.init(autoreset=True)
+        _colorama_initialized.append(True)
+
+
+# Profiler of the current run, set by main when profiling is enabled
+_profiler = None
+
+
+class _NotProfiled(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+def profiled(stage, detail=None, virtual=False):
+    """
+    Context manager timing its block as a job of the given stage when
+    profiling is enabled; see Profiler.span.
+    """
+    if _profiler is None:
+        return _NotProfiled()
+    return _profiler.span(stage, detail, virtual)
+
+
+def main(argv=sys.argv, stream=None):
     parser = optparse.OptionParser(
         usage='Usage: ss [options] <file or dir> <file or dir>...',
         description='Searches for subtitles using OpenSubtitles (http://www.opensubtitles.org).\n\nVersion: %s' % __version__,
@@ -305,8 +2248,53 @@ def main(argv=sys.argv, stream=sys.stdout):
     parser.add_option('-v', '--verbose',
                       help='always displays configuration and enable verbose mode.',
                       action='store_true', default=False)
+    parser.add_option('--rehash',
+                      help='calculate movie hashes again instead of using the '
+                           'hash cache.',
+                      action='store_true', default=False)
+    parser.add_option('--refresh',
+                      help='search again instead of using cached search '
+                           'results.',
+                      action='store_true', default=False)
+    parser.add_option('--watch',
+                      help='keep running, searching subtitles for the movies '
+                           'created in the given directories as they '
+                           'appear.',
+                      action='store_true', default=False)
+    parser.add_option('--resume',
+                      help='continue the interrupted runs, searching only '
+                           'the subtitles they did not finish, without '
+                           'listing the directories again.',
+                      action='store_true', default=False)
+    parser.add_option('--profile',
+                      help='time each stage of the run and show a summary '
+                           'at the end.',
+                      action='store_true', default=False)
+    parser.add_option('--trace', metavar='FILE',
+                      help='also write the timings of --profile to FILE in '
+                           'Chrome trace event format.')
     options, args = parser.parse_args(args=argv)
+    if stream is None:
+        init_colorama()
+        stream = sys.stdout
 
+    global _profiler
+    if options.profile or options.trace:
+        _profiler = Profiler()
+    try:
+        return _main(parser, options, args, stream)
+    finally:
+        profiler, _profiler = _profiler, None
+        if profiler is not None:
+            print(file=stream)
+            profiler.print_summary(stream)
+            if options.trace:
+                profiler.write_trace(options.trace)
+                print('Trace written to {0}'.format(options.trace),
+                      file=stream)
+
+
+def _main(parser, options, args, stream):
     config_filename = os.path.join(os.path.expanduser('~'), '.ss.ini')
     config = load_configuration(config_filename)
     if options.verbose:
@@ -314,14 +2302,73 @@ def main(argv=sys.argv, stream=sys.stdout):
         print(config, file=stream)
         print()
 
-    if len(args) < 2:
+    if len(args) < 2 and not options.resume:
         parser.print_help(file=stream)
         return 2
 
-    input_filenames = list(find_movie_files(args[1:], recursive=config.recursive))
-    if not input_filenames:
-        print('No files to search subtitles for. Aborting.', file=stream)
-        return 1
+    journal = RunJournal(os.path.join(config.cache_dir, 'journal.sqlite'))
+    with closing(journal):
+        return _plan(options, args, config, journal, stream)
+
+
+def _plan(options, args, config, journal, stream):
+    """
+    Finds the movies to search subtitles for, checks the configuration and
+    runs in the mode given in the command line.
+    """
+    from colorama import Fore, Style
+
+    listings = {}
+    pairs = None
+    downloaded = {}
+    if options.resume:
+        if len(args) > 1:
+            print('--resume continues the interrupted runs: do not pass '
+                  'files or directories.', file=stream)
+            return 2
+        pairs = [(movie_filename, language) for movie_filename, language
+                 in journal.incomplete() if os.path.isfile(movie_filename)]
+        if config.mkv:
+            # subtitles already downloaded go straight to their mkv file,
+            # unless they were removed since
+            multi = len(config.languages) > 1
+            for movie_filename, language in journal.downloaded():
+                if not os.path.isfile(movie_filename):
+                    continue
+                subtitle_filename = find_subtitle_filename(
+                    movie_filename, language, multi)
+                if subtitle_filename is None:
+                    pairs.append((movie_filename, language))
+                else:
+                    downloaded[(movie_filename, language)] = subtitle_filename
+        if not pairs and not downloaded:
+            print('Nothing to resume.', file=stream)
+            return 0
+        print('Resuming {0} unfinished subtitles.'.format(
+            len(pairs) + len(downloaded)), file=stream)
+        input_filenames = sorted(set(x for x, _ in pairs) |
+                                 set(x for x, _ in downloaded))
+    elif options.watch:
+        not_dirs = [x for x in args[1:] if not os.path.isdir(x)]
+        if not_dirs:
+            print('--watch needs directories: {0}'.format(', '.join(not_dirs)),
+                  file=stream)
+            return 2
+    else:
+        input_filenames = list(find_movie_files(
+            args[1:], recursive=config.recursive,
+            max_workers=config.parallel_jobs, listings=listings))
+        if not input_filenames:
+            print('No files to search subtitles for. Aborting.', file=stream)
+            return 1
+
+    if config.engine not in ENGINES:
+        print('Unknown engine "{0}" in your config: use one of {1}.'.format(
+            config.engine, ', '.join(ENGINES)), file=stream)
+        return 2
+    if config.engine == 'async' and sys.version_info < (3, 5):
+        print('engine = async requires Python 3.5 or later.', file=stream)
+        return 2
 
     if config.mkv:
         if not check_mkv_installed():
@@ -339,14 +2386,66 @@ def main(argv=sys.argv, stream=sys.stdout):
     print(msg, file=stream)
     print(file=stream)
 
+    if options.watch:
+        return _watch(args[1:], config, options, stream)
+    return _process_movies(input_filenames, listings, config, options, stream,
+                           journal=journal, pairs=pairs, downloaded=downloaded)
+
+
+def _watch(dirnames, config, options, stream):
+    """
+    Watch mode: searches subtitles for the movies created in the given
+    directories as they settle (see `watch_movies`), until interrupted.
+    """
+    watcher = create_watcher(dirnames, recursive=config.recursive)
+    print('Watching {0} ({1}), press Ctrl+C to stop.'.format(
+        ', '.join(dirnames), watcher.method), file=stream)
+    produced = set()
+    try:
+        for movie_filenames in watch_movies(watcher, config.watch_delay,
+                                            ignored=produced):
+            _process_movies(movie_filenames, {}, config, options, stream,
+                            produced)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+def _process_movies(input_filenames, listings, config, options, stream,
+                    produced=None, journal=None, pairs=None,
+                    downloaded=None):
+    """
+    Searches, downloads and embeds the subtitles of the given movies,
+    printing their progress.
+
+    :param set produced: if given, the mkv files written are added to it.
+    :param RunJournal journal: if given, records the progress of each
+        (movie_filename, language) pair; a new run is started in it unless
+        `pairs` are given.
+    :param list pairs: the (movie_filename, language) pairs to search,
+        instead of all languages of each movie.
+    :param dict downloaded: maps (movie_filename, language) pairs whose
+        subtitles were downloaded already to the subtitle filename, to be
+        embedded along with the searched ones without searching them again.
+    """
+    from colorama import Fore, Style
+
+    deadline = Deadline(config.deadline * 60)
     multi = len(config.languages) > 1
+    if pairs is None:
+        candidates = list(itertools.product(input_filenames,
+                                            config.languages))
+    else:
+        candidates = pairs
 
     to_skip = set()
     if config.skip:
-        for input_filename in input_filenames:
-            for language in config.languages:
-                if has_subtitle(input_filename, language, multi):
-                    to_skip.add((input_filename, language))
+        subtitle_index = SubtitleIndex(listings)
+        for input_filename, language in candidates:
+            if subtitle_index.has_subtitle(input_filename, language, multi):
+                to_skip.add((input_filename, language))
 
         if to_skip:
             print('Skipping %d subtitles.' % len(to_skip), file=stream)
@@ -356,91 +2455,1049 @@ def main(argv=sys.argv, stream=sys.stdout):
         print('{text}{spaces}{status}'.format(
             text=text, spaces=' ' * spaces, status=status), file=stream)
 
-    to_query = set(itertools.product(input_filenames, config.languages))
+    to_query = set(candidates)
     to_query.difference_update(to_skip)
-
-    if not to_query:
+    if not to_query and not downloaded:
         return 0
 
+    if journal is not None and pairs is None:
+        journal.start(to_query)
+
     header_style = Fore.WHITE + Style.BRIGHT
-    print(header_style + 'Downloading', file=stream)
+    if config.mkv:
+        print(header_style + 'Downloading / Embedding MKV', file=stream)
+    else:
+        print(header_style + 'Downloading', file=stream)
     print(file=stream)
 
-    matches = []
     to_query = sorted(to_query)
 
-    with ThreadPoolExecutor(max_workers=config.parallel_jobs) as executor:
-        future_to_movie_and_language = {}
-        for movie_filename, language in to_query:
-            f = executor.submit(search_and_download, movie_filename,
-                                language=language, multi=multi)
-            future_to_movie_and_language[f] = (movie_filename, language)
-
-        for future in as_completed(future_to_movie_and_language):
-            movie_filename, language = future_to_movie_and_language[future]
-            exception = future.exception()
-            if exception is None:
-                subtitle_filename = future.result()
-
-                if subtitle_filename:
-                    status = Fore.GREEN + '[OK]'
-                    matches.append((movie_filename, language, subtitle_filename))
-                else:
-                    status = Fore.RED + '[Not found]'
-            else:
-                status = Fore.RED + '[ERROR]: {}'.format(str(exception))
+    def print_language_status(movie_filename, language, status):
+        print_status(
+            os.path.basename(movie_filename),
+            status='{lang_color}{lang} {status}'.format(
+                lang_color=Fore.CYAN + Style.BRIGHT,
+                lang=language,
+                status=status))
+
+    timeouts = []
+
+    def report(movie_filename, language, subtitle_filename, exception):
+        state = None
+        if isinstance(exception, DeadlineExceeded):
+            timeouts.append((movie_filename, language))
+            status = Fore.YELLOW + '[timeout]'
+        elif exception is not None:
+            state = 'failed'
+            status = Fore.RED + '[ERROR]: {}'.format(str(exception))
+        elif subtitle_filename:
+            state = 'downloaded' if config.mkv else 'done'
+            status = Fore.GREEN + '[OK]'
+        else:
+            state = 'searched'
+            status = Fore.RED + '[Not found]'
+        if journal is not None and state is not None:
+            journal.record([(movie_filename, language)], state)
+        print_language_status(movie_filename, language, status)
+
+    failures = []  # list of (movie_filename, output)
+
+    def report_mkv(movie_filename, mkv_filename, status, output, written):
+        if journal is not None:
+            journal.record_movie(movie_filename, 'downloaded',
+                                 'failed' if status is False else 'embedded')
+        if status is None:
+            status = Fore.YELLOW + '[skipped]'
+        elif status:
+            if produced is not None:
+                produced.add(mkv_filename)
+            status = Fore.GREEN + '[OK] {0:.1f} MB written'.format(
+                written / 2 ** 20)
+        else:
+            failures.append((movie_filename, output))
+            status = Fore.RED + '[ERROR]'
+        print_status(os.path.basename(mkv_filename), Style.BRIGHT + status)
+
+    hash_cache = HashCache(os.path.join(config.cache_dir, 'hashes.sqlite'),
+                           rehash=options.rehash)
+    guessit_cache = GuessitCache(
+        os.path.join(config.cache_dir, 'guesses.sqlite'))
+    analyzer = MovieAnalyzer(hash_cache, guessit_cache)
+    search_cache = SearchCache(
+        os.path.join(config.cache_dir, 'searches.sqlite'),
+        ttl=config.search_cache_ttl * 60 * 60,
+        negative_ttl=config.search_cache_negative_ttl * 60 * 60,
+        refresh=options.refresh)
+    with closing(hash_cache), closing(guessit_cache), closing(search_cache):
+        if config.engine == 'async':
+            import ss_async
+            engine = ss_async.run_async_engine
+        else:
+            engine = run_thread_engine
+        stats = engine(to_query, config, multi, analyzer, report,
+                       report_mkv if config.mkv else None,
+                       search_cache=search_cache, deadline=deadline,
+                       downloaded=downloaded)
+
+    if failures:
+        print('_' * 80, file=stream)
+        for movie_filename, output in failures:
+            print(':%s:' % movie_filename, file=stream)
+            print(output, file=stream)
+
+    if timeouts:
+        print(file=stream)
+        print('Deadline of {0} minutes reached: {1} subtitles were not '
+              'searched or downloaded.'.format(config.deadline, len(timeouts)),
+              file=stream)
 
-            name = os.path.basename(movie_filename)
-            print_status(
-                name,
-                status='{lang_color}{lang} {status}'.format(
-                    lang_color=Fore.CYAN + Style.BRIGHT,
-                    lang=language,
-                    status=status))
+    if journal is not None and journal.error is not None:
+        print(file=stream)
+        print('Could not update the journal ({0}): --resume may not continue '
+              'this run.'.format(journal.error), file=stream)
 
-    if config.mkv:
+    retried = any(stats[x].retries or stats[x].breaker.opened
+                  for x in ('search_retry', 'download_retry'))
+    if options.verbose or retried:
         print(file=stream)
-        print(header_style + 'Embedding MKV', file=stream)
+        for name in ('search', 'download'):
+            print('{0} retries: {1}'.format(name.capitalize(),
+                                            stats[name + '_retry']),
+                  file=stream)
+
+    if options.verbose:
         print(file=stream)
-        failures = []  # list of (movie_filename, output)
-        to_embed = {}  # dict of movie -> (language, subtitle_filename)
-        for movie_filename, language, subtitle_filename in matches:
-            to_embed.setdefault(movie_filename, []).append((language,
-                                                            subtitle_filename))
-        to_embed = sorted(to_embed.items())
-        with ThreadPoolExecutor(max_workers=config.parallel_jobs) as executor:
-            future_to_mkv_filename = {}
-            for movie_filename, subtitles in to_embed:
-                subtitles.sort()
-                movie_ext = os.path.splitext(movie_filename)[1].lower()
-                mkv_filename = os.path.splitext(movie_filename)[0] + u'.mkv'
-                if movie_ext != u'.mkv' and not os.path.isfile(mkv_filename):
-                    f = executor.submit(embed_mkv, movie_filename, subtitles)
-                    future_to_mkv_filename[f] = (mkv_filename, movie_filename)
-                else:
-                    print_status(os.path.basename(mkv_filename),
-                                 Style.BRIGHT + Fore.YELLOW + '[skipped]')
-
-            for future in as_completed(future_to_mkv_filename):
-                mkv_filename, movie_filename = future_to_mkv_filename[future]
-                status, output = future.result()
-                if not status:
-                    failures.append((movie_filename, output))
-                status = Fore.GREEN + '[OK]' if status else Fore.RED + '[ERROR]'
-                status = Style.BRIGHT + status
-                print_status(os.path.basename(mkv_filename), status)
-
-        if failures:
-            print('_' * 80, file=stream)
-            for movie_filename, output in failures:
-                print(':%s:' % movie_filename, file=stream)
-                print(output, file=stream)
+        print('Movie analysis: {0} guessit parses ({1} saved, {2} cached), '
+              '{3} hashes ({4} saved)'.format(
+                  analyzer.calls['guessit'], analyzer.saved['guessit'],
+                  guessit_cache.hits, analyzer.calls['hash'],
+                  analyzer.saved['hash']),
+              file=stream)
+        print('Search cache: {0} hits, {1} misses'.format(
+            search_cache.hits, search_cache.misses), file=stream)
+        http_stats = stats['http']
+        print('Downloads: {0} requests, {1} reused connections '
+              '({2:.0%})'.format(http_stats.requests, http_stats.reused,
+                                 http_stats.reuse_rate),
+              file=stream)
+        for name in ('search', 'download'):
+            controller = stats[name + '_concurrency']
+            if controller is not None:
+                print('{0} concurrency: {1}'.format(name.capitalize(),
+                                                    controller), file=stream)
+        if stats['search_hedging'] is not None:
+            print('Search hedging: {0}'.format(stats['search_hedging']),
+                  file=stream)
 
     return 0
 
 
-def embed_mkv(movie_filename, subtitles):
-    output_filename = os.path.splitext(movie_filename)[0] + u'.mkv'
+class ConcurrencyController(object):
+    """
+    Adapts how many requests may be in flight at the same time using AIMD
+    (additive increase, multiplicative decrease).
+
+    The limit grows by one after each ``limit`` requests completed with a
+    healthy latency, up to ``maximum``, and is halved when the server
+    throttles us (see `is_throttling_error`) or when a request takes much
+    longer than the recent average. Requests started before a decrease do not
+    cause another one, so a burst of failures halves the limit only once.
+
+    ``levels`` records every limit chosen, for reporting.
+    """
+
+    # a request slower than this many times the average latency means the
+    # server is overloaded
+    latency_factor = 4.0
+
+    def __init__(self, maximum, initial=None, minimum=1):
+        self.maximum = max(maximum, minimum)
+        self.minimum = minimum
+        self.limit = initial or max(self.maximum // 2, minimum)
+        self.levels = [self.limit]
+        self.decreases = 0
+        self._in_flight = 0
+        self._successes = 0
+        self._average_latency = None
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        """
+        Waits until a request is allowed, recording its outcome and latency
+        when the block exits.
+        """
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+        started = time.time()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self.record(started, time.time() - started, error)
+                self._condition.notify_all()
+
+    def record(self, started, latency, error=None):
+        """
+        Adjusts the limit given the outcome of a request; callers must hold
+        the controller's lock (or run on a single thread).
+        """
+        if error is not None and not is_throttling_error(error):
+            return  # not the server's fault
+        slow = self._average_latency is not None and \
+            latency > self.latency_factor * self._average_latency
+        if error is not None or slow:
+            if started >= self._last_decrease:
+                self._last_decrease = time.time()
+                self.decreases += 1
+                self._successes = 0
+                self._set_limit(max(self.limit // 2, self.minimum))
+            return
+
+        if self._average_latency is None:
+            self._average_latency = latency
+        else:
+            self._average_latency = 0.8 * self._average_latency + 0.2 * latency
+        self._successes += 1
+        if self._successes >= self.limit:
+            self._successes = 0
+            self._set_limit(min(self.limit + 1, self.maximum))
+
+    def _set_limit(self, limit):
+        if limit != self.limit:
+            self.limit = limit
+            self.levels.append(limit)
+
+    def __str__(self):
+        return '{0} (started at {1}, range {2}-{3}, {4} decreases)'.format(
+            self.limit, self.levels[0], min(self.levels), max(self.levels),
+            self.decreases)
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised instead of starting a search or download after the deadline of
+    the run has passed.
+    """
+
+    def __init__(self):
+        Exception.__init__(self, 'deadline of the run exceeded')
+
+
+class Deadline(object):
+    """
+    Point in time after which no more network requests are started.
+
+    :param float seconds: from now; None or 0 means no deadline.
+    """
+
+    def __init__(self, seconds=None):
+        self.expires = time.time() + seconds if seconds else None
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    def check(self):
+        """
+        :raise DeadlineExceeded: if the deadline has passed.
+        """
+        if self.expired():
+            raise DeadlineExceeded()
+
+    def remaining(self):
+        """
+        :return: seconds until the deadline (0 once it passed), or None if
+            there is no deadline.
+        """
+        if self.expires is None:
+            return None
+        return max(self.expires - time.time(), 0.0)
+
+    def cap(self, seconds):
+        """
+        :return: how long to wait instead of ``seconds`` so that the wait ends
+            by the deadline.
+        """
+        remaining = self.remaining()
+        return seconds if remaining is None else min(seconds, remaining)
+
+
+class CircuitOpenError(IOError):
+    """
+    Raised instead of calling a server which the CircuitBreaker considers to
+    be down.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stops all workers from calling a server which is clearly down.
+
+    After ``failures`` transient errors in a row the circuit "opens": callers
+    of `admit` are paused for ``timeout`` seconds, after which a single one
+    of them is let through to probe the server. If it succeeds the circuit
+    closes and everyone resumes; if it fails, the circuit opens again and
+    the callers which were already waiting give up with CircuitOpenError.
+
+    ``opened`` counts how many times the circuit opened and ``paused`` the
+    seconds callers spent waiting, for reporting.
+    """
+
+    def __init__(self, failures=5, timeout=30):
+        self.failures = failures
+        self.timeout = timeout
+        self.opened = 0
+        self.paused = 0.0
+        self._state = 'closed'
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._condition = threading.Condition()
+
+    def admit(self, deadline=None):
+        """
+        Blocks while the circuit is open, but not past the given Deadline.
+
+        :raise CircuitOpenError: if the server is still down after waiting.
+        :raise DeadlineExceeded: if the deadline passes while waiting.
+        """
+        with self._condition:
+            generation = self.opened
+            started = time.time()
+            try:
+                while True:
+                    timeout = self._try_admit(generation)
+                    if timeout is None:
+                        return
+                    if deadline is not None:
+                        deadline.check()
+                        timeout = deadline.cap(timeout)
+                    self._condition.wait(timeout)
+            finally:
+                self.paused += time.time() - started
+
+    def _try_admit(self, generation):
+        """
+        State transition of `admit`, with the lock held: returns None if the
+        caller may proceed, or how long it should wait before trying again.
+        """
+        if self._state == 'closed':
+            return None
+        if self.opened != generation:
+            raise CircuitOpenError('server unavailable, giving up')
+        if self._state == 'open':
+            remaining = self._open_until - time.time()
+            if remaining > 0:
+                return remaining
+            self._state = 'half-open'
+            return None  # this caller probes the server
+        return self.timeout  # wait for the outcome of the probe
+
+    def record_success(self):
+        with self._condition:
+            self._record_success()
+            self._condition.notify_all()
+
+    def record_failure(self):
+        with self._condition:
+            self._record_failure()
+            self._condition.notify_all()
+
+    def _record_success(self):
+        self._consecutive_failures = 0
+        self._state = 'closed'
+
+    def _record_failure(self):
+        self._consecutive_failures += 1
+        if self._state == 'half-open' or (
+                self._state == 'closed' and
+                self._consecutive_failures >= self.failures):
+            self._state = 'open'
+            self._open_until = time.time() + self.timeout
+            self.opened += 1
+
+
+class RetryPolicy(object):
+    """
+    Calls functions again when they fail with a transient error (see
+    `is_transient_error`), up to ``attempts`` times in total, sleeping a
+    random time ("full jitter") below an exponentially growing delay between
+    attempts. Only use it for idempotent operations.
+
+    All calls go through the given CircuitBreaker, and no attempt is started
+    after the given Deadline (raising DeadlineExceeded instead), nor does any
+    wait for the breaker or between attempts last past it. ``retries``
+    counts the attempts made again and ``gave_up`` the calls which failed
+    even so.
+    """
+
+    base_delay = 0.5
+    max_delay = 30.0
+
+    def __init__(self, attempts=4, breaker=None, deadline=None):
+        self.attempts = max(attempts, 1)
+        self.breaker = breaker or CircuitBreaker()
+        self.deadline = deadline or Deadline()
+        self.retries = 0
+        self.gave_up = 0
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        for attempt in itertools.count(1):
+            self.deadline.check()
+            self.breaker.admit(self.deadline)
+            self.deadline.check()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                transient = is_transient_error(e)
+                if transient:
+                    self.breaker.record_failure()
+                else:
+                    # the server answered, so it is up
+                    self.breaker.record_success()
+                delay = self._next_delay(transient, attempt)
+                if delay is None:
+                    raise
+                time.sleep(self.deadline.cap(delay))
+            else:
+                self.breaker.record_success()
+                return result
+
+    def _next_delay(self, transient, attempt):
+        """
+        Counts a failed attempt, returning how long to wait before the next
+        one or None if the error should be raised.
+        """
+        if not transient:
+            return None
+        with self._lock:
+            if attempt >= self.attempts:
+                self.gave_up += 1
+                return None
+            self.retries += 1
+        return self.backoff(attempt)
+
+    def backoff(self, attempt):
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def __str__(self):
+        return '{0} retries, {1} gave up; circuit opened {2} times ' \
+               '(paused {3:.1f}s)'.format(self.retries, self.gave_up,
+                                          self.breaker.opened,
+                                          self.breaker.paused)
+
+
+class SearchHedger(object):
+    """
+    Cuts the tail latency of searches by hedging: when a search takes longer
+    than the ``percentile`` of the latencies seen so far in the run, the
+    same search is sent again on another session and the first reply wins.
+
+    Hedging starts after ``min_samples`` searches completed, and at most
+    ``max_rate`` of the searches are hedged, so a slow server does not get
+    twice the load. ``searches``, ``hedged`` and ``won`` count the searches
+    made, how many of them were hedged and how many times the hedge replied
+    first.
+
+    :param SessionPool hedge_pool: sessions used for the hedged requests.
+    :param int max_workers: threads used to wait for both requests.
+    """
+
+    def __init__(self, percentile=95, max_rate=0.05, hedge_pool=None,
+                 max_workers=8, min_samples=20, window=200):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.hedge_pool = hedge_pool
+        self.max_workers = max_workers
+        self.min_samples = min_samples
+        self.searches = 0
+        self.hedged = 0
+        self.won = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def threshold(self):
+        """
+        Returns the seconds after which a search should be hedged, or None
+        if there are not enough samples yet.
+        """
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = int(round(self.percentile / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+    def _start_search(self):
+        with self._lock:
+            self.searches += 1
+
+    def _take_hedge(self):
+        """
+        Returns True if one more search may be hedged under ``max_rate``.
+        """
+        with self._lock:
+            if self.hedged + 1 > self.max_rate * self.searches:
+                return False
+            self.hedged += 1
+            return True
+
+    def search(self, session_pool, search_queries):
+        """
+        Sends the search using a session of the given pool, hedging it if it
+        takes too long.
+        """
+        self._start_search()
+        from concurrent.futures import ThreadPoolExecutor, wait, \
+            FIRST_COMPLETED
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+        primary = self._executor.submit(self._search, session_pool,
+                                        search_queries, True)
+        threshold = self.threshold()
+        if threshold is None or primary in wait([primary], threshold)[0] or \
+                not self._take_hedge():
+            return primary.result()
+
+        hedge = self._executor.submit(self._search, self.hedge_pool,
+                                      search_queries, False)
+        pending = [primary, hedge]
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        with self._lock:
+                            self.won += 1
+                    return future.result()
+        return primary.result()  # both failed
+
+    def _search(self, session_pool, search_queries, measure):
+        with session_pool.session() as session:
+            started = time.time()
+            response = session.search_subtitles(search_queries)
+        if measure:
+            self.record(time.time() - started)
+        return response
+
+    def close(self):
+        # requests which lost the race may still be using a session, and
+        # blocking XML-RPC calls can't be cancelled, so they are waited for
+        # (at most the read timeout) before the sessions are logged out
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        if self.hedge_pool is not None:
+            self.hedge_pool.close()
+
+    def __str__(self):
+        return '{0} of {1} searches hedged, {2} won'.format(
+            self.hedged, self.searches, self.won)
+
+
+# maximum number of items waiting in the queue of each pipeline stage
+PIPELINE_QUEUE_SIZE = 100
+
+
+class PipelineStage(object):
+    """
+    Stage of a pipeline: worker threads calling ``func(item)`` for each item
+    put in a bounded queue, so producers block when the stage falls behind.
+
+    After `close` is called the workers exit once all queued items are
+    processed, and the last one to exit calls `on_finished`, typically to
+    close the next stage. If ``func`` raises, ``on_error(item, exception)``
+    is called and the worker goes on with the next item.
+    """
+
+    _stop = object()
+
+    def __init__(self, func, workers, on_finished=None, on_error=None,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        self._func = func
+        self._on_finished = on_finished
+        self._on_error = on_error
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._alive = workers
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def close(self):
+        for _ in self._threads:
+            self._queue.put(self._stop)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is self._stop:
+                    break
+                try:
+                    self._func(item)
+                except Exception as e:
+                    if self._on_error is not None:
+                        self._on_error(item, e)
+        finally:
+            with self._lock:
+                self._alive -= 1
+                finished = self._alive == 0
+            if finished and self._on_finished is not None:
+                self._on_finished()
+
+
+class MkvScheduler(object):
+    """
+    Stage creating mkv files, with the same interface as PipelineStage:
+    worker threads call ``func((movie_filename, subtitles))`` for each item
+    put, smallest movies first, with at most `max_per_device` items of
+    movies on the same device (``st_dev``) at a time, so remuxes on one disk
+    don't fight over its seeks while the other disks are idle.
+    """
+
+    def __init__(self, func, workers, max_per_device=1, on_finished=None,
+                 on_error=None):
+        self._func = func
+        self._on_finished = on_finished
+        self._on_error = on_error
+        self._max_per_device = max_per_device
+        self._pending = []  # sorted list of (size, sequence, device, item)
+        self._running = collections.defaultdict(int)  # device -> items
+        self._sequence = 0
+        self._closed = False
+        self._alive = workers
+        self._condition = threading.Condition()
+        self._threads = [threading.Thread(target=self._work)
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, item):
+        movie_filename = item[0]
+        try:
+            st = os.stat(movie_filename)
+            size, device = st.st_size, st.st_dev
+        except OSError:
+            size, device = 0, None  # let func report the error
+        with self._condition:
+            self._sequence += 1
+            bisect.insort(self._pending,
+                          (size, self._sequence, device, item))
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _next(self):
+        """
+        Waits for the smallest pending item whose device has a free slot,
+        returning (device, item), or None once closed and nothing is left.
+        """
+        with self._condition:
+            while True:
+                for i, (_, _, device, item) in enumerate(self._pending):
+                    if self._running[device] < self._max_per_device:
+                        del self._pending[i]
+                        self._running[device] += 1
+                        return device, item
+                if self._closed and not self._pending:
+                    return None
+                self._condition.wait()
+
+    def _work(self):
+        try:
+            while True:
+                job = self._next()
+                if job is None:
+                    break
+                device, item = job
+                try:
+                    self._func(item)
+                except Exception as e:
+                    if self._on_error is not None:
+                        self._on_error(item, e)
+                finally:
+                    with self._condition:
+                        self._running[device] -= 1
+                        self._condition.notify_all()
+        finally:
+            with self._condition:
+                self._alive -= 1
+                finished = self._alive == 0
+            if finished and self._on_finished is not None:
+                self._on_finished()
+
+
+class MovieProgress(object):
+    """
+    Keeps track of the (movie_filename, language) pairs still pending for
+    each movie, collecting the subtitles downloaded for it.
+    """
+
+    def __init__(self, movie_languages):
+        self._pending = {}
+        self._subtitles = {}
+        self._lock = threading.Lock()
+        for movie_filename, language in movie_languages:
+            self._pending[movie_filename] = \
+                self._pending.get(movie_filename, 0) + 1
+
+    def done(self, movie_filename, language, subtitle_filename):
+        """
+        Marks the pair as done.
+
+        :return: the list of (language, subtitle_filename) downloaded for
+            the movie if this was its last pending pair, else None.
+        """
+        with self._lock:
+            subtitles = self._subtitles.setdefault(movie_filename, [])
+            if subtitle_filename:
+                subtitles.append((language, subtitle_filename))
+            self._pending[movie_filename] -= 1
+            if self._pending[movie_filename] == 0:
+                return self._subtitles.pop(movie_filename)
+        return None
+
+
+def embed_movie(movie_filename, subtitles, in_place=False):
+    """
+    Creates an mkv file next to the movie with the given subtitles embedded,
+    unless the mkv file already exists. If the movie already is an mkv file
+    it is skipped, unless `in_place` is given: then the subtitles of
+    languages it doesn't have yet are added to it (see `update_mkv`).
+    Fails without calling mkvmerge if there is not enough free space for it.
+
+    :rtype: tuple(str, bool|None, str, int)
+    :return: the mkv filename, the status (None if skipped), the output
+        of mkvmerge and the bytes written.
+    """
+    movie_ext = os.path.splitext(movie_filename)[1].lower()
+    mkv_filename = mkv_filename_of(movie_filename)
+    if movie_ext == u'.mkv':
+        if in_place:
+            present = mkv_subtitle_languages(movie_filename)
+            subtitles = [(language, subtitle_filename)
+                         for language, subtitle_filename in subtitles
+                         if convert_language_code_to_iso639_2(language)
+                         not in present]
+        if not in_place or not subtitles:
+            return mkv_filename, None, '', 0
+    elif os.path.isfile(mkv_filename):
+        return mkv_filename, None, '', 0
+
+    # the mkv file takes about as much space as its contents
+    try:
+        needed = sum(os.path.getsize(x) for x in
+                     [movie_filename] + [s for _, s in subtitles])
+    except OSError:
+        needed = 0  # mkvmerge reports it
+    available = free_space(os.path.dirname(mkv_filename) or u'.')
+    if available is not None and available < needed:
+        return mkv_filename, False, (
+            'Not enough free space: {0} MB needed, {1} MB available'
+            .format(needed // 2 ** 20, available // 2 ** 20)), 0
+    with profiled('mkv', mkv_filename):
+        if movie_ext == u'.mkv':
+            status, output = update_mkv(movie_filename, sorted(subtitles))
+        else:
+            status, output = embed_mkv(movie_filename, sorted(subtitles))
+    written = os.path.getsize(mkv_filename) if status else 0
+    return mkv_filename, status, output, written
+
+
+def mkv_filename_of(movie_filename):
+    return os.path.splitext(movie_filename)[0] + u'.mkv'
+
+
+def free_space(dirname):
+    """
+    Returns the bytes available to the user in the file system of the given
+    directory, or None if unknown.
+    """
+    try:
+        if hasattr(os, 'statvfs'):
+            st = os.statvfs(dirname)
+            return st.f_bavail * st.f_frsize
+        import shutil
+        return shutil.disk_usage(dirname).free  # pragma: no cover
+    except (OSError, AttributeError):  # pragma: no cover
+        return None
+
+
+def run_thread_engine(to_query, config, multi, analyzer, report,
+                      report_mkv=None, search_cache=None, deadline=None,
+                      downloaded=None):
+    """
+    Searches and downloads subtitles for the given (movie_filename, language)
+    pairs, embedding them into mkv files if `report_mkv` is given.
+
+    Runs as a pipeline of stages connected by bounded queues, each one with
+    its own threads: search batches feed the downloads, and the mkv file of
+    a movie is created as soon as all its languages are done, by a
+    MkvScheduler limiting the mkv files created at once on each disk.
+    ``report(movie_filename, language, subtitle_filename, exception)`` and
+    ``report_mkv(movie_filename, mkv_filename, status, output, written)``
+    are called in the calling thread as each item is done.
+
+    When ``config.adaptive_concurrency`` is enabled, the number of searches
+    and downloads in flight is adapted by a ConcurrencyController, using the
+    threads of each stage as the upper bound. Searches and downloads failing
+    with transient errors are retried (see `create_retry_policies`), and
+    slow searches are hedged if ``config.hedge_percentile`` is set.
+
+    :param SearchCache search_cache: optional cache of search results.
+    :param Deadline deadline: searches and downloads not started by then are
+        reported with a DeadlineExceeded exception.
+    :param dict downloaded: maps pairs downloaded before to their subtitle
+        filename; they are reported as done right away, and embedded with
+        the other languages of their movie.
+    :return: dict with the statistics objects of the run: "http" (the
+        HTTPConnectionPool used for downloads), "search_concurrency" and
+        "download_concurrency" (ConcurrencyController or None), and
+        "search_retry" and "download_retry" (RetryPolicy), and
+        "search_hedging" (SearchHedger or None).
+    """
+    search_jobs = config.search_jobs or config.parallel_jobs
+    download_jobs = config.download_jobs or config.parallel_jobs
+    mkv_jobs = config.mkv_jobs or config.parallel_jobs
+    search_controller = download_controller = None
+    if config.adaptive_concurrency:
+        search_controller = ConcurrencyController(search_jobs)
+        download_controller = ConcurrencyController(download_jobs)
+    search_retry, download_retry = create_retry_policies(config, deadline)
+
+    session_pool = SessionPool(search_jobs,
+                               connect_timeout=config.connect_timeout,
+                               read_timeout=config.read_timeout)
+    http_pool = HTTPConnectionPool(config.http_max_connections,
+                                   config.http_idle_timeout,
+                                   config.connect_timeout, config.read_timeout)
+    hedger = None
+    if config.hedge_percentile:
+        hedge_pool = SessionPool(search_jobs,
+                                 connect_timeout=config.connect_timeout,
+                                 read_timeout=config.read_timeout)
+        hedger = SearchHedger(config.hedge_percentile, config.hedge_max_rate,
+                              hedge_pool, max_workers=2 * search_jobs)
+    downloaded = downloaded or {}
+    progress = MovieProgress(list(to_query) + list(downloaded))
+    events = queue.Queue()
+    finished = object()
+
+    def done(movie_filename, language, subtitle_filename, exception=None):
+        events.put((report, movie_filename, language, subtitle_filename,
+                    exception))
+        subtitles = progress.done(movie_filename, language, subtitle_filename)
+        if subtitles and mkv_stage is not None:
+            mkv_stage.put((movie_filename, subtitles))
+
+    def search(batch):
+        def search_batch():
+            return query_open_subtitles_batch(
+                batch, session_pool=session_pool, analyzer=analyzer,
+                search_cache=search_cache, hedger=hedger,
+                two_phase=config.two_phase_search,
+                controller=search_controller)
+
+        try:
+            search_results = search_retry.call(search_batch)
+        except Exception as e:
+            for movie_filename, language in batch:
+                done(movie_filename, language, None, e)
+            return
+        for movie_filename, language in batch:
+            job_results = search_results[(movie_filename, language)]
+            if isinstance(job_results, Exception):
+                done(movie_filename, language, None, job_results)
+                continue
+            subtitle_url, subtitle_ext = select_subtitle(job_results)
+            if subtitle_url:
+                download_stage.put((movie_filename, language, subtitle_url,
+                                    subtitle_ext))
+            else:
+                done(movie_filename, language, None)
+
+    def download(item):
+        movie_filename, language, subtitle_url, subtitle_ext = item
+        def download_item():
+            with controlled(download_controller):
+                return download_movie_subtitle(
+                    movie_filename, language, subtitle_url, subtitle_ext,
+                    multi=multi, http_pool=http_pool)
+
+        try:
+            subtitle_filename = download_retry.call(download_item)
+        except Exception as e:
+            done(movie_filename, language, None, e)
+        else:
+            done(movie_filename, language, subtitle_filename)
+
+    def search_failed(batch, exception):
+        for movie_filename, language in batch:
+            done(movie_filename, language, None, exception)
+
+    def download_failed(item, exception):
+        movie_filename, language = item[:2]
+        done(movie_filename, language, None, exception)
+
+    def embed(item):
+        movie_filename, subtitles = item
+        result = embed_movie(movie_filename, subtitles, config.mkv_in_place)
+        events.put((report_mkv, movie_filename) + result)
+
+    def embed_failed(item, exception):
+        movie_filename = item[0]
+        events.put((report_mkv, movie_filename,
+                    mkv_filename_of(movie_filename), False, str(exception), 0))
+
+    def feed():
+        try:
+            for batch in iter_analyzed_batches(to_query, config, analyzer):
+                search_stage.put(batch)
+        finally:
+            search_stage.close()
+
+    with closing(session_pool), closing(http_pool):
+        try:
+            if report_mkv is not None:
+                mkv_stage = MkvScheduler(
+                    embed, mkv_jobs, config.mkv_jobs_per_device,
+                    on_finished=lambda: events.put(finished),
+                    on_error=embed_failed)
+                download_finished = mkv_stage.close
+            else:
+                mkv_stage = None
+                download_finished = lambda: events.put(finished)
+            download_stage = PipelineStage(download, download_jobs,
+                                           on_finished=download_finished,
+                                           on_error=download_failed)
+            search_stage = PipelineStage(search, search_jobs,
+                                         on_finished=download_stage.close,
+                                         on_error=search_failed)
+            for job, subtitle_filename in sorted(downloaded.items()):
+                done(job[0], job[1], subtitle_filename)
+            feeder = threading.Thread(target=feed)
+            feeder.daemon = True
+            feeder.start()
+
+            while True:
+                event = events.get()
+                if event is finished:
+                    break
+                callback, args = event[0], event[1:]
+                callback(*args)
+        finally:
+            if hedger is not None:
+                hedger.close()
+
+    return {
+        'http': http_pool,
+        'search_concurrency': search_controller,
+        'download_concurrency': download_controller,
+        'search_retry': search_retry,
+        'download_retry': download_retry,
+        'search_hedging': hedger,
+    }
+
+
+def iter_analyzed_batches(to_query, config, analyzer):
+    """
+    Plans the search batches of the run (see `plan_search_batches`),
+    yielding each one once the names of all its movies have been parsed by
+    `MovieAnalyzer.analyze`.
+
+    With ``config.two_phase_search`` names are only parsed by the searches
+    whose hashes found nothing, so batches are yielded right away, and with
+    twice as many pairs since each call sends one query per pair.
+    """
+    if config.two_phase_search:
+        for batch in plan_search_batches(to_query, config.search_batch_size,
+                                         queries_per_pair=1):
+            yield batch
+        return
+    batches = collections.deque(plan_search_batches(to_query,
+                                                    config.search_batch_size))
+    movies = sorted(set(movie_filename for movie_filename, _ in to_query))
+    processes = config.guessit_processes or cpu_count()
+    ready = set()
+    for analyzed in analyzer.analyze(movies, processes):
+        ready.update(analyzed)
+        while batches and all(x in ready for x, _ in batches[0]):
+            yield batches.popleft()
+    for batch in batches:
+        yield batch
+
+
+def cpu_count():
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:  # pragma: no cover
+        return 1
+
+
+def create_retry_policies(config, deadline=None, retry_class=None,
+                          breaker_class=None):
+    """
+    Returns the RetryPolicy for searches and the one for downloads, each one
+    with its own CircuitBreaker as they talk to different servers.
+    """
+    retry_class = retry_class or RetryPolicy
+    breaker_class = breaker_class or CircuitBreaker
+    return tuple(
+        retry_class(config.retry_attempts,
+                    breaker_class(config.circuit_breaker_failures,
+                                  config.circuit_breaker_timeout),
+                    deadline)
+        for _ in range(2))
+
+
+@contextmanager
+def controlled(controller):
+    """
+    Runs the block in a slot of the given ConcurrencyController, if any.
+    """
+    if controller is None:
+        yield
+    else:
+        with controller.slot():
+            yield
+
+
+def embed_mkv(movie_filename, subtitles, output_filename=None):
+    if output_filename is None:
+        output_filename = os.path.splitext(movie_filename)[0] + u'.mkv'
     params = [
         u'mkvmerge',
         u'--output', output_filename,
@@ -456,10 +3513,58 @@ def embed_mkv(movie_filename, subtitles):
         check_output(params)
     except subprocess.CalledProcessError as e:
         return False, e.output
+    except OSError as e:
+        return False, str(e)
     else:
         return True, ''
 
 
+def update_mkv(mkv_filename, subtitles):
+    """
+    Adds the given subtitles to an existing mkv file in a single mkvmerge
+    pass, writing a temporary file in the same directory (so on the same
+    file system) which then atomically replaces the original: the original
+    is intact if anything fails, and a second copy of the movie is never
+    left behind.
+
+    :rtype: tuple(bool, str)
+    :return: the status and the output of mkvmerge.
+    """
+    import shutil
+    import tempfile
+    dirname, basename = os.path.split(mkv_filename)
+    fd, temp_filename = tempfile.mkstemp(suffix=u'.tmp',
+                                         prefix=u'.' + basename + u'.',
+                                         dir=dirname or u'.')
+    os.close(fd)
+    try:
+        status, output = embed_mkv(mkv_filename, subtitles, temp_filename)
+        if status:
+            shutil.copymode(mkv_filename, temp_filename)
+            replace_file(temp_filename, mkv_filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+    if not status:
+        os.remove(temp_filename)
+    return status, output
+
+
+def mkv_subtitle_languages(mkv_filename):
+    """
+    Returns the set of iso-639-2 languages of the subtitle tracks of an mkv
+    file, as identified by mkvmerge (empty if it can't tell).
+    """
+    try:
+        output = check_output([u'mkvmerge', u'-J', mkv_filename])
+        info = json.loads(output.decode('utf-8'))
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        return set()
+    return set(track.get('properties', {}).get('language')
+               for track in info.get('tracks', [])
+               if track.get('type') == 'subtitles')
+
+
 def convert_language_code_to_iso639_2(lang_code):
     """
     Translate OpenSubtitle language code to its iso-639-2 equivalent.
@@ -484,7 +3589,7 @@ def check_mkv_installed():
     """
     try:
         check_output([u'mkvmerge', u'--version'])
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         return False
     else:
         return True
@@ -493,8 +3598,11 @@ def check_mkv_installed():
 def check_output(params):
     """
     Python 2.6 support: subprocess.check_output from Python 2.7.
+
+    The program is executed directly, not through a shell, so raises OSError
+    if it is not found.
     """
-    popen = subprocess.Popen(params, shell=True, stderr=subprocess.STDOUT,
+    popen = subprocess.Popen(params, stderr=subprocess.STDOUT,
                              stdout=subprocess.PIPE)
 
     output, _ = popen.communicate()
@@ -0,0 +1,585 @@
+"""
+asyncio engine for ss, used instead of the thread pool when ``engine = async``
+is configured.
+
+It talks to OpenSubtitles and downloads subtitles over asyncio streams, so
+hundreds of searches and downloads can be in flight at the same time without
+a thread for each one; only hashing, guessit parsing and mkvmerge run on a
+small thread pool. It lives in its own module because it requires Python 3.5, while ss
+itself still supports Python 2.7.
+"""
+import asyncio
+import io
+import socket
+import time
+import xmlrpc.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import ss
+
+
+class AsyncHTTPClient:
+    """
+    Minimal HTTP/1.1 client on top of asyncio streams, keeping connections
+    alive and reusing them per scheme and host.
+
+    At most ``max_per_host`` requests to the same host are in flight at any
+    time. ``requests``, ``reused`` and ``reuse_rate`` have the same meaning as
+    in `ss.HTTPConnectionPool`. Connecting and reading each response fail
+    with socket.timeout after ``connect_timeout`` and ``read_timeout``
+    seconds.
+    """
+
+    redirect_statuses = (301, 302, 303, 307, 308)
+
+    def __init__(self, max_per_host=100, idle_timeout=30,
+                 connect_timeout=ss.CONNECT_TIMEOUT,
+                 read_timeout=ss.READ_TIMEOUT):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.requests = 0
+        self.reused = 0
+        self._idle = {}  # (scheme, host) -> list of (reader, writer, last used)
+        self._semaphores = {}  # (scheme, host) -> asyncio.Semaphore
+
+    @property
+    def reuse_rate(self):
+        return self.reused / self.requests if self.requests else 0.0
+
+    async def request(self, method, url, body=None, headers=None,
+                      max_redirects=5):
+        """
+        Sends a request, following redirects.
+
+        :rtype: tuple(int, bytes)
+        :return: the response status and body.
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        lines = ['{0} {1} HTTP/1.1'.format(method, path),
+                 'Host: ' + parts.netloc,
+                 'User-Agent: ss v' + ss.__version__]
+        lines.extend('{0}: {1}'.format(k, v)
+                     for k, v in sorted((headers or {}).items()))
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        request += body or b''
+
+        semaphore = self._semaphores.setdefault(
+            key, asyncio.Semaphore(self.max_per_host))
+        async with semaphore:
+            while True:
+                reader, writer, reused = await self._checkout(key)
+                try:
+                    writer.write(request)
+                    status, response_headers, keep_alive, response_body = \
+                        await with_timeout(self._read_response(reader),
+                                           self.read_timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue  # the server closed the idle connection
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                break
+            self.requests += 1
+            self.reused += reused
+            if keep_alive:
+                self._idle.setdefault(key, []).append(
+                    (reader, writer, time.time()))
+            else:
+                writer.close()
+
+        if status in self.redirect_statuses and max_redirects > 0:
+            location = urljoin(url, response_headers['location'])
+            return await self.request(method, location, body, headers,
+                                      max_redirects - 1)
+        return status, response_body
+
+    async def _checkout(self, key):
+        now = time.time()
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used <= self.idle_timeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, netloc = key
+        host, _, port = netloc.partition(':')
+        secure = scheme == 'https'
+        port = int(port) if port else (443 if secure else 80)
+        reader, writer = await with_timeout(
+            asyncio.open_connection(host, port, ssl=secure or None),
+            self.connect_timeout)
+        return reader, writer, False
+
+    async def _read_response(self, reader):
+        status_line = await reader.readuntil(b'\r\n')
+        version, status = status_line.split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == b'HTTP/1.1' and \
+            headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size_line = await reader.readuntil(b'\r\n')
+                size = int(size_line.split(b';')[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while await reader.readuntil(b'\r\n') != b'\r\n':
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return int(status), headers, keep_alive, body
+
+    def close(self):
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for reader, writer, last_used in connections:
+                writer.close()
+
+
+async def with_timeout(coroutine, timeout):
+    """
+    Awaits the coroutine, raising socket.timeout (as blocking sockets do)
+    if it takes longer than the given seconds.
+    """
+    try:
+        return await asyncio.wait_for(coroutine, timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout('timed out')
+
+
+class AsyncOpenSubtitlesSession:
+    """
+    Asynchronous counterpart of `ss.OpenSubtitlesSession`: a single token is
+    shared by all requests of a run, renewed when the server reports it as
+    invalid.
+    """
+
+    def __init__(self, client, uri=None):
+        self.client = client
+        self.uri = uri or ss.OPENSUBTITLES_URI
+        self.token = None
+        self.login_count = 0
+        self._login_lock = asyncio.Lock()
+
+    async def _call_rpc(self, method_name, *args):
+        body = xmlrpc.client.dumps(args, method_name, allow_none=True)
+        status, response_body = await self.client.request(
+            'POST', self.uri, body.encode('utf-8'),
+            {'Content-Type': 'text/xml'})
+        if status in ss.BUSY_STATUSES:
+            raise ss.ServerBusyError('HTTP error %d' % status)
+        if status != 200:
+            raise xmlrpc.client.ProtocolError(self.uri, status,
+                                              'HTTP error %d' % status, {})
+        (response,), _ = xmlrpc.client.loads(response_body, use_datetime=True)
+        return response
+
+    async def login(self, expired_token=None):
+        async with self._login_lock:
+            # another request might have renewed it while we waited
+            if self.token is None or self.token == expired_token:
+                login_info = await self._call_rpc(
+                    'LogIn', '', '', 'en', 'ss v' + ss.__version__)
+                self.token = login_info['token']
+                self.login_count += 1
+
+    async def logout(self):
+        if self.token is not None:
+            token, self.token = self.token, None
+            await self._call_rpc('LogOut', token)
+
+    async def call(self, method_name, *args):
+        if self.token is None:
+            await self.login()
+        token = self.token
+        response = await self._call_rpc(method_name, token, *args)
+        if ss.is_expired_session_response(response):
+            await self.login(expired_token=token)
+            response = await self._call_rpc(method_name, self.token, *args)
+        ss.check_server_busy_response(response)
+        return response
+
+    async def search_subtitles(self, search_queries):
+        return await self.call('SearchSubtitles', search_queries)
+
+
+class AsyncConcurrencyController(ss.ConcurrencyController):
+    """
+    `ss.ConcurrencyController` for coroutines: `slot` is an asynchronous
+    context manager.
+    """
+
+    def __init__(self, maximum, initial=None, minimum=1):
+        ss.ConcurrencyController.__init__(self, maximum, initial, minimum)
+        self._condition = asyncio.Condition()
+
+    def slot(self):
+        return _ControllerSlot(self)
+
+
+class _ControllerSlot:
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.started = None
+
+    async def __aenter__(self):
+        controller = self.controller
+        async with controller._condition:
+            while controller._in_flight >= controller.limit:
+                await controller._condition.wait()
+            controller._in_flight += 1
+        self.started = time.time()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        controller = self.controller
+        async with controller._condition:
+            controller._in_flight -= 1
+            controller.record(self.started, time.time() - self.started,
+                              exc_value if isinstance(exc_value, Exception)
+                              else None)
+            controller._condition.notify_all()
+
+
+class AsyncCircuitBreaker(ss.CircuitBreaker):
+    """
+    `ss.CircuitBreaker` for coroutines: its methods must be awaited.
+    """
+
+    def __init__(self, failures=5, timeout=30):
+        ss.CircuitBreaker.__init__(self, failures, timeout)
+        self._condition = asyncio.Condition()
+
+    async def admit(self, deadline=None):
+        async with self._condition:
+            generation = self.opened
+            started = time.time()
+            try:
+                while True:
+                    timeout = self._try_admit(generation)
+                    if timeout is None:
+                        return
+                    if deadline is not None:
+                        deadline.check()
+                        timeout = deadline.cap(timeout)
+                    try:
+                        await asyncio.wait_for(self._condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self.paused += time.time() - started
+
+    async def record_success(self):
+        async with self._condition:
+            self._record_success()
+            self._condition.notify_all()
+
+    async def record_failure(self):
+        async with self._condition:
+            self._record_failure()
+            self._condition.notify_all()
+
+
+class AsyncRetryPolicy(ss.RetryPolicy):
+    """
+    `ss.RetryPolicy` for coroutines, to be used with an AsyncCircuitBreaker:
+    `call` receives a coroutine function and must be awaited.
+    """
+
+    async def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.deadline.check()
+            await self.breaker.admit(self.deadline)
+            self.deadline.check()
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                transient = ss.is_transient_error(e)
+                if transient:
+                    await self.breaker.record_failure()
+                else:
+                    await self.breaker.record_success()
+                delay = self._next_delay(transient, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(self.deadline.cap(delay))
+            else:
+                await self.breaker.record_success()
+                return result
+
+
+class AsyncSearchHedger(ss.SearchHedger):
+    """
+    `ss.SearchHedger` for coroutines: the hedged request goes out on another
+    connection of the same session, and the request which loses the race is
+    cancelled.
+    """
+
+    async def search(self, session, search_queries):
+        self._start_search()
+        primary = asyncio.ensure_future(self._search(session, search_queries))
+        threshold = self.threshold()
+        if threshold is not None:
+            await asyncio.wait([primary], timeout=threshold)
+        if threshold is None or primary.done() or not self._take_hedge():
+            return await primary
+
+        hedge = asyncio.ensure_future(session.search_subtitles(search_queries))
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedge:
+                            self.won += 1
+                        return future.result()
+            return primary.result()  # both failed
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _search(self, session, search_queries):
+        started = time.time()
+        response = await session.search_subtitles(search_queries)
+        self.record(time.time() - started)
+        return response
+
+
+def run_async_engine(to_query, config, multi, analyzer, report,
+                     report_mkv=None, search_cache=None, deadline=None,
+                     downloaded=None):
+    """
+    Same as `ss.run_thread_engine`, but running all searches and downloads
+    concurrently in an asyncio event loop, limited per host by
+    ``config.async_max_requests``. With ``config.adaptive_concurrency`` the
+    number of searches and downloads in flight is adapted below that limit
+    by AsyncConcurrencyControllers. Requests failing with transient errors
+    are retried by AsyncRetryPolicies, and slow searches are hedged by an
+    AsyncSearchHedger if ``config.hedge_percentile`` is set.
+
+    :return: dict with the statistics of the run, as `ss.run_thread_engine`;
+        "http" is the AsyncHTTPClient used.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            _run(loop, to_query, config, multi, analyzer, report, report_mkv,
+                 search_cache, deadline, downloaded or {}))
+    finally:
+        loop.close()
+
+
+async def _run(loop, to_query, config, multi, analyzer, report, report_mkv,
+               search_cache, deadline, downloaded):
+    client = AsyncHTTPClient(config.async_max_requests,
+                             config.http_idle_timeout, config.connect_timeout,
+                             config.read_timeout)
+    session = AsyncOpenSubtitlesSession(client)
+    # hashing, guessit parsing and mkvmerge are blocking, so they run on
+    # threads
+    executor = ThreadPoolExecutor(max_workers=config.parallel_jobs)
+    progress = ss.MovieProgress(list(to_query) + list(downloaded))
+    if config.adaptive_concurrency:
+        search_controller = AsyncConcurrencyController(
+            config.async_max_requests)
+        download_controller = AsyncConcurrencyController(
+            config.async_max_requests)
+    else:
+        search_controller = download_controller = None
+    search_retry, download_retry = ss.create_retry_policies(
+        config, deadline, AsyncRetryPolicy, AsyncCircuitBreaker)
+    hedger = None
+    if config.hedge_percentile:
+        hedger = AsyncSearchHedger(config.hedge_percentile,
+                                   config.hedge_max_rate)
+
+    async def controlled(controller, coroutine):
+        if controller is None:
+            return await coroutine
+        async with controller.slot():
+            return await coroutine
+
+    def embed(item):
+        movie_filename, subtitles = item
+        result = ss.embed_movie(movie_filename, subtitles,
+                                config.mkv_in_place)
+        loop.call_soon_threadsafe(report_mkv, movie_filename, *result)
+
+    def embed_failed(item, exception):
+        movie_filename = item[0]
+        loop.call_soon_threadsafe(report_mkv, movie_filename,
+                                  ss.mkv_filename_of(movie_filename), False,
+                                  str(exception), 0)
+
+    mkv_scheduler = None
+    if report_mkv is not None:
+        mkv_scheduler = ss.MkvScheduler(
+            embed, config.mkv_jobs or config.parallel_jobs,
+            config.mkv_jobs_per_device, on_error=embed_failed)
+
+    def done(movie_filename, language, subtitle_filename, exception=None):
+        report(movie_filename, language, subtitle_filename, exception)
+        subtitles = progress.done(movie_filename, language, subtitle_filename)
+        if subtitles and mkv_scheduler is not None:
+            mkv_scheduler.put((movie_filename, subtitles))
+
+    async def search(movie_languages, kinds=ss.SEARCH_KINDS):
+        if config.two_phase_search and len(kinds) > 1:
+            # see query_open_subtitles_batch
+            results = await search(movie_languages, ('hash',))
+            misses = ss.search_misses(movie_languages, results)
+            if misses:
+                results.update(await search(misses, ('text',)))
+            return results
+
+        search_queries, query_jobs, errors = await loop.run_in_executor(
+            executor, ss.build_search_queries, movie_languages, analyzer,
+            kinds)
+        results = {}
+        if search_cache is not None:
+            results, search_queries, query_jobs = await loop.run_in_executor(
+                executor, search_cache.lookup, search_queries, query_jobs)
+        results.update(errors)
+        if not search_queries:
+            return results
+
+        def send():
+            if hedger is not None:
+                request = hedger.search(session, search_queries)
+            else:
+                request = session.search_subtitles(search_queries)
+            return controlled(search_controller, request)
+
+        with ss.profiled('search', '%d queries' % len(search_queries),
+                         virtual=True):
+            response = await search_retry.call(send)
+        search_results, missing = ss.parse_search_response(
+            response, search_queries, query_jobs)
+        if search_cache is not None:
+            await loop.run_in_executor(
+                executor, search_cache.store, search_queries, query_jobs,
+                dict((job, x) for job, x in search_results.items()
+                     if job not in missing))
+        results.update(search_results)
+        for batch in ss.split_in_halves(missing):
+            results.update(await search(batch, kinds))
+        return results
+
+    async def fetch(url):
+        status, body = await client.request('GET', url)
+        if status != 200:
+            error_class = ss.ServerBusyError \
+                if status in ss.BUSY_STATUSES else IOError
+            error = error_class('HTTP error {0} for {1}'.format(status, url))
+            error.errcode = status
+            raise error
+        return body
+
+    async def download(movie_filename, language, search_results):
+        if isinstance(search_results, Exception):
+            raise search_results  # building its queries failed
+        subtitle_url, subtitle_ext = ss.select_subtitle(search_results)
+        if not subtitle_url:
+            return None
+        subtitle_filename = ss.obtain_subtitle_filename(
+            movie_filename, language, subtitle_ext, multi=multi)
+        with ss.profiled('download', subtitle_filename, virtual=True):
+            body = await download_retry.call(
+                lambda: controlled(download_controller, fetch(subtitle_url)))
+            await loop.run_in_executor(executor, ss.save_gzipped_subtitle,
+                                       io.BytesIO(body), subtitle_filename)
+        return subtitle_filename
+
+    async def search_and_download(movie_languages):
+        try:
+            results = await search(movie_languages)
+        except Exception as e:
+            for movie_filename, language in movie_languages:
+                done(movie_filename, language, None, e)
+            return
+
+        async def download_and_report(movie_filename, language):
+            try:
+                subtitle_filename = await download(
+                    movie_filename, language,
+                    results[(movie_filename, language)])
+            except Exception as e:
+                done(movie_filename, language, None, e)
+            else:
+                done(movie_filename, language, subtitle_filename)
+
+        await asyncio.gather(*[download_and_report(movie_filename, language)
+                               for movie_filename, language in movie_languages])
+
+    try:
+        for job, subtitle_filename in sorted(downloaded.items()):
+            done(job[0], job[1], subtitle_filename)
+        # guessit parsing (in processes) feeds the searches as it goes
+        batches = asyncio.Queue()
+
+        def analyze():
+            try:
+                for batch in ss.iter_analyzed_batches(to_query, config,
+                                                      analyzer):
+                    loop.call_soon_threadsafe(batches.put_nowait, batch)
+            finally:
+                loop.call_soon_threadsafe(batches.put_nowait, None)
+
+        analysis = loop.run_in_executor(executor, analyze)
+        searches = []
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                break
+            searches.append(asyncio.ensure_future(search_and_download(batch)))
+        await analysis
+        await asyncio.gather(*searches)
+        # embeddings are scheduled as movies are done, so all were put
+        if mkv_scheduler is not None:
+            mkv_scheduler.close()
+            await loop.run_in_executor(executor, mkv_scheduler.join)
+        try:
+            await session.logout()
+        except Exception:
+            pass  # best effort: the server expires the token anyway
+    finally:
+        if mkv_scheduler is not None:
+            mkv_scheduler.close()
+        client.close()
+        executor.shutdown(wait=True)
+    return {
+        'http': client,
+        'search_concurrency': search_controller,
+        'download_concurrency': download_controller,
+        'search_retry': search_retry,
+        'download_retry': download_retry,
+        'search_hedging': hedger,
+    }
@@ -1,11 +1,17 @@
 from __future__ import with_statement
 
+import errno
+import json
 import os
 import re
+import socket
 import subprocess
 import sys
-from contextlib import closing
+import threading
+import time
+from contextlib import closing, contextmanager
 from gzip import GzipFile
+from io import BytesIO
 
 import pytest
 import ss
@@ -13,9 +19,15 @@ import ss
 if sys.version_info[0] == 3:
     from io import StringIO
     from unittest.mock import MagicMock, call
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from xmlrpc.server import SimpleXMLRPCServer
 else:
     from StringIO import StringIO
     from mock import MagicMock, call
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
 
 
 def test_find_movie_files(tmpdir):
@@ -39,6 +51,19 @@ def test_find_movie_files(tmpdir):
     ]
 
 
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason='requires symlinks')
+def test_find_movie_files_symlink_loop(tmpdir):
+    tmpdir.join('a', 'video.avi').ensure()
+    tmpdir.join('a', 'b', 'video.mp4').ensure()
+    os.symlink(str(tmpdir.join('a')), str(tmpdir.join('a', 'b', 'loop')))
+
+    found = ss.find_movie_files([str(tmpdir)], recursive=True)
+    # results are streamed
+    assert next(found) in (tmpdir.join('a', 'video.avi'),
+                           tmpdir.join('a', 'b', 'video.mp4'))
+    assert len(list(found)) == 1
+
+
 def test_has_subtitles(tmpdir):
     movie_filename = str(tmpdir.join('video.avi').ensure())
     assert not ss.has_subtitle(movie_filename, 'eng', multi=False)
@@ -52,6 +77,45 @@ def test_has_subtitles(tmpdir):
     assert ss.has_subtitle(movie_filename, 'eng', multi=True)
 
 
+def test_subtitle_index(tmpdir, mocker):
+    for name in ['video.avi', 'video.SRT', 'Video.eng.forced.srt',
+                 'Parks.S01E01.HI.pob.sub', 'Parks.S01E01.avi', 'other.spa.srt']:
+        tmpdir.join(name).ensure()
+
+    index = ss.SubtitleIndex()
+    movie_filename = str(tmpdir / 'video.avi')
+    assert index.has_subtitle(movie_filename, 'eng', multi=False)
+    assert index.has_subtitle(movie_filename, 'eng', multi=True)
+    assert not index.has_subtitle(movie_filename, 'pob', multi=True)
+
+    movie_filename = str(tmpdir / 'Parks.S01E01.avi')
+    assert index.has_subtitle(movie_filename, 'pob', multi=True)
+    assert index.has_subtitle(movie_filename, 'POB', multi=False)
+    assert not index.has_subtitle(movie_filename, 'spa', multi=False)
+    assert not index.has_subtitle(movie_filename, 'eng', multi=False)
+    assert not index.has_subtitle(str(tmpdir / 'missing' / 'foo.avi'), 'eng',
+                                  multi=False)
+
+    # other movies whose names start with the movie name don't count
+    tmpdir.join('Alien.Resurrection.eng.srt').ensure()
+    tmpdir.join('Alien.Resurrection.srt').ensure()
+    index = ss.SubtitleIndex()
+    alien = str(tmpdir / 'Alien.avi')
+    assert not index.has_subtitle(alien, 'eng', multi=True)
+    assert not index.has_subtitle(alien, 'eng', multi=False)
+    assert index.has_subtitle(str(tmpdir / 'Alien.Resurrection.avi'), 'eng',
+                              multi=True)
+
+    # listings from find_movie_files are reused instead of listing again
+    listings = {}
+    movies = list(ss.find_movie_files([str(tmpdir)], listings=listings))
+    listdir_mock = mocker.patch('os.listdir', autospec=True)
+    index = ss.SubtitleIndex(listings)
+    assert [index.has_subtitle(x, 'pob', multi=True) for x in sorted(movies)] \
+        == [True, False]
+    assert not listdir_mock.called
+
+
 def test_query_open_subtitles(tmpdir, mocker):
     filename = tmpdir.join('Drive (2011) BDRip XviD-COCAIN.avi').ensure()
 
@@ -64,9 +128,12 @@ def test_query_open_subtitles(tmpdir, mocker):
         data=[{'SubFileName': 'movie.srt'}])
 
     search_results = ss.query_open_subtitles(str(filename), 'eng')
+    transport = rpc_mock.call_args[1]['transport']
     rpc_mock.assert_called_once_with(
-        'http://api.opensubtitles.org/xml-rpc', use_datetime=True,
-        allow_none=True, verbose=0)
+        'http://api.opensubtitles.org/xml-rpc', transport=transport,
+        use_datetime=True, allow_none=True, verbose=0)
+    assert isinstance(transport, ss.TimeoutTransport)
+    assert (transport.connect_timeout, transport.read_timeout) == (10, 60)
     server.LogIn.assert_called_once_with('', '', 'en', 'ss v' + ss.__version__)
     expected_calls = [
         call('TOKEN',
@@ -81,6 +148,463 @@ def test_query_open_subtitles(tmpdir, mocker):
     assert search_results == [{'SubFileName': 'movie.srt'}]
 
 
+def test_session_pool(mocker):
+    rpc_mock = mocker.patch('ss.ServerProxy', autospec=True)
+    rpc_mock.return_value = server = MagicMock(name='MockServer')
+    server.LogIn.side_effect = [dict(token='TOKEN1'), dict(token='TOKEN2')]
+    server.SearchSubtitles.return_value = dict(data=[])
+
+    pool = ss.SessionPool(2)
+    for i in range(3):
+        with pool.session() as session:
+            assert session.search_subtitles([{'query': 'foo'}]) == dict(data=[])
+    assert server.LogIn.call_count == 1
+    assert pool.login_count == 1
+
+    # expired tokens are renewed and the call retried transparently
+    server.SearchSubtitles.side_effect = [dict(status='406 No session'),
+                                          dict(data=[])]
+    with pool.session() as session:
+        assert session.search_subtitles([{'query': 'foo'}]) == dict(data=[])
+    assert server.SearchSubtitles.call_args_list[-2:] == [
+        call('TOKEN1', [{'query': 'foo'}]),
+        call('TOKEN2', [{'query': 'foo'}]),
+    ]
+
+    pool.close()
+    server.LogOut.assert_called_once_with('TOKEN2')
+
+
+def test_server_busy(mocker):
+    rpc_mock = mocker.patch('ss.ServerProxy', autospec=True)
+    rpc_mock.return_value = server = MagicMock(name='MockServer')
+    server.LogIn.return_value = dict(token='TOKEN')
+    server.SearchSubtitles.return_value = dict(status='429 Too many requests')
+
+    session = ss.OpenSubtitlesSession()
+    with pytest.raises(ss.ServerBusyError) as e:
+        session.search_subtitles([{'query': 'foo'}])
+    assert ss.is_throttling_error(e.value)
+    assert not ss.is_throttling_error(IOError('not found'))
+
+
+def test_concurrency_controller(mocker):
+    time_mock = mocker.patch('time.time', return_value=100.0)
+    controller = ss.ConcurrencyController(8)
+    assert controller.limit == 4
+
+    # additive increase after a full "window" of healthy requests
+    for i in range(4):
+        controller.record(100.0, 0.1)
+    assert controller.limit == 5
+    for i in range(5 + 6 + 7 + 8 + 8):
+        controller.record(100.0, 0.1)
+    assert controller.limit == 8  # never above the maximum
+
+    # throttling halves the limit once for requests started before the cut
+    time_mock.return_value = 101.0
+    controller.record(100.0, 0.1, ss.ServerBusyError('busy'))
+    controller.record(100.0, 0.1, ss.ServerBusyError('busy'))
+    assert controller.limit == 4
+    # ... while unrelated errors are ignored
+    controller.record(101.0, 0.1, IOError('not found'))
+    assert controller.limit == 4
+
+    # requests much slower than average also mean the server is struggling
+    time_mock.return_value = 102.0
+    controller.record(101.5, 5.0)
+    assert controller.limit == 2
+    controller.record(102.0, 0.1, ss.ServerBusyError('busy'))
+    controller.record(102.0, 0.1, ss.ServerBusyError('busy'))
+    assert controller.limit == 1  # never below the minimum
+
+    assert controller.levels == [4, 5, 6, 7, 8, 4, 2, 1]
+    assert controller.decreases == 4
+    assert str(controller) == '1 (started at 4, range 1-8, 4 decreases)'
+
+    # slots are held while the block runs, and released on errors
+    with pytest.raises(ss.ServerBusyError):
+        with controller.slot():
+            assert controller._in_flight == 1
+            raise ss.ServerBusyError('busy')
+    assert controller._in_flight == 0
+
+
+def test_read_timeout():
+    # the connection is accepted (backlog) but the server never answers
+    with closing(socket.socket()) as server:
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        url = 'http://127.0.0.1:%d/sub.gz' % server.getsockname()[1]
+        with closing(ss.HTTPConnectionPool(read_timeout=0.1)) as pool:
+            with pytest.raises(socket.timeout) as e:
+                pool.urlopen(url)
+    assert ss.is_transient_error(e.value)
+
+
+def test_deadline(mocker):
+    time_mock = mocker.patch('time.time', return_value=100.0)
+    deadline = ss.Deadline(60)
+    deadline.check()
+    time_mock.return_value = 160.0
+    with pytest.raises(ss.DeadlineExceeded):
+        deadline.check()
+    assert not ss.Deadline(0).expired()
+
+    # no attempt is started after the deadline
+    func = MagicMock()
+    with pytest.raises(ss.DeadlineExceeded):
+        ss.RetryPolicy(deadline=deadline).call(func)
+    assert not func.called
+    assert deadline.remaining() == 0.0
+    assert ss.Deadline().remaining() is None
+
+    # waits between attempts end by the deadline
+    time_mock.return_value = 100.0
+    deadline = ss.Deadline(10)
+    sleep_mock = mocker.patch('time.sleep',
+                              side_effect=lambda seconds: setattr(
+                                  time_mock, 'return_value',
+                                  time_mock.return_value + seconds))
+    mocker.patch('random.uniform', side_effect=lambda a, b: 30.0)
+    func = MagicMock(side_effect=socket.timeout('timed out'))
+    with pytest.raises(ss.DeadlineExceeded):
+        ss.RetryPolicy(deadline=deadline).call(func)
+    assert func.call_count == 1
+    assert sleep_mock.call_args_list == [call(10.0)]
+
+    # so do waits for an open circuit
+    time_mock.return_value = 100.0
+    deadline = ss.Deadline(10)
+    breaker = ss.CircuitBreaker(failures=1, timeout=30)
+    breaker.record_failure()
+    wait_mock = mocker.patch.object(
+        breaker._condition, 'wait', side_effect=lambda timeout: setattr(
+            time_mock, 'return_value', time_mock.return_value + timeout))
+    func = MagicMock()
+    with pytest.raises(ss.DeadlineExceeded):
+        ss.RetryPolicy(breaker=breaker, deadline=deadline).call(func)
+    assert not func.called
+    assert wait_mock.call_args_list == [call(10.0)]
+
+
+def test_retry_policy(mocker):
+    sleep_mock = mocker.patch('time.sleep')
+    mocker.patch('random.uniform', side_effect=lambda a, b: b)
+    func = MagicMock(side_effect=[socket.timeout('timed out'),
+                                  ss.ServerBusyError('busy'), 'result'])
+
+    retry = ss.RetryPolicy(attempts=3)
+    assert retry.call(func, 'arg') == 'result'
+    assert func.call_args_list == [call('arg')] * 3
+    # exponential backoff with jitter
+    assert sleep_mock.call_args_list == [call(0.5), call(1.0)]
+    assert retry.retries == 2 and retry.gave_up == 0
+
+    # errors which will happen again are not retried
+    func = MagicMock(side_effect=IOError('HTTP error 404 (Not Found)'))
+    with pytest.raises(IOError):
+        retry.call(func)
+    assert func.call_count == 1
+
+    func = MagicMock(side_effect=socket.timeout('timed out'))
+    with pytest.raises(socket.timeout):
+        retry.call(func)
+    assert func.call_count == 3
+    assert retry.retries == 4 and retry.gave_up == 1
+    assert str(retry) == \
+        '4 retries, 1 gave up; circuit opened 0 times (paused 0.0s)'
+
+
+def test_circuit_breaker(mocker):
+    time_mock = mocker.patch('time.time', return_value=100.0)
+    breaker = ss.CircuitBreaker(failures=2, timeout=30)
+    breaker.admit()
+    breaker.record_failure()
+    breaker.admit()
+    breaker.record_failure()
+    assert breaker.opened == 1
+
+    # open: callers wait for the timeout, then one of them probes the server
+    def wait(timeout):
+        time_mock.return_value += timeout
+    mocker.patch.object(breaker._condition, 'wait', side_effect=wait)
+    breaker.admit()
+    assert time_mock.return_value == 130.0
+    assert breaker.paused == 30.0
+    assert breaker._state == 'half-open'
+
+    # the probe fails, so callers which were waiting for it give up
+    def fail_probe(timeout):
+        breaker._record_failure()
+    breaker._condition.wait.side_effect = fail_probe
+    with pytest.raises(ss.CircuitOpenError):
+        breaker.admit()
+    assert breaker.opened == 2
+
+    # a successful probe closes the circuit
+    breaker._condition.wait.side_effect = wait
+    breaker.admit()
+    breaker.record_success()
+    assert breaker._state == 'closed'
+    breaker.admit()
+
+
+def test_search_hedger():
+    class FakePool(object):
+        def __init__(self, event=None):
+            self.event = event
+            self.queries = []
+
+        @contextmanager
+        def session(self):
+            yield self
+
+        def search_subtitles(self, search_queries):
+            self.queries.append(search_queries)
+            if self.event is not None:
+                self.event.wait(5)
+            return dict(data=[], pool=self)
+
+        def close(self):
+            pass
+
+    stuck = threading.Event()
+    pool, hedge_pool = FakePool(stuck), FakePool()
+    hedger = ss.SearchHedger(percentile=90, max_rate=0.1,
+                             hedge_pool=hedge_pool, min_samples=2)
+    try:
+        # not hedged while there are not enough samples
+        assert hedger.threshold() is None
+        stuck.set()
+        for i in range(9):
+            assert hedger.search(pool, ['q%d' % i])['pool'] is pool
+        assert hedger.threshold() < 1
+        assert hedge_pool.queries == []
+
+        # a search slower than the percentile is sent again; first reply wins
+        stuck.clear()
+        assert hedger.search(pool, ['slow'])['pool'] is hedge_pool
+        assert hedge_pool.queries == [['slow']]
+        assert str(hedger) == '1 of 10 searches hedged, 1 won'
+
+        # ... but at most 10% of the searches are hedged
+        timer = threading.Timer(0.2, stuck.set)
+        timer.start()
+        assert hedger.search(pool, ['slow again'])['pool'] is pool
+        assert hedger.hedged == 1
+    finally:
+        stuck.set()
+        hedger.close()
+
+
+def test_search_hedger_close():
+    """
+    Closing the hedger waits for the requests which lost the race before
+    logging out the sessions of the hedge pool.
+    """
+    log = []
+
+    class FakePool(object):
+        def __init__(self, name, delays):
+            self.name = name
+            self.delays = delays
+
+        @contextmanager
+        def session(self):
+            yield self
+
+        def search_subtitles(self, search_queries):
+            time.sleep(self.delays.pop(0))
+            log.append(self.name)
+            return dict(data=[], pool=self.name)
+
+        def close(self):
+            log.append('closed')
+
+    pool = FakePool('primary', [0, 0.5])
+    hedge_pool = FakePool('hedge', [0])
+    hedger = ss.SearchHedger(percentile=50, max_rate=1,
+                             hedge_pool=hedge_pool, min_samples=1)
+    assert hedger.search(pool, ['fast'])['pool'] == 'primary'
+    assert hedger.search(pool, ['slow'])['pool'] == 'hedge'
+    hedger.close()
+    assert log == ['primary', 'hedge', 'primary', 'closed']
+
+
+def test_query_open_subtitles_batch(tmpdir, mocker):
+    drive = str(tmpdir.join('Drive (2011) BDRip XviD-COCAIN.avi').ensure())
+    parks = str(tmpdir.join('Parks.and.Recreation.S05E13.HDTV.x264-LOL.avi')
+                .ensure())
+
+    mocker.patch('ss.calculate_hash_for_file', autospec=True,
+                 side_effect=lambda name: 'h%d' % len(name))
+    server = MagicMock(name='MockServer')
+    mocker.patch('ss.ServerProxy', autospec=True, return_value=server)
+    server.LogIn.return_value = dict(token='TOKEN')
+
+    drive_hash = 'h%d' % len(drive)
+    server.SearchSubtitles.return_value = dict(data=[
+        # matched by QueryNumber (text query for parks/pob)
+        dict(QueryNumber='2', SubDownloadLink='parks-pob',
+             SeriesSeason='5', SeriesEpisode='13'),
+        # wrong episode, filtered out
+        dict(QueryNumber='0', SubDownloadLink='parks-eng-wrong',
+             SeriesSeason='5', SeriesEpisode='1'),
+        # matched by hash
+        dict(MovieHash=drive_hash, SubLanguageID='eng', IDMovieImdb='1',
+             SubDownloadLink='drive-eng-hash'),
+        # matched by imdb id learned from the hash result
+        dict(MovieHash='0', SubLanguageID='eng', IDMovieImdb='1',
+             SubDownloadLink='drive-eng-text'),
+    ])
+
+    jobs = [(parks, 'eng'), (parks, 'pob'), (drive, 'eng')]
+    results = ss.query_open_subtitles_batch(jobs)
+    assert server.SearchSubtitles.call_count == 1
+    queries = server.SearchSubtitles.call_args[0][1]
+    assert [x['sublanguageid'] for x in queries] == ['eng', 'eng', 'pob',
+                                                     'pob', 'eng', 'eng']
+
+    links = dict((job, [x['SubDownloadLink'] for x in results[job]])
+                 for job in jobs)
+    assert links == {
+        (parks, 'eng'): [],
+        (parks, 'pob'): ['parks-pob'],
+        (drive, 'eng'): ['drive-eng-hash', 'drive-eng-text'],
+    }
+
+
+def test_query_open_subtitles_batch_errors(tmpdir, mocker):
+    """
+    A movie whose queries can't be built fails alone, not its whole batch.
+    """
+    drive = str(tmpdir.join('Drive (2011) BDRip XviD-COCAIN.avi').ensure())
+    tiny = str(tmpdir.join('Tiny (2011).avi').ensure())
+
+    def calculate_hash(name):
+        if name == tiny:
+            raise ValueError('too small')
+        return 'h1'
+
+    mocker.patch('ss.calculate_hash_for_file', autospec=True,
+                 side_effect=calculate_hash)
+    server = MagicMock(name='MockServer')
+    mocker.patch('ss.ServerProxy', autospec=True, return_value=server)
+    server.LogIn.return_value = dict(token='TOKEN')
+    server.SearchSubtitles.return_value = dict(data=[
+        dict(QueryNumber='0', SubDownloadLink='drive-eng')])
+
+    results = ss.query_open_subtitles_batch([(drive, 'eng'), (tiny, 'eng')])
+    queries = server.SearchSubtitles.call_args[0][1]
+    assert len(queries) == 2
+    assert [x['SubDownloadLink'] for x in results[(drive, 'eng')]] == \
+        ['drive-eng']
+    assert isinstance(results[(tiny, 'eng')], ValueError)
+    with pytest.raises(ValueError):
+        ss.query_open_subtitles(tiny, 'eng')
+
+    # searching by name is still possible without a hash
+    server.SearchSubtitles.reset_mock()
+    results = ss.query_open_subtitles_batch([(tiny, 'eng')], two_phase=True)
+    assert server.SearchSubtitles.call_count == 1
+    assert 'query' in server.SearchSubtitles.call_args[0][1][0]
+    assert len(results[(tiny, 'eng')]) == 1
+
+
+def test_query_open_subtitles_batch_controller(tmpdir, mocker):
+    """
+    Only the SearchSubtitles calls run in a slot of the controller, not the
+    hashing of the movies.
+    """
+    drive = str(tmpdir.join('Drive (2011) BDRip XviD-COCAIN.avi').ensure())
+    controller = ss.ConcurrencyController(1)
+    in_flight = []
+
+    def calculate_hash(name):
+        in_flight.append(('hash', controller._in_flight))
+        return 'h1'
+
+    def search_subtitles(token, queries):
+        in_flight.append(('search', controller._in_flight))
+        return dict(data=[])
+
+    mocker.patch('ss.calculate_hash_for_file', autospec=True,
+                 side_effect=calculate_hash)
+    server = MagicMock(name='MockServer')
+    mocker.patch('ss.ServerProxy', autospec=True, return_value=server)
+    server.LogIn.return_value = dict(token='TOKEN')
+    server.SearchSubtitles.side_effect = search_subtitles
+
+    ss.query_open_subtitles_batch([(drive, 'eng')], two_phase=True,
+                                  controller=controller)
+    assert in_flight == [('hash', 0), ('search', 1), ('search', 1)]
+    assert controller._in_flight == 0
+
+
+def test_movie_analyzer(tmpdir, mocker):
+    movie_filename = str(tmpdir.join('Drive (2011) BDRip XviD-COCAIN.avi')
+                         .ensure())
+    hash_mock = mocker.patch('ss.calculate_hash_for_file', autospec=True,
+                             return_value='13ab')
+    import guessit
+    guessit_spy = mocker.spy(guessit, 'guessit')
+
+    analyzer = ss.MovieAnalyzer()
+    for language in ['eng', 'pob', 'spa']:
+        assert analyzer.guessit_query(movie_filename, language) == \
+            ss.obtain_guessit_query(movie_filename, language)
+        assert analyzer.movie_hash_query(movie_filename, language) == dict(
+            moviehash='13ab', moviebytesize='0', sublanguageid=language)
+
+    # 3 calls from obtain_guessit_query above plus 1 from the analyzer
+    assert guessit_spy.call_count == 4
+    assert hash_mock.call_count == 1
+    assert analyzer.calls == {'guessit': 1, 'hash': 1}
+    assert analyzer.saved == {'guessit': 2, 'hash': 2}
+
+
+def test_analyze_in_processes(tmpdir):
+    names = ['Drive (2011) BDRip XviD-COCAIN.avi',
+             'Modern.Family.S05E01.HDTV.x264-LOL.mp4',
+             'Project.X.2012.DVDRip.XviD-AMIABLE.avi',
+             'Parks.and.Recreation.S05E13.HDTV.x264-LOL.mp4',
+             'Unknown.mp4']
+    movies = [str(tmpdir / x) for x in names]
+    cache = ss.GuessitCache(str(tmpdir / 'guesses.sqlite'), version='1.0')
+    with closing(cache):
+        analyzer = ss.MovieAnalyzer(guessit_cache=cache)
+        analyzed = list(analyzer.analyze(movies, processes=2, chunk_size=2))
+        assert analyzed == [movies[0:2], movies[2:4], movies[4:]]
+        assert analyzer.calls['guessit'] == 5
+        for movie in movies:
+            assert analyzer.guessit_query(movie, 'eng') == \
+                ss.obtain_guessit_query(movie, 'eng')
+        assert analyzer.calls['guessit'] == 5
+
+        # guesses are cached per name and guessit version
+        analyzer = ss.MovieAnalyzer(guessit_cache=cache)
+        assert list(analyzer.analyze(movies + movies[:1])) == [movies]
+        assert analyzer.calls['guessit'] == 0
+        assert cache.lookup([names[1]]) == {names[1]: {
+            'type': 'episode', 'title': 'Modern Family', 'season': 5,
+            'episode': 1, 'release_group': 'LOL'}}
+        cache._version = '2.0'
+        assert cache.lookup(names) == {}
+
+
+def test_plan_search_batches():
+    jobs = [('movie%d' % i, lang) for i in range(5) for lang in ('eng', 'pob')]
+    batches = ss.plan_search_batches(jobs, batch_size=6)
+    assert [len(x) for x in batches] == [3, 3, 3, 1]
+    assert sorted(sum(batches, [])) == sorted(jobs)
+    assert ss.plan_search_batches(jobs, batch_size=1) == [[x] for x in
+                                                          sorted(jobs)]
+    # hash-only or text-only searches send one query per pair
+    batches = ss.plan_search_batches(jobs, batch_size=6, queries_per_pair=1)
+    assert [len(x) for x in batches] == [6, 4]
+
+
 def test_obtain_guessit_query():
     assert ss.obtain_guessit_query('Drive (2011) BDRip XviD-COCAIN.avi',
                                    'eng') == {
@@ -218,6 +742,8 @@ def test_configuration():
     assert ss.Configuration(mkv=True) != ss.Configuration()
     assert ss.Configuration(skip=True) != ss.Configuration()
     assert ss.Configuration(parallel_jobs=3) != ss.Configuration()
+    assert ss.Configuration(adaptive_concurrency=False) != \
+        ss.Configuration()
 
 
 def test_check_mkv_installed(mocker):
@@ -232,6 +758,23 @@ def test_check_mkv_installed(mocker):
 
     assert not ss.check_mkv_installed()
 
+    ss.check_output.side_effect = OSError(errno.ENOENT, 'No such file')
+    assert not ss.check_mkv_installed()
+
+
+def test_lazy_imports():
+    """
+    Heavy dependencies are imported only when needed, keeping the startup of
+    ss fast.
+    """
+    code = ('import sys, ss; '
+            'print(",".join(sorted(set(sys.modules) & set(%r))))' %
+            (['guessit', 'colorama', 'sqlite3', 'concurrent.futures',
+              'urllib.request', 'numpy', 'ss_async'],))
+    output = subprocess.check_output([sys.executable, '-c', code],
+                                     cwd=os.path.dirname(ss.__file__))
+    assert output.decode('ascii').strip() == ''
+
 
 def test_script_main():
     """
@@ -261,13 +804,261 @@ def test_download_subtitle(tmpdir, mocker):
     urlopen_mock.return_value = open(gzip_filename, 'rb')
     ss.download_subtitle(url, subtitle_filename)
 
-    urlopen_mock.assert_called_once_with(url)
+    urlopen_mock.assert_called_once_with(url, timeout=ss.READ_TIMEOUT)
+
+    # a stalled server doesn't hang the download forever
+    urlopen_mock.reset_mock()
+    urlopen_mock.return_value = open(gzip_filename, 'rb')
+    ss.download_subtitle(url, subtitle_filename, timeout=5)
+    urlopen_mock.assert_called_once_with(url, timeout=5)
 
     assert os.path.isfile(subtitle_filename)
     with open(subtitle_filename, 'rb') as f:
         assert f.read() == sub_contents
 
 
+def test_download_subtitle_streaming(tmpdir, mocker):
+    subtitle_filename = str(tmpdir / 'subtitle.srt')
+    contents = os.urandom(100 * 1024)
+
+    gzip_filename = str(tmpdir / 'sub.gz')
+    with closing(GzipFile(gzip_filename, 'wb')) as f:
+        f.write(contents[:60 * 1024])
+    # multiple members
+    with closing(GzipFile(gzip_filename, 'ab')) as f:
+        f.write(contents[60 * 1024:])
+
+    urlopen_mock = mocker.patch('ss.urlopen')
+    urlopen_mock.return_value = open(gzip_filename, 'rb')
+    ss.download_subtitle('http://server.com/foo.gz', subtitle_filename)
+    with open(subtitle_filename, 'rb') as f:
+        assert f.read() == contents
+
+    # truncated downloads do not touch the existing subtitle nor leave
+    # temporary files behind
+    with open(gzip_filename, 'rb') as f:
+        truncated = f.read()[:1000]
+    with open(gzip_filename, 'wb') as f:
+        f.write(truncated)
+    urlopen_mock.return_value = open(gzip_filename, 'rb')
+    with pytest.raises(IOError):
+        ss.download_subtitle('http://server.com/foo.gz', subtitle_filename)
+    assert sorted(os.listdir(str(tmpdir))) == ['sub.gz', 'subtitle.srt']
+    with open(subtitle_filename, 'rb') as f:
+        assert f.read() == contents
+
+
+@pytest.fixture
+def subtitles_server():
+    """
+    Local HTTP/1.1 server with keep-alive support serving gzipped subtitles;
+    "/redirect/<name>" redirects to "/<name>".
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path.startswith('/redirect/'):
+                self.send_response(302)
+                self.send_header('Location', self.path[len('/redirect'):])
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            buf = BytesIO()
+            with closing(GzipFile(fileobj=buf, mode='wb')) as f:
+                f.write(self.path.encode('ascii') * 100)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(buf.getvalue())))
+            self.end_headers()
+            self.wfile.write(buf.getvalue())
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_connection_pool(tmpdir, subtitles_server):
+    pool = ss.HTTPConnectionPool(max_per_host=2)
+    with closing(pool):
+        for name in ['a.gz', 'b.gz', 'redirect/c.gz']:
+            subtitle_filename = str(tmpdir / (name.split('/')[-1] + '.srt'))
+            ss.download_subtitle(subtitles_server + '/' + name,
+                                 subtitle_filename, http_pool=pool)
+            with open(subtitle_filename, 'rb') as f:
+                assert f.read() == ('/' + name.split('/')[-1]).encode() * 100
+
+        # the redirect counts as one request
+        assert (pool.requests, pool.reused) == (4, 3)
+        assert pool.reuse_rate == 0.75
+
+        with pytest.raises(IOError):
+            pool.urlopen('http://127.0.0.1:1/foo.gz')
+
+    # idle connections past the timeout are not reused
+    pool = ss.HTTPConnectionPool(idle_timeout=0)
+    with closing(pool):
+        for name in ['a.gz', 'b.gz']:
+            with closing(pool.urlopen(subtitles_server + '/' + name)) as f:
+                f.read()
+            time.sleep(0.01)
+        assert (pool.requests, pool.reused) == (2, 0)
+
+
+class FakeOpenSubtitles(object):
+    """
+    Stand-in for the OpenSubtitles XML-RPC API: text queries containing
+    one of the titles in ``subtitles`` (and hash queries of a movie hash in
+    ``hashes``) return a subtitle served by `subtitles_server`.
+    """
+
+    def __init__(self, subtitles_url):
+        self.subtitles_url = subtitles_url
+        self.subtitles = {}  # title -> languages
+        self.hashes = {}  # movie hash -> title
+        self.calls = []
+        self.queries = []
+
+    def LogIn(self, username, password, language, useragent):
+        self.calls.append('LogIn')
+        return {'token': 'TOKEN', 'status': '200 OK'}
+
+    def LogOut(self, token):
+        self.calls.append('LogOut')
+        return {'status': '200 OK'}
+
+    def SearchSubtitles(self, token, queries):
+        self.calls.append('SearchSubtitles')
+        self.queries.append(queries)
+        data = []
+        for i, query in enumerate(queries):
+            for title, languages in self.subtitles.items():
+                language = query['sublanguageid']
+                found = title in query.get('query', '') or \
+                    self.hashes.get(query.get('moviehash')) == title
+                if found and language in languages:
+                    data.append(dict(
+                        QueryNumber=str(i), SubLanguageID=language,
+                        SeriesSeason=str(query.get('season', 0)),
+                        SeriesEpisode=str(query.get('episode', 0)),
+                        SubFormat='srt', SubDownloadLink='{0}/{1}.{2}.gz'
+                        .format(self.subtitles_url, title, language)))
+        return {'status': '200 OK', 'data': data or False}
+
+
+@pytest.fixture
+def opensubtitles_server(subtitles_server, monkeypatch):
+    fake = FakeOpenSubtitles(subtitles_server)
+    server = SimpleXMLRPCServer(('127.0.0.1', 0), logRequests=False,
+                                allow_none=True)
+    server.register_instance(fake)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(ss, 'OPENSUBTITLES_URI',
+                        'http://127.0.0.1:%d/RPC2' % server.server_address[1])
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_engines(tmpdir, mocker, opensubtitles_server, engine):
+    if engine == 'async' and sys.version_info < (3, 5):
+        pytest.skip('async engine requires Python 3.5')
+    opensubtitles_server.subtitles = {'Drive': ['eng', 'pob'],
+                                      'Parks': ['eng']}
+    movies = ['Drive.2011.avi', 'Parks.S01E01.avi', 'Unknown.avi']
+    for movie in movies:
+        with open(str(tmpdir / movie), 'wb') as f:
+            f.write(os.urandom(128 * 1024))
+
+    config = ss.Configuration(languages=['eng', 'pob'], engine=engine,
+                              search_batch_size=4, hedge_percentile=95,
+                              cache_dir=str(tmpdir / 'cache'))
+    mocker.patch('ss.load_configuration', return_value=config)
+    stream = StringIO()
+    assert ss.main(['ss', '--verbose', str(tmpdir)], stream=stream) == 0
+    output = stream.getvalue()
+
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'Drive.2011.avi', 'Drive.2011.eng.srt', 'Drive.2011.pob.srt',
+        'Parks.S01E01.avi', 'Parks.S01E01.eng.srt', 'Unknown.avi', 'cache']
+    with open(str(tmpdir / 'Drive.2011.pob.srt'), 'rb') as f:
+        assert f.read() == b'/Drive.pob.gz' * 100
+    assert len(re.findall(r'\[OK\]', output)) == 3
+    assert len(re.findall(r'\[Not found\]', output)) == 3
+    # one session per concurrent worker (thread) or per run (async)
+    logins = opensubtitles_server.calls.count('LogIn')
+    assert 1 <= logins <= (3 if engine == 'thread' else 1)
+    assert opensubtitles_server.calls.count('LogOut') == logins
+    assert opensubtitles_server.calls.count('SearchSubtitles') == 3
+    assert re.search(r'Downloads: \d+ requests', output)
+    assert re.search(r'Search concurrency: \d+ \(started at', output)
+    # not enough searches to measure their latency
+    assert 'Search hedging: 0 of 3 searches hedged, 0 won' in output
+
+    # search results are cached between runs, unless --refresh is given
+    stream = StringIO()
+    assert ss.main(['ss', '--verbose', str(tmpdir)], stream=stream) == 0
+    assert opensubtitles_server.calls.count('SearchSubtitles') == 3
+    assert len(re.findall(r'\[OK\]', stream.getvalue())) == 3
+    assert 'Search cache: 6 hits, 0 misses' in stream.getvalue()
+    assert 'Movie analysis: 0 guessit parses (6 saved, 3 cached)' in \
+        stream.getvalue()
+    stream = StringIO()
+    assert ss.main(['ss', '--refresh', '--profile', str(tmpdir)],
+                   stream=stream) == 0
+    assert opensubtitles_server.calls.count('SearchSubtitles') == 6
+    for stage in ('walk', 'search', 'download'):
+        assert re.search(r'^%s\s+\d+ ' % stage, stream.getvalue(), re.M)
+
+
+@pytest.mark.parametrize('engine', ['thread', 'async'])
+def test_two_phase_search(tmpdir, mocker, opensubtitles_server, engine):
+    if engine == 'async' and sys.version_info < (3, 5):
+        pytest.skip('async engine requires Python 3.5')
+    opensubtitles_server.subtitles = {'Drive': ['eng', 'pob'],
+                                      'Parks': ['eng']}
+    movies = ['Drive.2011.avi', 'Parks.S01E01.avi', 'Unknown.avi']
+    for movie in movies:
+        with open(str(tmpdir / movie), 'wb') as f:
+            f.write(os.urandom(128 * 1024))
+    drive_hash = ss.calculate_hash_for_file(str(tmpdir / 'Drive.2011.avi'))
+    opensubtitles_server.hashes = {drive_hash: 'Drive'}
+
+    config = ss.Configuration(languages=['eng', 'pob'], engine=engine,
+                              search_batch_size=4, two_phase_search=True,
+                              cache_dir=str(tmpdir / 'cache'))
+    mocker.patch('ss.load_configuration', return_value=config)
+    stream = StringIO()
+    assert ss.main(['ss', '--verbose', str(tmpdir)], stream=stream) == 0
+    output = stream.getvalue()
+
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'Drive.2011.avi', 'Drive.2011.eng.srt', 'Drive.2011.pob.srt',
+        'Parks.S01E01.avi', 'Parks.S01E01.eng.srt', 'Unknown.avi', 'cache']
+    # one query per pair in each call: the hashes of 4 pairs, then the text
+    # queries of the pairs not found by hash
+    queries = sorted(opensubtitles_server.queries, key=len, reverse=True)
+    assert [len(x) for x in queries] == [4, 2, 2, 2]
+    hash_calls = [x for x in queries if all('moviehash' in q for q in x)]
+    text_calls = [x for x in queries if all('query' in q for q in x)]
+    assert (len(hash_calls), len(text_calls)) == (2, 2)
+    assert not any('Drive' in q['query'] for x in text_calls for q in x)
+    # Drive was found by its hash, so its name was never parsed
+    assert 'Movie analysis: 2 guessit parses' in output
+
+
 def test_calculate_hash_for_file(tmpdir):
     # we don't actually test the algorithm since we copied from the
     # reference implementation, we just call it with dummy data that we know
@@ -281,6 +1072,167 @@ def test_calculate_hash_for_file(tmpdir):
     assert ss.calculate_hash_for_file(filename) == '010101010108b000'
 
 
+def reference_hash_for_file(name):
+    """
+    Original implementation from the OpenSubtitles wiki, reading one 64 bit
+    word at a time.
+    """
+    import struct
+    filesize = os.path.getsize(name)
+    hash = filesize
+    with open(name, 'rb') as f:
+        for offset in (0, filesize - 65536):
+            f.seek(offset)
+            for x in range(65536 // 8):
+                (l_value,) = struct.unpack('<q', f.read(8))
+                hash = (hash + l_value) & 0xFFFFFFFFFFFFFFFF
+    return '%016x' % hash
+
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_calculate_hash_matches_reference(tmpdir, monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(ss, '_numpy', [None])
+
+    filename = str(tmpdir / u'foo.x')
+    random_data = os.urandom(300 * 1024 + 3)
+    for data in [random_data, b'\xff' * (128 * 1024)]:
+        with open(filename, 'wb') as f:
+            f.write(data)
+        assert ss.calculate_hash_for_file(filename) == \
+            reference_hash_for_file(filename)
+
+
+def test_hash_cache(tmpdir, mocker):
+    movie_filename = str(tmpdir / 'movie.avi')
+    with open(movie_filename, 'wb') as f:
+        f.write(b'\x01' * (128 * 1024))
+    cache_filename = str(tmpdir / 'cache' / 'hashes.sqlite')
+    spy = mocker.spy(ss, 'calculate_hash_for_file')
+
+    with closing(ss.HashCache(cache_filename)) as cache:
+        expected = ss.calculate_hash_for_file(movie_filename)
+        assert not os.path.isfile(cache_filename)
+        assert cache.get_hash(movie_filename) == expected
+        assert cache.get_hash(movie_filename) == expected
+        assert spy.call_count == 2
+
+    # persisted across runs
+    with closing(ss.HashCache(cache_filename)) as cache:
+        assert cache.get_hash(movie_filename) == expected
+        assert spy.call_count == 2
+        assert (cache.hits, cache.misses) == (1, 0)
+
+        # changed files are hashed again
+        with open(movie_filename, 'ab') as f:
+            f.write(b'\x01' * 8)
+        changed = cache.get_hash(movie_filename)
+        assert changed != expected
+        assert spy.call_count == 3
+        assert cache.get_hash(movie_filename) == changed
+        assert spy.call_count == 3
+
+    with closing(ss.HashCache(cache_filename, rehash=True)) as cache:
+        assert cache.get_hash(movie_filename) == changed
+        assert spy.call_count == 4
+
+
+def test_search_cache(tmpdir, mocker):
+    time_mock = mocker.patch('time.time', return_value=1000.0)
+    cache_filename = str(tmpdir / 'searches.sqlite')
+    queries = [
+        {'query': '"Drive"', 'sublanguageid': 'eng'},
+        {'moviehash': '13ab', 'moviebytesize': '10', 'sublanguageid': 'eng'},
+        {'query': '"Drive"', 'sublanguageid': 'pob'},
+        {'moviehash': '13ab', 'moviebytesize': '10', 'sublanguageid': 'pob'},
+    ]
+    jobs = [('drive.avi', 'eng')] * 2 + [('drive.avi', 'pob')] * 2
+
+    def lookup(cache):
+        cached, remaining_queries, remaining_jobs = cache.lookup(queries, jobs)
+        assert remaining_queries == [q for q, j in zip(queries, jobs)
+                                     if j not in cached]
+        return cached
+
+    with closing(ss.SearchCache(cache_filename, ttl=100,
+                                negative_ttl=10)) as cache:
+        assert lookup(cache) == {}
+        cache.store(queries, jobs, {('drive.avi', 'eng'): [{'IDSub': '1'}],
+                                    ('drive.avi', 'pob'): []})
+        assert lookup(cache) == {('drive.avi', 'eng'): [{'IDSub': '1'}],
+                                 ('drive.avi', 'pob'): []}
+        assert (cache.hits, cache.misses) == (2, 2)
+
+    with closing(ss.SearchCache(cache_filename, ttl=100,
+                                negative_ttl=10)) as cache:
+        # negative results expire first...
+        time_mock.return_value = 1011.0
+        assert list(lookup(cache)) == [('drive.avi', 'eng')]
+        # ...and back off exponentially when still not found
+        cache.store(queries[2:], jobs[2:], {('drive.avi', 'pob'): []})
+        time_mock.return_value = 1011.0 + 19
+        assert ('drive.avi', 'pob') in lookup(cache)
+        time_mock.return_value = 1011.0 + 21
+        assert ('drive.avi', 'pob') not in lookup(cache)
+
+        time_mock.return_value = 1101.0
+        assert lookup(cache) == {}
+
+    with closing(ss.SearchCache(cache_filename, refresh=True)) as cache:
+        cache.store(queries, jobs, {('drive.avi', 'eng'): [{'IDSub': '2'}]})
+        assert lookup(cache) == {}
+
+
+def test_run_journal(tmpdir):
+    journal_filename = str(tmpdir / 'journal.sqlite')
+    a, b = str(tmpdir / 'a.avi'), str(tmpdir / 'b.avi')
+    with closing(ss.RunJournal(journal_filename)) as journal:
+        journal.start([(a, 'eng'), (a, 'pob'), (b, 'eng'), (b, 'pob')])
+        journal.record([(a, 'eng'), (b, 'eng')], 'downloaded')
+        journal.record([(a, 'pob')], 'searched')
+        journal.record([(b, 'pob')], 'failed')
+        journal.record_movie(a, 'downloaded', 'embedded')
+
+    with closing(ss.RunJournal(journal_filename)) as journal:
+        assert journal.incomplete() == [(b, 'pob')]
+        assert journal.downloaded() == [(b, 'eng')]
+        # a new run forgets the finished pairs, but not the unfinished ones
+        c = str(tmpdir / 'c.avi')
+        journal.start([(b, 'eng'), (c, 'eng')])
+        assert journal.incomplete() == [(b, 'eng'), (b, 'pob'), (c, 'eng')]
+        assert journal.downloaded() == []
+        assert len(journal._pairs('searched', 'embedded')) == 0
+
+
+def test_run_journal_concurrent(tmpdir, mocker):
+    """
+    Runs at the same time share the journal, and a run goes on without it if
+    it can't be written.
+    """
+    journal_filename = str(tmpdir / 'journal.sqlite')
+    a, b = str(tmpdir / 'a.avi'), str(tmpdir / 'b.avi')
+    with closing(ss.RunJournal(journal_filename)) as first, \
+            closing(ss.RunJournal(journal_filename)) as second:
+        first.start([(a, 'eng')])
+        first.record([(a, 'eng')], 'failed')
+        second.start([(b, 'eng')])
+        second.record([(b, 'eng')], 'failed')
+        first.record([(a, 'eng')], 'planned')
+        assert first.error is None and second.error is None
+        assert first.incomplete() == [(a, 'eng'), (b, 'eng')]
+
+    import sqlite3
+    with closing(ss.RunJournal(journal_filename)) as journal:
+        error = sqlite3.OperationalError('database is locked')
+        mocker.patch.object(journal, '_connect', side_effect=error)
+        journal.start([(a, 'eng')])
+        assert str(journal.error) == 'database is locked'
+        journal.record([(a, 'eng')], 'searched')
+        assert journal._connect.call_count == 1
+
+
 def test_embed_mkv(mocker):
     mocked_popen = mocker.patch('subprocess.Popen')
     mocked_popen.return_value = popen = MagicMock()
@@ -289,15 +1241,14 @@ def test_embed_mkv(mocker):
 
     subtitles = [('eng', u'foo.eng.srt'), ('pob', u'foo.pob.srt')]
     mocked_convert = mocker.patch('ss.convert_language_code_to_iso639_2',
-               side_effect=['eng', 'por', 'eng'])
+               side_effect=['eng', 'por', 'eng', 'eng'])
     assert ss.embed_mkv(u'foo.avi', subtitles) == (True, '')
     mocked_convert.assert_has_calls([call('eng'), call('pob')])
 
     params = (u'mkvmerge --output foo.mkv foo.avi '
               u'--language 0:eng foo.eng.srt '
               u'--language 0:por foo.pob.srt').split()
-    mocked_popen.assert_called_once_with(params, shell=True,
-                                         stderr=subprocess.STDOUT,
+    mocked_popen.assert_called_once_with(params, stderr=subprocess.STDOUT,
                                          stdout=subprocess.PIPE)
     popen.communicate.assert_called_once_with()
     popen.poll.assert_called_once_with()
@@ -307,6 +1258,184 @@ def test_embed_mkv(mocker):
     result = ss.embed_mkv(u'foo.avi', [('eng', u'foo.srt')])
     assert result == (False, 'failed error')
 
+    mocked_popen.side_effect = OSError(errno.ENOENT, 'No such file')
+    result = ss.embed_mkv(u'foo.avi', [('eng', u'foo.srt')])
+    assert result == (False, '[Errno 2] No such file')
+
+
+def test_embed_movie_free_space(tmpdir, mocker):
+    movie_filename = str(tmpdir.join('movie.avi'))
+    subtitle_filename = str(tmpdir.join('movie.srt'))
+    tmpdir.join('movie.avi').write('x' * 1000)
+    tmpdir.join('movie.srt').write('x' * 100)
+
+    def embed_mkv(movie_filename, subtitles):
+        tmpdir.join('movie.mkv').write('x' * 1050)
+        return True, ''
+
+    mocker.patch('ss.embed_mkv', autospec=True, side_effect=embed_mkv)
+
+    mocker.patch('ss.free_space', autospec=True, return_value=1099)
+    mkv_filename, status, output, written = ss.embed_movie(
+        movie_filename, [('eng', subtitle_filename)])
+    assert status is False
+    assert output.startswith('Not enough free space')
+    assert not ss.embed_mkv.called
+
+    ss.free_space.return_value = 1100
+    assert ss.embed_movie(movie_filename, [('eng', subtitle_filename)]) == \
+        (str(tmpdir.join('movie.mkv')), True, '', 1050)
+    assert ss.free_space(str(tmpdir)) is not None
+
+
+def test_update_mkv(tmpdir, mocker):
+    mkv_filename = str(tmpdir.join('movie.mkv'))
+    tmpdir.join('movie.mkv').write('original')
+    os.chmod(mkv_filename, 0o640)
+    subtitles = [('eng', 'movie.eng.srt'), ('pob', 'movie.pob.srt')]
+
+    def embed_mkv(movie_filename, subtitles, output_filename=None):
+        assert movie_filename == mkv_filename
+        # next to the original, so it can be renamed over it
+        assert os.path.dirname(output_filename) == str(tmpdir)
+        with open(output_filename, 'w') as f:
+            f.write('updated')
+        return True, ''
+
+    mocker.patch('ss.embed_mkv', autospec=True, side_effect=embed_mkv)
+    assert ss.update_mkv(mkv_filename, subtitles) == (True, '')
+    assert ss.embed_mkv.call_count == 1  # all languages in a single pass
+    assert tmpdir.join('movie.mkv').read() == 'updated'
+    assert os.stat(mkv_filename).st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmpdir)) == ['movie.mkv']
+
+    ss.embed_mkv.side_effect = None
+    ss.embed_mkv.return_value = (False, 'error')
+    assert ss.update_mkv(mkv_filename, subtitles) == (False, 'error')
+    assert tmpdir.join('movie.mkv').read() == 'updated'
+    assert os.listdir(str(tmpdir)) == ['movie.mkv']
+
+
+def test_mkv_subtitle_languages(mocker):
+    info = {'tracks': [
+        {'type': 'video', 'properties': {'language': 'und'}},
+        {'type': 'subtitles', 'properties': {'language': 'eng'}},
+        {'type': 'subtitles', 'properties': {'language': 'por'}},
+    ]}
+    mocker.patch('ss.check_output', autospec=True,
+                 return_value=json.dumps(info).encode('utf-8'))
+    assert ss.mkv_subtitle_languages(u'movie.mkv') == set(['eng', 'por'])
+    ss.check_output.assert_called_once_with([u'mkvmerge', u'-J',
+                                             u'movie.mkv'])
+
+    ss.check_output.side_effect = OSError(errno.ENOENT, 'No such file')
+    assert ss.mkv_subtitle_languages(u'movie.mkv') == set()
+
+
+def test_pipeline_stage_errors():
+    done = []
+    errors = []
+    finished = threading.Event()
+
+    def func(item):
+        if item == 1:
+            raise ValueError('bad item')
+        done.append(item)
+
+    stage = ss.PipelineStage(func, 1, on_finished=finished.set,
+                             on_error=lambda item, e: errors.append((item,
+                                                                     str(e))))
+    for item in range(3):
+        stage.put(item)
+    stage.close()
+    stage.join()
+    # the worker goes on after an item fails
+    assert done == [0, 2]
+    assert errors == [(1, 'bad item')]
+    assert finished.is_set()
+
+
+def test_mkv_scheduler(tmpdir):
+    sizes = {'a.avi': 300, 'b.avi': 100, 'c.avi': 200, 'd.avi': 50}
+    for name, size in sizes.items():
+        tmpdir.join(name).write('x' * size)
+    first_started = threading.Event()
+    release = threading.Event()
+    lock = threading.Lock()
+    done = []
+    running = [0]
+    most_running = [0]
+
+    def embed(item):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        if not done:
+            first_started.set()
+            release.wait(5)
+        with lock:
+            running[0] -= 1
+            done.append(os.path.basename(item[0]))
+
+    finished = []
+    scheduler = ss.MkvScheduler(embed, 3, max_per_device=1,
+                                on_finished=lambda: finished.append(True))
+    scheduler.put((str(tmpdir.join('a.avi')), []))
+    assert first_started.wait(5)
+    for name in ['b.avi', 'c.avi', 'd.avi']:
+        scheduler.put((str(tmpdir.join(name)), []))
+    # all movies are on the same device, so the others wait for the first
+    # and are then created smallest first, one at a time
+    release.set()
+    scheduler.close()
+    scheduler.join()
+    assert done == ['a.avi', 'd.avi', 'b.avi', 'c.avi']
+    assert most_running[0] == 1
+    assert finished == [True]
+
+
+def test_mkv_scheduler_errors(tmpdir):
+    tmpdir.join('a.avi').write('x')
+    tmpdir.join('b.avi').write('xx')
+    done = []
+    errors = []
+
+    def embed(item):
+        if item[0].endswith('a.avi'):
+            raise OSError(errno.EACCES, 'Permission denied')
+        done.append(item)
+
+    scheduler = ss.MkvScheduler(embed, 1,
+                                on_error=lambda item, e: errors.append(item))
+    scheduler.put((str(tmpdir / 'a.avi'), []))
+    scheduler.put((str(tmpdir / 'b.avi'), []))
+    scheduler.close()
+    scheduler.join()
+    # the worker goes on after an item fails
+    assert errors == [(str(tmpdir / 'a.avi'), [])]
+    assert done == [(str(tmpdir / 'b.avi'), [])]
+
+
+def test_mkv_exception(runner):
+    """
+    :type runner: _Runner
+    """
+    runner.register('first.avi', ['eng'])
+    runner.register('second.avi', ['eng'])
+    runner.configuration.mkv = True
+    runner.configuration.mkv_jobs = 1
+
+    def embed_mkv(movie_filename, subtitles):
+        if 'first' in movie_filename:
+            raise OSError(errno.EACCES, 'Permission denied')
+        return runner._mock_embed_mkv(movie_filename, subtitles)
+
+    ss.embed_mkv.side_effect = embed_mkv
+    assert runner.run('first.avi', 'second.avi') == 0
+    runner.check_output_matches(r'first.mkv.*\[ERROR\]')
+    runner.check_output_matches('Permission denied')
+    runner.check_output_matches(r'second.mkv.*\[OK\]')
+
 
 def test_normal_execution(runner):
     """
@@ -393,6 +1522,20 @@ def test_verbose(runner):
     assert 'mkv = False' in runner.output
 
 
+def test_verbose_analysis_counters(runner):
+    """
+    :type runner: _Runner
+    """
+    runner.register('movie.avi', ['eng'])
+    assert runner.run('--verbose', 'movie.avi') == 0
+    runner.check_output_matches(
+        r'Movie analysis: 1 guessit parses \(0 saved, 0 cached\)')
+    # guesses are cached between runs
+    assert runner.run('--verbose', 'movie.avi') == 0
+    runner.check_output_matches(
+        r'Movie analysis: 0 guessit parses \(0 saved, 1 cached\)')
+
+
 def test_missing_mkv(runner):
     """
     :type runner: _Runner
@@ -404,6 +1547,332 @@ def test_missing_mkv(runner):
     assert 'mkvmerge not found in PATH' in runner.output
 
 
+def test_mkv_pipelined(runner, tmpdir):
+    """
+    The mkv file of a movie is created as soon as all its subtitles are
+    downloaded, while other downloads are still running.
+
+    :type runner: _Runner
+    """
+    runner.register('first.avi', ['eng', 'pob'])
+    runner.register('second.avi', ['eng', 'pob'])
+    runner.configuration.mkv = True
+    runner.configuration.languages = ['eng', 'pob']
+    runner.configuration.search_batch_size = 4
+    first_embedded = threading.Event()
+
+    def embed_mkv(movie_filename, subtitles):
+        first_embedded.set()
+        return runner._mock_embed_mkv(movie_filename, subtitles)
+
+    def download(url, name, http_pool=None):
+        if 'second' in name:
+            assert first_embedded.wait(timeout=5)
+        return runner._mock_download(url, name)
+
+    ss.embed_mkv.side_effect = embed_mkv
+    ss.download_subtitle.side_effect = download
+    assert runner.run('first.avi', 'second.avi') == 0
+    runner.check_output_matches(r'first.mkv.*\[OK\]')
+    runner.check_output_matches(r'second.mkv.*\[OK\]')
+    assert ss.embed_mkv.call_count == 2
+
+
+def test_mkv_in_place(runner, tmpdir):
+    """
+    :type runner: _Runner
+    """
+    runner.register('movie.mkv', ['eng', 'pob'])
+    runner.configuration.mkv = True
+    runner.configuration.languages = ['eng', 'pob']
+    assert runner.run('movie.mkv') == 0
+    runner.check_output_matches(r'movie.mkv.*\[skipped\]')
+    assert not ss.embed_mkv.called
+
+    runner.configuration.mkv_in_place = True
+    ss.mkv_subtitle_languages.return_value = set(['eng'])
+    assert runner.run('movie.mkv') == 0
+    runner.check_output_matches(r'movie.mkv.*\[OK\] 0.0 MB written')
+    # only the languages the file doesn't have yet are added
+    assert ss.embed_mkv.call_count == 1
+    assert ss.embed_mkv.call_args[0][1] == [
+        ('pob', str(tmpdir / 'movie.pob.srt'))]
+    assert tmpdir.join('movie.mkv').read() == 'mkv'
+
+    ss.mkv_subtitle_languages.return_value = set(['eng', 'por'])
+    assert runner.run('movie.mkv') == 0
+    runner.check_output_matches(r'movie.mkv.*\[skipped\]')
+    assert ss.embed_mkv.call_count == 1
+
+
+def test_watch(runner, tmpdir):
+    """
+    :type runner: _Runner
+    """
+    runner.register('old.avi', ['eng'])
+    runner.register('new.avi', ['eng'])
+    runner.configuration.mkv = True
+    runner.configuration.watch_delay = 0
+    new_filename = str(tmpdir / 'new.avi')
+
+    class FakeWatcher(object):
+        method = 'fake'
+        closed = False
+
+        def __init__(self, changes):
+            self.changes = changes
+
+        def read(self, timeout=None):
+            if not self.changes:
+                raise KeyboardInterrupt
+            return self.changes.pop(0)
+
+        def close(self):
+            self.closed = True
+
+    watcher = FakeWatcher([
+        [(new_filename, False)],  # still being written
+        [(new_filename, True)],
+        [(str(tmpdir / 'new.mkv'), True)],  # created by ss itself
+    ])
+    create_watcher = runner._mocker.patch('ss.create_watcher',
+                                         return_value=watcher)
+    assert runner.run('--watch', '.') == 0
+    create_watcher.assert_called_once_with([str(tmpdir / '.')],
+                                          recursive=False)
+    assert watcher.closed
+    runner.check_output_matches(r'Watching .* \(fake\)')
+    # only the new movie is searched, once, without listing the directory
+    assert ss.query_open_subtitles_batch.call_count == 1
+    assert ss.embed_mkv.call_count == 1
+    runner.check_files('old.avi', 'new.avi', 'new.srt', 'new.mkv')
+
+    assert runner.run('--watch', 'old.avi') == 2
+    assert '--watch needs directories' in runner.output
+
+
+def test_resume(runner, tmpdir):
+    """
+    :type runner: _Runner
+    """
+    runner.register('first.avi', ['eng'])
+    runner.register('second.avi', ['eng'])
+    runner.register('third.avi', [])
+
+    def download(url, name, http_pool=None):
+        if 'second' in name:
+            raise IOError('connection reset')
+        return runner._mock_download(url, name)
+
+    ss.download_subtitle.side_effect = download
+    assert runner.run('first.avi', 'second.avi', 'third.avi') == 0
+    runner.check_output_matches(r'second.avi.*\[ERROR\]')
+
+    # only the failed download is searched again
+    ss.download_subtitle.side_effect = runner._mock_download
+    ss.query_open_subtitles_batch.reset_mock()
+    assert runner.run('--resume') == 0
+    assert 'Resuming 1 unfinished subtitles.' in runner.output
+    assert ss.query_open_subtitles_batch.call_count == 1
+    movie_languages = ss.query_open_subtitles_batch.call_args[0][0]
+    assert movie_languages == [(str(tmpdir / 'second.avi'), 'eng')]
+    runner.check_files('first.avi', 'first.srt', 'second.avi', 'second.srt',
+                       'third.avi')
+
+    assert runner.run('--resume') == 0
+    assert 'Nothing to resume.' in runner.output
+    assert runner.run('--resume', 'first.avi') == 2
+
+
+def test_resume_after_other_run(runner, tmpdir):
+    """
+    Runs on other movies, or with nothing to do, keep what an interrupted
+    run didn't finish.
+
+    :type runner: _Runner
+    """
+    runner.register('first.avi', ['eng'])
+    runner.register('second.avi', ['eng'])
+    runner.register('other.avi', ['eng'])
+    journal_filename = os.path.join(runner.configuration.cache_dir,
+                                    'journal.sqlite')
+
+    # nothing to do: the journal isn't even created
+    runner.configuration.skip = True
+    tmpdir.join('first.srt').write('eng')
+    assert runner.run('first.avi') == 0
+    assert 'Skipping 1 subtitles.' in runner.output
+    assert not os.path.exists(journal_filename)
+    tmpdir.join('first.srt').remove()
+    runner.configuration.skip = False
+
+    def download(url, name, http_pool=None):
+        if 'second' in name:
+            raise IOError('connection reset')
+        return runner._mock_download(url, name)
+
+    ss.download_subtitle.side_effect = download
+    assert runner.run('first.avi', 'second.avi') == 0
+    ss.download_subtitle.side_effect = runner._mock_download
+    assert runner.run('other.avi') == 0
+    runner.configuration.skip = True
+    assert runner.run('first.avi') == 0
+    assert 'Skipping 1 subtitles.' in runner.output
+
+    ss.query_open_subtitles_batch.reset_mock()
+    assert runner.run('--resume') == 0
+    assert 'Resuming 1 unfinished subtitles.' in runner.output
+    movie_languages = ss.query_open_subtitles_batch.call_args[0][0]
+    assert movie_languages == [(str(tmpdir / 'second.avi'), 'eng')]
+
+
+def test_resume_mkv(runner, tmpdir):
+    """
+    Subtitles downloaded by the last run go straight to the mkv file, even
+    if `skip` is enabled.
+
+    :type runner: _Runner
+    """
+    runner.register('first.avi', ['eng', 'pob'])
+    runner.configuration.languages = ['eng', 'pob']
+    runner.configuration.mkv = True
+    runner.configuration.skip = True
+
+    # the last run was interrupted before creating the mkv file
+    movie = str(tmpdir / 'first.avi')
+    tmpdir.join('first.eng.srt').write('eng')
+    tmpdir.join('first.pob.srt').write('pob')
+    journal_filename = os.path.join(runner.configuration.cache_dir,
+                                    'journal.sqlite')
+    with closing(ss.RunJournal(journal_filename)) as journal:
+        journal.start([(movie, 'eng'), (movie, 'pob')])
+        journal.record([(movie, 'eng'), (movie, 'pob')], 'downloaded')
+
+    ss.query_open_subtitles_batch.reset_mock()
+    assert runner.run('--resume') == 0
+    assert 'Resuming 2 unfinished subtitles.' in runner.output
+    assert not ss.query_open_subtitles_batch.called
+    ss.embed_mkv.assert_called_once_with(
+        str(tmpdir / 'first.avi'), [
+            ('eng', str(tmpdir / 'first.eng.srt')),
+            ('pob', str(tmpdir / 'first.pob.srt')),
+        ],
+    )
+    runner.check_files('first.avi', 'first.eng.srt', 'first.pob.srt',
+                       'first.mkv')
+
+    assert runner.run('--resume') == 0
+    assert 'Nothing to resume.' in runner.output
+
+
+def test_debouncer():
+    debouncer = ss.Debouncer(5)
+    assert debouncer.timeout(now=0) is None
+    debouncer.touch('a.avi', complete=False, now=0)
+    assert debouncer.timeout(now=0) is None
+    debouncer.touch('b.avi', complete=True, now=1)
+    debouncer.touch('a.avi', complete=True, now=2)
+    assert debouncer.timeout(now=3) == 3
+    assert debouncer.ready(now=5) == []
+    assert debouncer.ready(now=6) == ['b.avi']
+    # writing again postpones it
+    debouncer.touch('a.avi', complete=False, now=6)
+    assert debouncer.ready(now=10) == []
+    debouncer.touch('a.avi', complete=True, now=10)
+    assert debouncer.ready(now=15) == ['a.avi']
+    assert debouncer.timeout(now=15) is None
+
+
+def test_debouncer_incomplete(tmpdir):
+    """
+    Paths never closed are forgotten once removed, or after a while.
+    """
+    kept = str(tmpdir.join('kept.avi').ensure())
+    removed = str(tmpdir / 'removed.avi')
+    debouncer = ss.Debouncer(5, expire=60)
+    debouncer.touch(kept, complete=False, now=0)
+    debouncer.touch(removed, complete=False, now=0)
+    assert debouncer.ready(now=10) == []
+    assert sorted(debouncer._changed) == [kept]
+    assert debouncer.ready(now=59) == []
+    assert sorted(debouncer._changed) == [kept]
+    assert debouncer.ready(now=60) == []
+    assert debouncer._changed == {}
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='requires inotify')
+def test_inotify_watcher(tmpdir):
+    tmpdir.join('sub').ensure(dir=True)
+    watcher = ss.InotifyWatcher([str(tmpdir)], recursive=True)
+    try:
+        tmpdir.join('sub', 'movie.avi').write('movie')
+        changes = []
+        while (str(tmpdir / 'sub' / 'movie.avi'), True) not in changes:
+            changes.extend(watcher.read(timeout=5))
+        assert (str(tmpdir / 'sub' / 'movie.avi'), False) in changes
+
+        # files of directories moved in are reported too
+        moved = tmpdir.dirpath(tmpdir.basename + '-moved').ensure(dir=True)
+        moved.join('other.avi').write('movie')
+        moved.move(tmpdir.join('new'))
+        assert watcher.read(timeout=5) == [
+            (str(tmpdir / 'new' / 'other.avi'), True)]
+        assert watcher.read(timeout=0) == []
+    finally:
+        watcher.close()
+
+
+def test_polling_watcher(tmpdir, mocker):
+    tmpdir.join('existing.avi').write('movie')
+    mocker.patch('time.sleep')
+    watcher = ss.create_watcher([str(tmpdir)])
+    if watcher.method == 'inotify':
+        watcher.close()
+        mocker.patch('ss.InotifyWatcher', side_effect=OSError)
+        watcher = ss.create_watcher([str(tmpdir)])
+    assert watcher.method == 'polling every 2s'
+    assert watcher.read() == []
+    tmpdir.join('movie.avi').write('movie')
+    tmpdir.join('sub').ensure(dir=True).join('other.avi').write('movie')
+    assert watcher.read() == [(str(tmpdir / 'movie.avi'), True)]
+    tmpdir.join('movie.avi').write('more movie')
+    assert watcher.read(timeout=1) == [(str(tmpdir / 'movie.avi'), True)]
+    time.sleep.assert_called_with(1)
+    assert watcher.read() == []
+    watcher.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink'), reason='requires symlinks')
+def test_watcher_symlink_loop(tmpdir, mocker):
+    """
+    Directory symlink loops are watched only once.
+    """
+    tmpdir.join('a').ensure(dir=True)
+    os.symlink(os.pardir, str(tmpdir / 'a' / 'loop'))
+    movie = str(tmpdir / 'a' / 'movie.avi')
+
+    if sys.platform.startswith('linux'):
+        watcher = ss.InotifyWatcher([str(tmpdir)], recursive=True)
+        try:
+            assert len(watcher._dirnames) == 2
+            tmpdir.join('a', 'movie.avi').write('movie')
+            changes = []
+            while (movie, True) not in changes:
+                changes.extend(watcher.read(timeout=5))
+            assert set(path for path, _ in changes) == {movie}
+        finally:
+            watcher.close()
+        tmpdir.join('a', 'movie.avi').remove()
+
+    mocker.patch('time.sleep')
+    watcher = ss.PollingWatcher([str(tmpdir)], recursive=True)
+    assert watcher.read() == []
+    tmpdir.join('a', 'movie.avi').write('movie')
+    assert watcher.read() == [(movie, True)]
+    watcher.close()
+
+
 def test_mkv_error(runner):
     runner.register('movie.avi', ['eng'])
     runner.configuration.mkv = True
@@ -443,6 +1912,111 @@ def test_mkv_with_subtitles_already_inplace(runner, tmpdir):
     runner.check_output_matches(r'serieS01E01.mkv.*\[skipped\]')
 
 
+def test_batched_search(runner):
+    """
+    :type runner: _Runner
+    """
+    for i in range(3):
+        runner.register('serieS01E0%d.avi' % i, ['eng'])
+    runner.configuration.search_batch_size = 4
+    assert runner.run('serieS01E00.avi', 'serieS01E01.avi',
+                      'serieS01E02.avi') == 0
+    assert ss.query_open_subtitles_batch.call_count == 2
+    for i in range(3):
+        runner.check_output_matches(r'serieS01E0%d.avi.*\[OK\]' % i)
+
+
+def test_retry_search(runner, mocker):
+    """
+    :type runner: _Runner
+    """
+    mocker.patch('time.sleep')
+    runner.register('movie.avi', ['eng'])
+    ss.query_open_subtitles_batch.side_effect = [
+        socket.error(errno.ECONNRESET, 'Connection reset by peer'),
+        runner._mock_query([(str(runner._tmpdir / 'movie.avi'), 'eng')]),
+    ]
+    assert runner.run('movie.avi') == 0
+    runner.check_output_matches(r'movie.avi.*\[OK\]')
+    runner.check_output_matches(
+        r'Search retries: 1 retries, 0 gave up; circuit opened 0 times')
+
+
+def test_deadline_exceeded(runner, mocker):
+    """
+    :type runner: _Runner
+    """
+    runner.register('movie1.avi', ['eng'])
+    runner.register('movie2.avi', ['eng'])
+    runner.configuration.deadline = 5
+    mocker.patch.object(ss.Deadline, 'expired', return_value=True)
+    assert runner.run('movie1.avi', 'movie2.avi') == 0
+    assert not ss.query_open_subtitles_batch.called
+    runner.check_output_matches(r'movie1.avi.*\[timeout\]')
+    runner.check_output_matches(r'movie2.avi.*\[timeout\]')
+    runner.check_output_matches(r'Deadline of 5 minutes reached: 2 subtitles')
+
+
+def test_profile(runner, tmpdir):
+    """
+    :type runner: _Runner
+    """
+    runner.register('movie.avi', ['eng'])
+    trace_filename = str(tmpdir.dirpath(tmpdir.basename + '-trace.json'))
+    assert runner.run('--trace=' + trace_filename, '.') == 0
+    runner.check_output_matches(r'Stage\s+Jobs\s+Total s\s+Busy')
+    runner.check_output_matches(r'walk\s+1 ')
+    runner.check_output_matches('Trace written to')
+    assert ss._profiler is None
+
+    with open(trace_filename) as f:
+        events = json.load(f)['traceEvents']
+    walk, = [x for x in events if x['name'] == 'walk']
+    assert walk['ph'] == 'X' and walk['dur'] >= 0
+    assert walk['args'] == {'detail': str(tmpdir)}
+    assert any(x['ph'] == 'M' and x['tid'] == walk['tid'] for x in events)
+
+
+def test_profiler(mocker):
+    time_mock = mocker.patch('time.time', return_value=0.0)
+    profiler = ss.Profiler()
+    for i in range(1, 101):
+        with profiler.span('search', virtual=True):
+            # overlapping coroutines get different lanes
+            with profiler.span('search', virtual=True):
+                time_mock.return_value += i / 1000.0
+    lanes = set(x[1] for x in profiler.spans)
+    assert lanes == set(['async-0', 'async-1'])
+    stage, count, total, p50, p99, maximum = profiler.summary()[0]
+    assert (stage, count) == ('search', 200)
+    assert round(p50, 3) == 0.051
+    assert round(p99, 3) == 0.099
+    assert round(maximum, 3) == 0.1
+
+
+def test_rehash(runner):
+    """
+    :type runner: _Runner
+    """
+    runner.register('movie.avi', ['eng'])
+    assert runner.run('movie.avi') == 0
+    analyzer = ss.query_open_subtitles_batch.call_args[1]['analyzer']
+    assert not analyzer.hash_cache.rehash
+    assert runner.run('--rehash', 'movie.avi') == 0
+    analyzer = ss.query_open_subtitles_batch.call_args[1]['analyzer']
+    assert analyzer.hash_cache.rehash
+
+
+def test_unknown_engine(runner):
+    """
+    :type runner: _Runner
+    """
+    runner.register('movie.avi', ['eng'])
+    runner.configuration.engine = 'fibers'
+    assert runner.run('movie.avi') == 2
+    runner.check_output_matches('Unknown engine "fibers"')
+
+
 def test_no_matches(runner, tmpdir):
     tmpdir.join('movie.avi').ensure()
     assert runner.run('movie.avi') == 0
@@ -467,7 +2041,8 @@ class _Runner(object):
         self._mocker = mocker
         self._movies = set()
         self._subtitles = {}  # movie name to set of subtitle langues
-        self.configuration = ss.Configuration(mkv=False)
+        self.configuration = ss.Configuration(
+            mkv=False, cache_dir=str(tmpdir.dirpath(tmpdir.basename + '-cache')))
         self.output = None
         self.downloaded = set()
 
@@ -489,28 +2064,37 @@ class _Runner(object):
 
     def start(self):
         p = self._mocker.patch
-        p('ss.query_open_subtitles', side_effect=self._mock_query)
+        p('ss.query_open_subtitles_batch', side_effect=self._mock_query)
         p('ss.download_subtitle', side_effect=self._mock_download)
         p('ss.load_configuration', return_value=self.configuration)
         p('ss.embed_mkv', side_effect=self._mock_embed_mkv)
+        p('ss.mkv_subtitle_languages', return_value=set())
         p('ss.check_mkv_installed', return_value=True)
 
 
-    def _mock_download(self, url, name):
+    def _mock_download(self, url, name, http_pool=None):
         with open(name, 'w') as f:
             f.write('downloaded')
         self.downloaded.add(name)
 
 
-    def _mock_query(self, movie_filename, language):
-        movie_name = os.path.basename(movie_filename)
-        if language in self._subtitles.get(movie_name, set()):
-            return [{'SubDownloadLink': 'fake_url', 'SubFormat': 'srt'}]
-        else:
-            return []
+    def _mock_query(self, movie_languages, session_pool=None, analyzer=None,
+                    search_cache=None, hedger=None, two_phase=False,
+                    controller=None):
+        result = {}
+        for movie_filename, language in movie_languages:
+            movie_name = os.path.basename(movie_filename)
+            if language in self._subtitles.get(movie_name, set()):
+                search_results = [{'SubDownloadLink': 'fake_url',
+                                   'SubFormat': 'srt'}]
+            else:
+                search_results = []
+            result[(movie_filename, language)] = search_results
+        return result
 
 
-    def _mock_embed_mkv(self, movie_filename, subtitles):
+    def _mock_embed_mkv(self, movie_filename, subtitles,
+                        output_filename=None):
         if not os.path.isfile(movie_filename):
             return False, '{} not found'.format(movie_filename)
 
@@ -518,7 +2102,10 @@ class _Runner(object):
             if not os.path.isfile(subtitle_filename):
                 return False, '{} not found'.format(subtitle_filename)
 
-        open(os.path.splitext(movie_filename)[0] + '.mkv', 'w').close()
+        if output_filename is None:
+            output_filename = os.path.splitext(movie_filename)[0] + '.mkv'
+        with open(output_filename, 'w') as f:
+            f.write('mkv' * len(subtitles))
         return True, ''
 
 